@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reading and parsing the HTTP-POST body of large SAML responses: the old
+get_post + parse_qs of the whole body, compared with the bounded reader that
+only decodes the SAML fields. Reports time per body and peak memory.
+
+    python -m benchmarks.body [-n 200] [-s 64 256 1024]
+
+The responses come from the FakeIdP of the test suite, with one attribute
+padded to make the response the given number of KB.
+"""
+
+import argparse
+import io
+import time
+import tracemalloc
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+
+from saml2.httputil import get_post
+
+from s2sproxy.server import WsgiApplication
+from s2sproxy.service import parse_form
+from s2sproxy.service import read_body
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import login_response
+
+# Form fields a browser may send along, ignored by the proxy.
+NOISE = {"submit": "Continue", "extra": "x" * 4096}
+
+
+def response_body(app, sp, size):
+    users = {"test1": dict(USERS["test1"], description="x" * (size * 1024))}
+    _, form = login_response(app.run_server, sp, FakeIdP(users))
+    form.update(NOISE)
+    return urlencode(form).encode("utf-8")
+
+
+def old_unpack(environ):
+    _dict = parse_qs(get_post(environ).decode("utf-8"))
+    return dict([(k, v[0]) for k, v in _dict.items()])
+
+
+def new_unpack(environ):
+    return parse_form(read_body(environ))
+
+
+def environ(body):
+    return {"CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body),
+            "s2sproxy.max_body_size": len(body)}
+
+
+def measure(unpack, body, count):
+    tracemalloc.start()
+    unpack(environ(body))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(count):
+        unpack(environ(body))
+    return (time.perf_counter() - start) / count, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", type=int, default=200,
+                        help="Bodies parsed per measurement.")
+    parser.add_argument("-s", dest="sizes", type=int, nargs="+",
+                        default=[64, 256, 1024],
+                        help="Sizes of the padding, KB.")
+    args = parser.parse_args()
+
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    sp = FakeSP("tests.configurations.sp_conf")
+    print("%10s %14s %14s %14s %14s" % ("body KB", "old ms", "new ms",
+                                        "old peak KB", "new peak KB"))
+    for size in args.sizes:
+        body = response_body(app, sp, size)
+        assert (old_unpack(environ(body))["SAMLResponse"] ==
+                new_unpack(environ(body))["SAMLResponse"])
+        old_time, old_peak = measure(old_unpack, body, args.count)
+        new_time, new_peak = measure(new_unpack, body, args.count)
+        print("%10d %14.3f %14.3f %14d %14d" % (
+            len(body) / 1024, old_time * 1000, new_time * 1000,
+            old_peak / 1024, new_peak / 1024))
+
+
+if __name__ == "__main__":
+    main()
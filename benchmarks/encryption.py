@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Responses/sec with plain, signed and signed+encrypted assertions, with the
+xmlsec1 and the in-process crypto backends: the proxy's IdP making the
+response to an SP, and the proxy's SP parsing (verifying, decrypting) a
+response from an IdP.
+
+    python -m benchmarks.encryption [-n 100]
+
+Requires xmlsec1 and python-xmlsec.
+"""
+
+import argparse
+import base64
+import os
+import time
+
+from saml2 import BINDING_HTTP_POST
+from saml2.authn_context import PASSWORD
+
+import tests.configurations.proxy_conf as proxy_conf
+from s2sproxy.crypto import IN_PROCESS
+from s2sproxy.crypto import XMLSEC1
+from s2sproxy.server import WsgiApplication
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+
+PKI = os.path.join(os.path.dirname(__file__), "..", "tests", "pki")
+KEY_FILE = os.path.join(PKI, "key.pem")
+CERT_FILE = os.path.join(PKI, "cert.pem")
+
+# Flows: (name, sign, encrypt).
+FLOWS = [("plain", False, False), ("signed", True, False),
+         ("signed+encrypted", True, True)]
+
+
+def authn_response(idp, sp_entity_id, destination, in_response_to, sign,
+                   encrypt, cert):
+    return idp.create_authn_response(
+        USERS["test1"], in_response_to=in_response_to,
+        destination=destination, sp_entity_id=sp_entity_id, userid="test1",
+        authn={"class_ref": PASSWORD},
+        sign_response=sign, encrypt_assertion=encrypt,
+        encrypt_cert_assertion=cert if encrypt else None)
+
+
+def idp_leg(app, sp, count, sign, encrypt, cert):
+    acs = sp.config.getattr("endpoints", "sp")[
+        "assertion_consumer_service"][0][0]
+    start = time.perf_counter()
+    for i in range(count):
+        authn_response(app.idp, sp.config.entityid, acs, "id-%d" % i, sign,
+                       encrypt, cert)
+    return count / (time.perf_counter() - start)
+
+
+def sp_leg(app, idp, count, sign, encrypt, cert):
+    acs = app.sp.config.getattr("endpoints", "sp")[
+        "assertion_consumer_service"][0][0]
+    responses = [
+        base64.b64encode(str(authn_response(
+            idp, app.sp.config.entityid, acs, "id-%d" % i, sign, encrypt,
+            cert)).encode("utf-8"))
+        for i in range(count)]
+    start = time.perf_counter()
+    for i, response in enumerate(responses):
+        app.sp.parse_authn_request_response(response, BINDING_HTTP_POST,
+                                            {"id-%d" % i: "/"})
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", type=int, default=100,
+                        help="Number of responses per flow.")
+    args = parser.parse_args()
+
+    with open(CERT_FILE) as f:
+        cert = f.read()
+    proxy_conf.CONFIG["encryption_keypairs"] = [
+        {"key_file": KEY_FILE, "cert_file": CERT_FILE}]
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+
+    results = []
+    for backend in (XMLSEC1, IN_PROCESS):
+        proxy_conf.CRYPTO_BACKEND = backend
+        app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+        for name, sign, encrypt in FLOWS:
+            results.append((
+                backend, name,
+                idp_leg(app, sp, args.count, sign, encrypt, cert),
+                sp_leg(app, idp, args.count, sign, encrypt, cert)
+                if sign else None))
+
+    print("responses/sec, %d per flow" % args.count)
+    print("%-10s %-18s %10s %10s" % ("backend", "flow", "IdP leg", "SP leg"))
+    for backend, name, made, parsed in results:
+        print("%-10s %-18s %10.1f %10s" % (
+            backend, name, made, "-" if parsed is None else "%.1f" % parsed))
+
+
+if __name__ == "__main__":
+    main()
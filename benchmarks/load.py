@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test: complete SP -> proxy -> IdP -> proxy -> SP logins, with the
+FakeSP/FakeIdP from the test suite, against WsgiApplication called in-process
+or served over HTTP on localhost.
+
+    python -m benchmarks.load [-n 1000] [-c 8] [--http] [-o results.json]
+
+Reports logins/sec, p50/p95/p99 latency of each leg, RSS growth and the size
+of the login state store. With -o the results are also written as JSON, to
+compare releases. Requires xmlsec1, just like the tests.
+"""
+
+import argparse
+import http.client
+import importlib.metadata
+import json
+import platform
+import resource
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+from cheroot import wsgi
+
+from s2sproxy.server import WsgiApplication
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import call
+from tests.test_util import idp_response
+from tests.test_util import location
+from tests.test_util import sp_response
+
+# Timed parts of a login, in order.
+LEGS = ("sp_request", "proxy_request", "idp", "proxy_response",
+        "sp_response", "login")
+
+
+def rss():
+    """
+    Resident set size of this process in bytes, the peak where the current
+    size isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes elsewhere.
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+class HttpClient(object):
+    """
+    Sends the requests to a server on localhost, whatever host the SAML
+    messages are addressed to.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def __call__(self, url, method="GET", body=b""):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=30)
+        parts = urlsplit(url)
+        path = parts.path + ("?%s" % parts.query if parts.query else "")
+        headers = {"Host": parts.netloc}
+        if method == "POST":
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            conn.request(method, path, body or None, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self.local.conn = None
+            raise
+        return ("%d %s" % (resp.status, resp.reason), resp.getheaders(),
+                data)
+
+
+class InProcessClient(object):
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, url, method="GET", body=b""):
+        return call(self.app, url, method, body)
+
+
+def login(client, sp, idp, timings):
+    """
+    One complete login, the time of each leg is appended to timings.
+    """
+    start = time.perf_counter()
+    url = sp.make_auth_req()
+    t1 = time.perf_counter()
+
+    status, headers, _ = client(url)
+    assert status.startswith("303"), status
+    t2 = time.perf_counter()
+
+    action, form = idp_response(idp, location(headers))
+    t3 = time.perf_counter()
+
+    status, headers, _ = client(action, "POST",
+                                urlencode(form).encode("utf-8"))
+    assert status.startswith("302"), status
+    t4 = time.perf_counter()
+
+    assert sp_response(sp, location(headers)).ava
+    end = time.perf_counter()
+
+    for leg, duration in zip(LEGS, (t1 - start, t2 - t1, t3 - t2, t4 - t3,
+                                    end - t4, end - start)):
+        timings[leg].append(duration)
+
+
+def run(client, count, concurrency):
+    """
+    Run count logins in concurrency threads.
+
+    :return: (seconds, timings per leg, number of failed logins)
+    """
+    timings = dict((leg, []) for leg in LEGS)
+    lock = threading.Lock()
+    remaining = [count]
+    failures = [0]
+
+    def worker():
+        # pysaml2 entities aren't meant to be shared between threads.
+        sp = FakeSP("tests.configurations.sp_conf")
+        idp = FakeIdP(USERS)
+        own = dict((leg, []) for leg in LEGS)
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+            try:
+                login(client, sp, idp, own)
+            except Exception as err:
+                with lock:
+                    failures[0] += 1
+                print("login failed: %s" % err, file=sys.stderr)
+        with lock:
+            for leg in LEGS:
+                timings[leg].extend(own[leg])
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, timings, failures[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", type=int, default=1000,
+                        help="Number of logins to run.")
+    parser.add_argument("-c", dest="concurrency", type=int, default=1,
+                        help="Number of concurrent clients.")
+    parser.add_argument("--http", action="store_true",
+                        help="Serve the proxy over HTTP on localhost instead "
+                             "of calling it in-process.")
+    parser.add_argument("--warmup", type=int, default=10,
+                        help="Logins to run before measuring.")
+    parser.add_argument("-o", dest="output",
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    server = None
+    if args.http:
+        server = wsgi.Server(("127.0.0.1", 0), app.run_server,
+                             numthreads=max(10, args.concurrency))
+        server.prepare()
+        threading.Thread(target=server.serve, daemon=True).start()
+        client = HttpClient(server.bind_addr[1])
+    else:
+        client = InProcessClient(app.run_server)
+
+    try:
+        run(client, args.warmup, 1)
+        rss_start = rss()
+        elapsed, timings, failures = run(client, args.count,
+                                         args.concurrency)
+        rss_end = rss()
+    finally:
+        if server is not None:
+            server.stop()
+
+    results = {
+        "mode": "http" if args.http else "inprocess",
+        "logins": args.count,
+        "concurrency": args.concurrency,
+        "failures": failures,
+        "seconds": elapsed,
+        "logins_per_sec": (args.count - failures) / elapsed,
+        "latency": dict(
+            (leg, {"p50": percentile(timings[leg], 50),
+                   "p95": percentile(timings[leg], 95),
+                   "p99": percentile(timings[leg], 99)})
+            for leg in LEGS),
+        "rss_start": rss_start,
+        "rss_end": rss_end,
+        "rss_growth": rss_end - rss_start,
+        "state_entries": len(app.cache),
+        "state_stats": (app.cache.stats() if hasattr(app.cache, "stats")
+                        else None),
+        "versions": {"s2sproxy": version("s2sproxy"),
+                     "pysaml2": version("pysaml2"),
+                     "python": platform.python_version()},
+    }
+
+    print("mode: %s, logins: %d, concurrency: %d, failures: %d" %
+          (results["mode"], args.count, args.concurrency, failures))
+    print("logins/sec: %.1f" % results["logins_per_sec"])
+    print("%-16s %9s %9s %9s" % ("leg (ms)", "p50", "p95", "p99"))
+    for leg in LEGS:
+        latency = results["latency"][leg]
+        if latency["p50"] is None:
+            continue
+        print("%-16s %9.2f %9.2f %9.2f" % (
+            leg, latency["p50"] * 1000, latency["p95"] * 1000,
+            latency["p99"] * 1000))
+    print("RSS: %.1f MB -> %.1f MB (%+.1f MB)" % (
+        rss_start / 2.0 ** 20, rss_end / 2.0 ** 20,
+        results["rss_growth"] / 2.0 ** 20))
+    print("login state entries: %d" % results["state_entries"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
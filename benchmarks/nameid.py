@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent NameIDs/sec with the dbm file of subject_data compared with the
+NameIDStore, for users logging in the first time and returning users, and
+complete logins/sec through the proxy with PERSISTENT_NAMEID.
+
+    python -m benchmarks.nameid [-u 5000] [-n 200]
+
+The dbm file is synced after each login, as it must be for other processes
+to see the NameIDs.
+"""
+
+import argparse
+import shelve
+import shutil
+import tempfile
+import time
+
+from saml2.ident import IdentDB
+
+import tests.configurations.proxy_conf as proxy_conf
+from s2sproxy.nameid import NameIDStore
+from s2sproxy.server import WsgiApplication
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import login
+
+SP_ENTITY_ID = "https://sp.example.com/sp.xml"
+
+
+def issue(ident, sync, users):
+    start = time.perf_counter()
+    for i in range(users):
+        ident.persistent_nameid("user%d" % i, sp_name_qualifier=SP_ENTITY_ID,
+                                name_qualifier=IDP_ENTITY_ID)
+        sync()
+    return users / (time.perf_counter() - start)
+
+
+def run_ident(db, sync, users):
+    ident = IdentDB(db)
+    first = issue(ident, sync, users)
+    returning = issue(ident, sync, users)
+    return first, returning
+
+
+def run_logins(app, sync, count):
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+    start = time.perf_counter()
+    for _ in range(count):
+        login(app.run_server, sp, idp)
+        sync()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", dest="users", type=int, default=5000,
+                        help="Number of users.")
+    parser.add_argument("-n", dest="count", type=int, default=200,
+                        help="Number of logins through the proxy.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        db = shelve.open("%s/idp.subject" % directory, writeback=True,
+                         protocol=2)
+        subject_data = run_ident(db, db.sync, args.users)
+        db.close()
+
+        store = NameIDStore("%s/nameid.db" % directory)
+        nameid_store = run_ident(store, lambda: None, args.users)
+        store.close()
+
+        proxy_conf.PERSISTENT_NAMEID = True
+        app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+        db = shelve.open("%s/login.subject" % directory, writeback=True,
+                         protocol=2)
+        app.idp.ident.db = db
+        logins_subject_data = run_logins(app, db.sync, args.count)
+        db.close()
+
+        proxy_conf.NAMEID_STORE = "%s/login.db" % directory
+        app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+        logins_nameid_store = run_logins(app, lambda: None, args.count)
+        app.idp.ident.db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d users, NameIDs/sec (first login, returning)" % args.users)
+    print("%-15s %10.0f %10.0f" % (("subject_data",) + subject_data))
+    print("%-15s %10.0f %10.0f" % (("NameIDStore",) + nameid_store))
+    print("logins/sec with PERSISTENT_NAMEID, one returning user")
+    print("%-15s %10.1f" % ("subject_data", logins_subject_data))
+    print("%-15s %10.1f" % ("NameIDStore", logins_nameid_store))
+
+
+if __name__ == "__main__":
+    main()
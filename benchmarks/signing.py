@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares signatures/sec and verifications/sec of the xmlsec1 binary with the
+in-process crypto backend.
+
+    python -m benchmarks.signing [-n 200]
+"""
+
+import argparse
+import os
+import time
+
+from saml2 import class_name
+from saml2.saml import Issuer
+from saml2.samlp import Response
+from saml2.sigver import CryptoBackendXmlSec1
+from saml2.sigver import get_xmlsec_binary
+from saml2.sigver import pre_signature_part
+
+from s2sproxy.crypto import InProcessCryptoBackend
+
+PKI = os.path.join(os.path.dirname(__file__), "..", "tests", "pki")
+KEY_FILE = os.path.join(PKI, "key.pem")
+CERT_FILE = os.path.join(PKI, "cert.pem")
+
+
+def rate(func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", type=int, default=200,
+                        help="Number of operations per measurement.")
+    args = parser.parse_args()
+
+    statement = Response(id="id-1", version="2.0",
+                         issue_instant="2015-01-01T00:00:00Z",
+                         issuer=Issuer(text="https://idp.example.com"),
+                         signature=pre_signature_part("id-1", None, 1))
+    node_name = class_name(statement)
+
+    backends = [("xmlsec1", CryptoBackendXmlSec1(get_xmlsec_binary())),
+                ("inprocess", InProcessCryptoBackend())]
+    for name, backend in backends:
+        signed = backend.sign_statement(statement, node_name, KEY_FILE, "id-1")
+        sign = rate(lambda: backend.sign_statement(statement, node_name,
+                                                   KEY_FILE, "id-1"),
+                    args.count)
+        verify = rate(lambda: backend.validate_signature(
+            signed, CERT_FILE, "pem", node_name, "id-1"), args.count)
+        print("%-10s signatures/sec: %8.1f  verifications/sec: %8.1f" %
+              (name, sign, verify))
+
+
+if __name__ == "__main__":
+    main()
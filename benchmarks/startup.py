@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup time with a large federation metadata file: the SP and IdP
+configurations each parsing the metadata (how the proxy used to start), one
+shared parse, and loading the parsed metadata from a snapshot.
+
+    python -m benchmarks.startup [-e 2000] [-n 3]
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from saml2.config import config_factory
+
+from s2sproxy.server import WsgiApplication
+from tests.configurations import proxy_conf
+
+SP_METADATA = os.path.join(os.path.dirname(proxy_conf.__file__),
+                           "unittest_sp.xml")
+IDP_ENTITY_ID = "http://example.com/unittest_idp.xml"
+
+CONF_MODULE = """
+from tests.configurations.proxy_conf import *
+CONFIG = dict(CONFIG, metadata={
+    "local": [full_path("unittest_idp.xml"), %r]})
+"""
+
+
+def write_metadata(path, count):
+    """
+    Write an EntitiesDescriptor with count copies of the test SP.
+    """
+    with open(SP_METADATA) as f:
+        entity = f.read()
+    entity = entity[entity.index("<ns0:EntityDescriptor"):]
+    entity = re.sub(r" xmlns:\w+=\"[^\"]+\"", "", entity)
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<ns0:EntitiesDescriptor '
+                'xmlns:ns0="urn:oasis:names:tc:SAML:2.0:metadata" '
+                'xmlns:ns1="http://www.w3.org/2000/09/xmldsig#">')
+        for i in range(count):
+            f.write(entity.replace("unittest_sp.xml", "sp%d.xml" % i))
+        f.write("</ns0:EntitiesDescriptor>")
+
+
+def best(func, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", dest="entities", type=int, default=2000,
+                        help="Number of SPs in the metadata.")
+    parser.add_argument("-n", dest="runs", type=int, default=3,
+                        help="Runs per measurement, the fastest is reported.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        metadata = os.path.join(directory, "federation.xml")
+        write_metadata(metadata, args.entities)
+        size = os.path.getsize(metadata)
+        snapshot = os.path.join(directory, "metadata.snapshot")
+        with open(os.path.join(directory, "startup_conf.py"), "w") as f:
+            f.write(CONF_MODULE % metadata)
+        with open(os.path.join(directory, "startup_snapshot_conf.py"),
+                  "w") as f:
+            f.write(CONF_MODULE % metadata)
+            f.write("METADATA_SNAPSHOT = %r\n" % snapshot)
+        sys.path.insert(0, directory)
+
+        import startup_conf
+        saml_conf = startup_conf.CONFIG
+
+        def separate():
+            config_factory("sp", saml_conf)
+            config_factory("idp", saml_conf)
+
+        def app(module):
+            return lambda: WsgiApplication(module, entityid=IDP_ENTITY_ID,
+                                           start=False)
+
+        # Writes the snapshot.
+        app("startup_snapshot_conf")()
+        results = [
+            ("separate parses", best(separate, args.runs)),
+            ("shared parse", best(app("startup_conf"), args.runs)),
+            ("snapshot", best(app("startup_snapshot_conf"), args.runs)),
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d entities, %.1f MB metadata" % (args.entities, size / 1e6))
+    for name, duration in results:
+        print("%-16s %8.3f s" % (name, duration))
+
+
+if __name__ == "__main__":
+    main()
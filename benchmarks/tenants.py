@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup time and memory of several proxies with the same federation
+metadata: one WsgiApplication per tenant, as separate processes would load
+them, compared with one MultiTenantApplication sharing the metadata store.
+
+    python -m benchmarks.tenants [-t 4] [-e 2000]
+
+Each variant is loaded in a fresh process, the memory is the growth of its
+resident set size.
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.load import rss
+from benchmarks.startup import CONF_MODULE
+from benchmarks.startup import IDP_ENTITY_ID
+from benchmarks.startup import write_metadata
+from s2sproxy.server import WsgiApplication
+from s2sproxy.tenants import MultiTenantApplication
+
+
+def separate(count):
+    return [WsgiApplication("tenants_conf", IDP_ENTITY_ID, start=False)
+            for _ in range(count)]
+
+
+def shared(count):
+    return MultiTenantApplication(
+        [{"config": "tenants_conf", "entityid": IDP_ENTITY_ID,
+          "path": "t%d" % i} for i in range(count)], start=False)
+
+
+def measure(load, count, results):
+    before = rss()
+    start = time.perf_counter()
+    app = load(count)
+    results.put((time.perf_counter() - start, rss() - before))
+    del app
+
+
+def run(load, count):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+                                      args=(load, count, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", dest="tenants", type=int, default=4,
+                        help="Number of tenants.")
+    parser.add_argument("-e", dest="entities", type=int, default=2000,
+                        help="Number of SPs in the metadata.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        metadata = os.path.join(directory, "federation.xml")
+        write_metadata(metadata, args.entities)
+        with open(os.path.join(directory, "tenants_conf.py"), "w") as f:
+            f.write(CONF_MODULE % metadata)
+        sys.path.insert(0, directory)
+
+        results = [("one app per tenant", run(separate, args.tenants)),
+                   ("multi-tenant", run(shared, args.tenants))]
+    finally:
+        shutil.rmtree(directory)
+
+    print("%d tenants, %d entities" % (args.tenants, args.entities))
+    for name, (duration, memory) in results:
+        print("%-20s %8.3f s %8.1f MB" % (name, duration, memory / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import json
 
 from s2sproxy.util.attribute_module import AttributeModule, NoUserData
+from s2sproxy.util.pipeline import compile_pipeline
 
 
 class TestModule(AttributeModule):
@@ -11,6 +12,10 @@ class TestModule(AttributeModule):
             self.user_data = json.load(f)
 
         self.global_data = {'university': 'Small university', 'co': 'Sweden'}
+        self.pipeline = compile_pipeline([
+            ("static", self.global_data),
+            ("rename", {"email": "mail", "testA": "sn", "university": "o"}),
+        ])
 
     def get_attributes(self, idp_attributes):
         try:
@@ -26,18 +31,4 @@ class TestModule(AttributeModule):
             raise NoUserData("Unknown user id '{}'".format(user_id))
 
         idp_attributes.update(user_data)
-        idp_attributes.update(self.global_data)
-
-        return self._rename_attributes(idp_attributes)
-
-    def _rename_attributes(self, attributes):
-        translation = {"email": "mail", "testA": "sn", "university": "o"}
-
-        for attr_name, saml_name in translation.items():
-            try:
-                val = attributes.pop(attr_name)
-                attributes[saml_name] = val
-            except KeyError:
-                pass
-
-        return attributes
\ No newline at end of file
+        return self.pipeline(idp_attributes)
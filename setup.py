@@ -19,7 +19,14 @@ setup(
     classifiers=['Development Status :: 4 - Beta',
                  'License :: OSI Approved :: Apache Software License',
                  'Topic :: Software Development :: Libraries :: Python Modules',
-                 'Programming Language :: Python :: 3.4'],
-    install_requires=["pysaml2 >= 3.0.0"],
+                 'Programming Language :: Python :: 3',
+                 'Programming Language :: Python :: 3.8',
+                 'Programming Language :: Python :: 3.9',
+                 'Programming Language :: Python :: 3.10',
+                 'Programming Language :: Python :: 3.11',
+                 'Programming Language :: Python :: 3.12'],
+    python_requires='>=3.8',
+    install_requires=["pysaml2 >= 3.0.0", "cryptography", "defusedxml"],
+    extras_require={"inprocess": ["xmlsec"], "brotli": ["brotli"]},
     zip_safe=False,
 )
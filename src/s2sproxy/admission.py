@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control: limits on the number of requests handled at the same
+time per class of endpoint, so a burst of responses from the IdPs can't
+take all request threads from the cheap requests.
+
+A request over the limit of its class waits in a bounded queue. When the
+queue is full, or the request waited too long, it's answered right away
+with 503 and Retry-After instead of adding to the latency of the others.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Endpoint classes.
+ACS = "acs"
+SSO = "sso"
+DISCO = "disco"
+
+# Class of each handler, by (entity, method) of the route spec.
+ROUTE_CLASSES = {
+    ("SP", "authn_response"): ACS,
+    ("IDP", "handle_authn_request"): SSO,
+    ("SP", "disco_response"): DISCO,
+}
+
+# Default seconds a request waits for its turn.
+DEFAULT_TIMEOUT = 5.0
+# Default Retry-After, in seconds, of a shed request.
+DEFAULT_RETRY_AFTER = 1
+
+
+class Overloaded(Exception):
+    """
+    The request was shed, answered with status and Retry-After.
+    """
+    status = "503 Service Unavailable"
+
+
+class Budget(object):
+    """
+    At most limit requests at a time, and at most queue_size more waiting
+    for their turn in arrival order for at most timeout seconds.
+    """
+
+    def __init__(self, name, limit, queue_size=None, timeout=DEFAULT_TIMEOUT,
+                 timer=time.monotonic):
+        """
+        :param name: Name of the endpoint class, for messages
+        :param limit: Number of requests handled at the same time
+        :param queue_size: Number of requests waiting, four per allowed
+            request by default
+        :param timeout: Seconds a request waits before it's shed
+        """
+        self.name = name
+        self.limit = limit
+        self.queue_size = 4 * limit if queue_size is None else queue_size
+        self.timeout = timeout
+        self.timer = timer
+        self._cond = threading.Condition()
+
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timeouts = 0
+
+    def acquire(self):
+        """
+        :raise Overloaded: If the queue is full or the wait timed out
+        """
+        with self._cond:
+            # Requests already waiting go first.
+            if self.running < self.limit and not self.waiting:
+                self.running += 1
+                self.admitted += 1
+                return
+
+            if self.waiting >= self.queue_size:
+                self.shed += 1
+                raise Overloaded("%d %s requests waiting" %
+                                 (self.waiting, self.name))
+
+            self.waiting += 1
+            deadline = self.timer() + self.timeout
+            try:
+                while self.running >= self.limit:
+                    remaining = deadline - self.timer()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        self.shed += 1
+                        raise Overloaded("%s request waited more than %s s" %
+                                         (self.name, self.timeout))
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._cond:
+            self.running -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {"limit": self.limit, "running": self.running,
+                "waiting": self.waiting, "admitted": self.admitted,
+                "shed": self.shed, "timeouts": self.timeouts}
+
+
+class AdmissionControl(object):
+    """
+    The budgets of the endpoint classes. Requests of classes without a
+    budget, and requests for the other endpoints, aren't limited.
+    """
+
+    def __init__(self, limits, queue_sizes=None, timeout=DEFAULT_TIMEOUT,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        """
+        :param limits: dict of endpoint class -> number of requests handled
+            at the same time
+        :param queue_sizes: dict of endpoint class -> number of requests
+            waiting
+        :param timeout: Seconds a request waits before it's shed
+        :param retry_after: Seconds clients are asked to wait before trying
+            again
+        """
+        queue_sizes = queue_sizes or {}
+        self.retry_after = retry_after
+        self.budgets = dict(
+            (name, Budget(name, limit, queue_sizes.get(name), timeout))
+            for name, limit in limits.items())
+
+    def budget(self, spec):
+        """
+        :param spec: The spec of a routed request
+        :return: The Budget of its endpoint class, or None
+        """
+        if not isinstance(spec, tuple):
+            return None
+        return self.budgets.get(ROUTE_CLASSES.get(spec[:2]))
+
+    def acquire(self, spec):
+        """
+        Wait for the turn of a request.
+
+        :param spec: The spec of a routed request
+        :return: The Budget to release when the request is done, or None
+        :raise Overloaded: If the request is shed
+        """
+        budget = self.budget(spec)
+        if budget is not None:
+            budget.acquire()
+        return budget
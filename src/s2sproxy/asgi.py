@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI front end for the proxy, for many concurrent slow clients without a
+thread each. Run it with any ASGI server, e.g.:
+
+    uvicorn --factory 's2sproxy.asgi:create_app'
+
+with S2SPROXY_CONFIG (and optionally S2SPROXY_ENTITYID) in the environment,
+or S2SPROXY_TENANTS to serve several proxies.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from saml2.httputil import NotFound
+from saml2.httputil import Response
+
+from s2sproxy.encoding import ResponseEncoder
+from s2sproxy.server import WsgiApplication
+from s2sproxy.service import RequestTimeout
+from s2sproxy.service import RequestTooLarge
+from s2sproxy.tenants import MultiTenantApplication
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+
+def build_environ(scope, body):
+    """
+    WSGI environ for an ASGI HTTP request.
+
+    :param scope: ASGI connection scope
+    :param body: The request body, bytes, or None if not read yet: then
+        CONTENT_LENGTH is the one in the headers
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body or b"")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body or b""),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            if body is None:
+                environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_%s" % name
+            if key in environ:
+                # Cookie headers (split up by HTTP/2) are joined as in one
+                # Cookie header, others as a comma separated list.
+                separator = "; " if key == "HTTP_COOKIE" else ","
+                value = "%s%s%s" % (environ[key], separator, value)
+            environ[key] = value
+    if "HTTP_HOST" not in environ:
+        environ["HTTP_HOST"] = "%s:%s" % server
+    return environ
+
+
+class AsgiApplication(object):
+    """
+    ASGI application sharing the routing, state store and SP/IdP engines of
+    a WsgiApplication, or of the tenants of a MultiTenantApplication.
+
+    Bodies are read, requests routed and unknown paths answered on the event
+    loop. The SAML handling, which is CPU heavy, runs in an executor.
+    """
+
+    def __init__(self, app, executor=None):
+        """
+        :param app: The WsgiApplication or MultiTenantApplication
+        :param executor: concurrent.futures executor for the SAML handling,
+            a thread pool by default
+        """
+        self.app = app
+        self.executor = executor or ThreadPoolExecutor()
+        # For responses to requests no tenant is found for.
+        self.encoder = ResponseEncoder(None)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported scope type %s" % scope["type"])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive, max_size):
+        """
+        :return: The body, or None if the client disconnected
+        :raise RequestTooLarge: As soon as more than max_size bytes arrived
+        """
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > max_size:
+                raise RequestTooLarge("Request body larger than %d bytes" %
+                                      max_size)
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def http(self, scope, receive, send):
+        environ = build_environ(scope, None)
+        app = self.app.tenant(environ)
+        encoder = self.encoder if app is None else app.encoder
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+
+        def finish(result):
+            return encoder.encode(environ, response["status"],
+                                  response["headers"], result)
+
+        # Routed before the body is read, so too large bodies are refused
+        # without reading them.
+        if app is None:
+            spec, resp = None, NotFound("Couldn't find the side you asked for!")
+        else:
+            with app.metrics.phase("routing"):
+                spec, resp = app.route(environ)
+        if resp is None:
+            try:
+                body = await asyncio.wait_for(
+                    self.read_body(receive,
+                                   environ["s2sproxy.max_body_size"]),
+                    environ["s2sproxy.body_timeout"])
+            except RequestTooLarge as err:
+                resp = Response("%s" % err, status=err.status)
+            except asyncio.TimeoutError:
+                resp = Response("Request body not received in time",
+                                status=RequestTimeout.status)
+            else:
+                if body is None:
+                    return
+                environ["wsgi.input"] = io.BytesIO(body)
+                environ["CONTENT_LENGTH"] = str(len(body))
+
+        if resp is not None:
+            headers, body = finish(resp(environ, start_response))
+        else:
+            loop = asyncio.get_running_loop()
+            headers, body = await loop.run_in_executor(
+                self.executor,
+                lambda: finish(app.handle(spec, environ, start_response)))
+
+        await send({
+            "type": "http.response.start",
+            "status": int(response["status"].split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin-1"),
+                         str(value).encode("latin-1"))
+                        for name, value in headers],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def create_app():
+    """
+    Factory for ASGI servers, configured through the environment variables
+    S2SPROXY_CONFIG and S2SPROXY_ENTITYID, or S2SPROXY_TENANTS for a module
+    with the tenants of a MultiTenantApplication.
+    """
+    if "S2SPROXY_TENANTS" in os.environ:
+        return AsgiApplication(MultiTenantApplication.from_config(
+            os.environ["S2SPROXY_TENANTS"]))
+    return AsgiApplication(WsgiApplication(
+        os.environ["S2SPROXY_CONFIG"], os.environ.get("S2SPROXY_ENTITYID")))
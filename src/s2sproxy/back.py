@@ -15,25 +15,71 @@ from saml2.httputil import Unauthorized
 from saml2.response import VerificationError
 from saml2.s_utils import UnknownPrincipal
 from saml2.s_utils import UnsupportedBinding
+from saml2.samlp import AuthnRequest
 
+from s2sproxy.plan import ResponsePlans
+from s2sproxy.remember import is_true
+from s2sproxy.replay import ReplayedResponse
+from s2sproxy.replay import response_keys
+from s2sproxy.replay import verified_keys
 from s2sproxy.service import BINDING_MAP
+from s2sproxy.state import InvalidState
 import s2sproxy.service as service
 
 # Module level logger.
 logger = logging.getLogger(__name__)
 
 # Authentication request constructor.
+def essentials(authn_req):
+    """
+    Copy of an authentication request with only what's needed to construct
+    the response to it.
+    """
+    return AuthnRequest(
+        id=authn_req.id, issuer=authn_req.issuer,
+        name_id_policy=authn_req.name_id_policy,
+        protocol_binding=authn_req.protocol_binding,
+        assertion_consumer_service_url=authn_req.assertion_consumer_service_url,
+        assertion_consumer_service_index=
+        authn_req.assertion_consumer_service_index,
+        attribute_consuming_service_index=
+        authn_req.attribute_consuming_service_index)
+
+
 class SamlSP(service.Service):
-    def __init__(self, environ, start_response, config, cache=None,
-                 outgoing=None, discosrv=None, bindings=None):
-        service.Service.__init__(self, environ, start_response)
-        self.sp = Base(config, state_cache=cache)
+    def __init__(self, environ, start_response, sp, cache=None,
+                 outgoing=None, discosrv=None, bindings=None, sealer=None,
+                 metrics=None, plans=None, remember=None, replay=None):
+        """
+        Constructor for the class.
+        :param environ: WSGI environ
+        :param start_response: WSGI start response function
+        :param sp: Long-lived SP engine (saml2.client_base.Base), shared
+            between requests
+        :param cache: Cache with active sessions
+        :param sealer: s2sproxy.state.RelayStateSealer for stateless mode,
+            where the login state travels in RelayState instead of the cache
+        :param metrics: s2sproxy.metrics.Metrics to record timings in
+        :param plans: s2sproxy.plan.ResponsePlans of the SP engine, shared
+            between requests
+        :param remember: s2sproxy.remember.RememberedIdP to skip the
+            discovery service for returning users
+        :param replay: s2sproxy.replay.ReplayCache to refuse responses that
+            were used before
+        """
+        service.Service.__init__(self, environ, start_response, metrics)
+        self.sp = sp
+        self.plans = plans or ResponsePlans(sp)
         self.environ = environ
         self.start_response = start_response
         self.cache = cache
+        self.sealer = sealer
+        self.sealed_state = None
         self.idp_disco_query_param = "entityID"
         self.outgoing = outgoing
         self.discosrv = discosrv
+        self.remember = remember
+        self.replay = replay
         if bindings:
             self.bindings = bindings
         else:
@@ -56,14 +102,46 @@ class SamlSP(service.Service):
             return resp(self.environ, self.start_response)
         else:
             # TODO should I check the state variable ?
-            return self.authn_request(entity_id, info["state"])
+            return self.authn_request(entity_id, info["state"],
+                                      remember=True)
+
+    def remembered_idp(self, req_args):
+        """
+        The IdP the user picked last time, if it can be used for this login.
+        Not used if the SP forces a new authentication, so the user can pick
+        another IdP, or if the IdP is no longer in the metadata.
+
+        :param req_args: Arguments from the SP's authentication request
+        :return: The IdP's entity ID or None
+        """
+        if self.remember is None:
+            return None
+        entity_id = None
+        if not is_true(req_args.get("force_authn")):
+            entity_id = self.remember.get(self.environ)
+        if entity_id is not None:
+            try:
+                self.sp.metadata[entity_id]["idpsso_descriptor"]
+            except KeyError:
+                logger.info("Remembered IdP %s not in the metadata" %
+                            entity_id)
+                entity_id = None
+        self.remember.count(entity_id is not None)
+        return entity_id
 
     def store_state(self, authn_req, relay_state, req_args):
+        if self.sealer:
+            with self.metrics.phase("state_put"):
+                return self.sealer.seal({"authn_req": essentials(authn_req),
+                                         "relay_state": relay_state,
+                                         "req_args": req_args})
+
         # Which page was accessed to get here.
         came_from = geturl(self.environ)
         key = str(hash(came_from + self.environ["REMOTE_ADDR"] + str(time.time())))
         logger.debug("[sp.challenge] RelayState >> '%s'" % came_from)
-        self.cache[key] = (authn_req, relay_state, req_args)
+        with self.metrics.phase("state_put"):
+            self.cache[key] = (authn_req, relay_state, req_args)
         return key
 
     def disco_query(self, authn_req, relay_state, req_args):
@@ -86,21 +164,60 @@ class SamlSP(service.Service):
         ret = dr[0][0]
         # Append it to the disco server URL.
         ret += "?state=%s" % state_key
+        disco_args = {"return": ret}
+        if is_true(req_args.get("is_passive")):
+            disco_args["isPassive"] = True
         loc = _cli.create_discovery_service_request(self.discosrv, eid,
-                                                    **{"return": ret})
+                                                    **disco_args)
 
         resp = SeeOther(loc)
         return resp(self.environ, self.start_response)
 
-    def authn_request(self, entity_id, state_key):
+    def consume_state(self, in_response_to):
+        """
+        Get, and forget, the state of the login a response belongs to.
+
+        :param in_response_to: ID of the request sent to the IdP
+        :return: (authn_req, relay_state, req_args) of the original request
+        """
+        if self.sealer:
+            state = self.sealed_state
+            if state is None or state["req_id"] != in_response_to:
+                raise KeyError(in_response_to)
+            return state["authn_req"], state["relay_state"], state["req_args"]
+
+        with self.metrics.phase("state_get"):
+            state_key = self.cache.pop(in_response_to)
+            return self.cache.pop(state_key)
+
+    def authn_request(self, entity_id, state_key, remember=False):
+        """
+        Send the user to the IdP with an authentication request.
+
+        :param entity_id: The IdP
+        :param state_key: Key of, or with a sealer the sealed, login state
+        :param remember: Remember the IdP for the next login, if enabled
+        """
         _cli = self.sp
-        req_args = self.cache[state_key][2]
+        if self.sealer:
+            try:
+                with self.metrics.phase("state_get"):
+                    state = self.sealer.unseal(state_key)
+            except InvalidState as err:
+                self.metrics.error(err)
+                resp = Unauthorized("%s" % err)
+                return resp(self.environ, self.start_response)
+            req_args = state["req_args"]
+        else:
+            with self.metrics.phase("state_get"):
+                req_args = self.cache[state_key][2]
 
         try:
             # Picks a binding to use for sending the Request to the IDP.
-            _binding, destination = _cli.pick_binding(
-                "single_sign_on_service", self.bindings, "idpsso",
-                entity_id=entity_id)
+            with self.metrics.phase("pick_binding"):
+                _binding, destination = self.plans.pick_binding(
+                    "single_sign_on_service", self.bindings, "idpsso",
+                    entity_id=entity_id)
             logger.debug("binding: %s, destination: %s" % (_binding,
                                                            destination))
             # Binding here is the response binding that is which binding the
@@ -109,23 +226,36 @@ class SamlSP(service.Service):
                 "assertion_consumer_service"]
             # Just pick one.
             endp, return_binding = acs[0]
-            req_id, req = _cli.create_authn_request(destination,
-                                                    binding=return_binding,
-                                                    **req_args)
+            with self.metrics.phase("create_authn_request"):
+                req_id, req = _cli.create_authn_request(
+                    destination, binding=return_binding, **req_args)
 
-            ht_args = _cli.apply_binding(_binding, "%s" % req, destination,
-                                         relay_state=state_key)
+            if self.sealer:
+                state["req_id"] = req_id
+                with self.metrics.phase("state_put"):
+                    relay_state = self.sealer.seal(state)
+            else:
+                relay_state = state_key
+            with self.metrics.phase("apply_binding"):
+                ht_args = _cli.apply_binding(_binding, "%s" % req,
+                                             destination,
+                                             relay_state=relay_state)
             _sid = req_id
             logger.debug("ht_args: %s" % ht_args)
         except Exception as exc:
+            self.metrics.error(exc)
             logger.exception(exc)
             resp = ServiceError(
                 "Failed to construct the AuthnRequest: %s" % exc)
             return resp(self.environ, self.start_response)
 
         # Remember the request.
-        self.cache[_sid] = state_key
+        if not self.sealer:
+            with self.metrics.phase("state_put"):
+                self.cache[_sid] = state_key
         resp = self.response(_binding, ht_args, do_not_start_response=True)
+        if remember and self.remember is not None:
+            resp.add_header(self.remember.cookie(entity_id))
         return resp(self.environ, self.start_response)
 
     def authn_response(self, binding):
@@ -142,47 +272,87 @@ class SamlSP(service.Service):
             resp = Unauthorized('Unknown user')
             return resp(self.environ, self.start_response)
 
+        if self.sealer:
+            try:
+                with self.metrics.phase("state_get"):
+                    self.sealed_state = self.sealer.unseal(
+                        _authn_response.get("RelayState", ""))
+            except InvalidState as err:
+                self.metrics.error(err)
+                logger.info("%s" % err)
+                resp = Unauthorized("%s" % err)
+                return resp(self.environ, self.start_response)
+            outstanding = {self.sealed_state["req_id"]:
+                           _authn_response["RelayState"]}
+        else:
+            outstanding = self.cache
+
         binding = service.INV_BINDING_MAP[binding]
+        # Refuse a response seen before, without verifying its signature.
+        if self.replay is not None:
+            with self.metrics.phase("replay_check"):
+                keys = response_keys(_authn_response["SAMLResponse"], binding)
+                replayed = self.replay.seen(keys)
+            if replayed:
+                return self.replayed(keys)
+
         try:
-            _response = self.sp.parse_authn_request_response(
-                _authn_response["SAMLResponse"], binding,
-                self.cache)
+            # Signature verification included.
+            with self.metrics.phase("parse_authn_request_response"):
+                _response = self.sp.parse_authn_request_response(
+                    _authn_response["SAMLResponse"], binding, outstanding)
         except UnknownPrincipal as excp:
+            self.metrics.error(excp)
             logger.error("UnknownPrincipal: %s" % (excp,))
             resp = ServiceError("UnknownPrincipal: %s" % (excp,))
             return resp(self.environ, self.start_response)
         except UnsupportedBinding as excp:
+            self.metrics.error(excp)
             logger.error("UnsupportedBinding: %s" % (excp,))
             resp = ServiceError("UnsupportedBinding: %s" % (excp,))
             return resp(self.environ, self.start_response)
         except VerificationError as err:
+            self.metrics.error(err)
             resp = ServiceError("Verification error: %s" % (err,))
             return resp(self.environ, self.start_response)
         except Exception as err:
+            self.metrics.error(err)
             resp = ServiceError("Other error: %s" % (err,))
             return resp(self.environ, self.start_response)
 
+        # Checked again while adding it, another worker may have been sent
+        # the same response meanwhile.
+        if self.replay is not None:
+            keys = verified_keys(_response)
+            if self.replay.add(keys):
+                return self.replayed(keys)
+
         return self.outgoing(_response, self)
 
+    def replayed(self, keys):
+        logger.warning("Replayed response: %s" % ", ".join(keys))
+        self.metrics.error(ReplayedResponse(keys))
+        resp = Unauthorized("The response has already been used")
+        return resp(self.environ, self.start_response)
+
     def register_endpoints(self):
         """
         Given the configuration, return a set of URL to function mappings.
+        See s2sproxy.router.Router for the path syntax.
         """
 
         url_map = []
         sp_endpoints = self.sp.config.getattr("endpoints", "sp")
         for endp, binding in sp_endpoints["assertion_consumer_service"]:
             p = urlparse(endp)
-            url_map.append(("^%s?(.*)$" % p.path[1:], ("SP", "authn_response",
-                                                       BINDING_MAP[binding])))
-            url_map.append(("^%s$" % p.path[1:], ("SP", "authn_response",
-                                                  BINDING_MAP[binding])))
+            url_map.append((p.path[1:], ("SP", "authn_response",
+                                         BINDING_MAP[binding])))
 
         if self.discosrv:
             for endp, binding in sp_endpoints["discovery_response"]:
                 p = urlparse(endp)
-                url_map.append(("^%s$" % p.path[1:], ("SP", "disco_response",
-                                                            BINDING_MAP[binding])))
+                url_map.append((p.path[1:], ("SP", "disco_response",
+                                             BINDING_MAP[binding])))
 
         return url_map
 
@@ -191,6 +361,6 @@ if __name__ == "__main__":
     from saml2.config import config_factory
 
     _config = config_factory("sp", sys.argv[1])
-    sp = SamlSP(None, None, _config)
+    sp = SamlSP(None, None, Base(_config))
     maps = sp.register_endpoints()
     print(maps)
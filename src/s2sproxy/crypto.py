@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+In-process signing, signature verification, encryption and decryption with
+libxmlsec1, through the python-xmlsec binding, instead of running the
+xmlsec1 binary for every operation. Since it is the same library the output
+is interchangeable with the one of the xmlsec1 binary.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from lxml import etree
+from saml2 import SamlBase
+from saml2.sigver import ASSERT_XPATH
+from saml2.sigver import CryptoBackendXmlSec1
+from saml2.sigver import DecryptError
+from saml2.sigver import EncryptError
+from saml2.sigver import SignatureError
+from saml2.sigver import XmlsecError
+from saml2.sigver import pre_encrypt_assertion
+
+try:
+    import xmlsec
+except ImportError:
+    xmlsec = None
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+DSIG_NS = "http://www.w3.org/2000/09/xmldsig#"
+SIGNATURE_TAG = "{%s}Signature" % DSIG_NS
+REFERENCE_TAG = "{%s}Reference" % DSIG_NS
+XENC_NS = "http://www.w3.org/2001/04/xmlenc#"
+ENCRYPTED_DATA_TAG = "{%s}EncryptedData" % XENC_NS
+ENCRYPTED_KEY_TAG = "{%s}EncryptedKey" % XENC_NS
+
+# Name of the crypto backend setting in the proxy configuration.
+XMLSEC1 = "xmlsec1"
+IN_PROCESS = "inprocess"
+# Default number of parsed keys, certificates and keys managers kept.
+DEFAULT_MAX_KEYS = 256
+
+
+def _parse(text):
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    parser = etree.XMLParser(resolve_entities=False, no_network=True,
+                             remove_blank_text=False)
+    return etree.fromstring(text, parser)
+
+
+def _split_node_name(node_name):
+    # 'urn:oasis:names:tc:SAML:2.0:assertion:Assertion' -> ElementTree tag
+    namespace, _, name = node_name.rpartition(":")
+    return "{%s}%s" % (namespace, name)
+
+
+class KeyCache(object):
+    """
+    Parsed keys and certificates, so every file is only parsed once per
+    process. Files are recognized by path and modification time, and
+    certificates also by content for the temporary files pysaml2 writes
+    certificates from metadata to. The least recently used entries are
+    dropped when there are more than max_size, as every temporary file
+    adds one.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_KEYS):
+        """
+        :param max_size: How many entries to keep
+        """
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def _lookup(self, cache_key):
+        with self._lock:
+            value = self._keys[cache_key]
+            self._keys.move_to_end(cache_key)
+            return value
+
+    def _store(self, cache_key, value):
+        with self._lock:
+            self._keys[cache_key] = value
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+
+    def _get(self, cache_key, load):
+        try:
+            return self._lookup(cache_key)
+        except KeyError:
+            pass
+        key = load()
+        self._store(cache_key, key)
+        with self._lock:
+            self.loads += 1
+        return key
+
+    @staticmethod
+    def _file_key(path):
+        st = os.stat(path)
+        return path, st.st_mtime_ns, st.st_size
+
+    def private_key(self, path):
+        return self._get(
+            ("key",) + self._file_key(path),
+            lambda: xmlsec.Key.from_file(path, xmlsec.KeyFormat.PEM))
+
+    def _certificate(self, path, cert_type):
+        # The digest of the file, remembered by path and modification time
+        # so it is only read once, and the certificate parsed from it.
+        file_key = ("digest", cert_type) + self._file_key(path)
+        try:
+            digest = self._lookup(file_key)
+        except KeyError:
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).digest()
+            self._store(file_key, digest)
+        else:
+            data = None
+
+        def load():
+            if cert_type == "der":
+                key_format = xmlsec.KeyFormat.CERT_DER
+            else:
+                key_format = xmlsec.KeyFormat.CERT_PEM
+            if data is None:
+                return xmlsec.Key.from_file(path, key_format)
+            return xmlsec.Key.from_memory(data, key_format)
+        return digest, self._get(("cert", cert_type, digest), load)
+
+    def certificate(self, path, cert_type="pem"):
+        return self._certificate(path, cert_type)[1]
+
+    def _manager(self, cache_key, key):
+        # Setting up a keys manager costs far more than parsing the key.
+        def load():
+            manager = xmlsec.KeysManager()
+            manager.add_key(key)
+            return manager
+        return self._get(("manager",) + cache_key, load)
+
+    def private_key_manager(self, path):
+        """
+        :return: A keys manager with the private key of a file, for
+            decryption
+        """
+        return self._manager(self._file_key(path), self.private_key(path))
+
+    def certificate_manager(self, path, cert_type="pem"):
+        """
+        :return: A keys manager with the certificate of a file, for
+            encryption
+        """
+        digest, certificate = self._certificate(path, cert_type)
+        return self._manager((cert_type, digest), certificate)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def stats(self):
+        return {"entries": len(self._keys), "loads": self.loads,
+                "evictions": self.evictions}
+
+
+class InProcessCryptoBackend(CryptoBackendXmlSec1):
+    """
+    pysaml2 crypto backend that signs, verifies, encrypts assertions and
+    decrypts in-process. Encryption of other elements still uses the
+    xmlsec1 binary.
+    """
+
+    def __init__(self, xmlsec_binary=XMLSEC1, key_cache=None, **kwargs):
+        """
+        :param xmlsec_binary: Path to xmlsec1, only used by encrypt
+        :param key_cache: KeyCache to use, a new one by default
+        """
+        if xmlsec is None or not hasattr(xmlsec, "SignatureContext"):
+            raise ImportError("The in-process crypto backend needs the xmlsec "
+                              "package (python-xmlsec)")
+        CryptoBackendXmlSec1.__init__(self, xmlsec_binary, **kwargs)
+        self.key_cache = key_cache or KeyCache()
+
+    @staticmethod
+    def _signature(root, node_name, node_id):
+        """
+        Find the Signature element to work on, the same one xmlsec1 would
+        pick: the first one in document order below the node with node_id,
+        or in the whole document.
+        """
+        tag = _split_node_name(node_name)
+        start = root
+        for node in root.iter(tag):
+            xmlsec.tree.add_ids(node, ["ID"])
+            if node_id and node.get("ID") == node_id:
+                start = node
+        if root.tag == tag:
+            xmlsec.tree.add_ids(root, ["ID"])
+
+        for signature in start.iter(SIGNATURE_TAG):
+            return signature
+        raise SignatureError("No Signature element found")
+
+    @staticmethod
+    def _serialize(root):
+        return etree.tostring(root.getroottree(), xml_declaration=True,
+                              encoding="UTF-8").decode("utf-8")
+
+    def sign_statement(self, statement, node_name, key_file, node_id):
+        """
+        Sign an XML statement.
+
+        :param statement: The statement to be signed
+        :param node_name: string like 'urn:oasis:names:...:Assertion'
+        :param key_file: The file where the key can be found
+        :param node_id: ID of the node to sign
+        :return: The signed statement
+        """
+        if not isinstance(statement, (str, bytes)):
+            statement = "%s" % statement
+
+        try:
+            root = _parse(statement)
+            ctx = xmlsec.SignatureContext()
+            ctx.key = self.key_cache.private_key(key_file)
+            ctx.sign(self._signature(root, node_name, node_id))
+        except (xmlsec.Error, etree.XMLSyntaxError, OSError) as err:
+            raise SignatureError("Failed to sign: %s" % err)
+        return self._serialize(root)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name,
+                           node_id):
+        """
+        Validate the signature on an XML document.
+
+        :param signedtext: The XML document as a string
+        :param cert_file: The public key that was used to sign the document
+        :param cert_type: The file type of the certificate
+        :param node_name: The name of the class that is signed
+        :param node_id: The identifier of the node
+        :return: True if the signature was correct, otherwise XmlsecError
+            is raised, like the xmlsec1 backend does
+        """
+        try:
+            root = _parse(signedtext)
+            signature = self._signature(root, node_name, node_id)
+        except (etree.XMLSyntaxError, SignatureError) as err:
+            raise XmlsecError("%s" % err)
+
+        # Same restriction as '--enabled-reference-uris empty,same-doc'.
+        for reference in signature.iter(REFERENCE_TAG):
+            uri = reference.get("URI")
+            if uri and not uri.startswith("#"):
+                raise XmlsecError("Reference to other document: %s" % uri)
+
+        try:
+            ctx = xmlsec.SignatureContext()
+            ctx.key = self.key_cache.certificate(cert_file, cert_type)
+            ctx.verify(signature)
+        except (xmlsec.Error, OSError) as err:
+            raise XmlsecError("Signature verification failed: %s" % err)
+        return True
+
+    # Session key of each key_type pysaml2 asks for.
+    SESSION_KEYS = {"des-192": ("KeyDataDes", 192),
+                    "aes-128": ("KeyDataAes", 128),
+                    "aes-192": ("KeyDataAes", 192),
+                    "aes-256": ("KeyDataAes", 256)}
+
+    def encrypt_assertion(self, statement, enc_key, template,
+                          key_type="des-192", node_xpath=None, node_id=None):
+        """
+        Encrypt an assertion in a response.
+
+        :param statement: The response with the assertion, a string with it
+            in an EncryptedAssertion or a samlp.Response
+        :param enc_key: File with the receiver's certificate
+        :param template: The EncryptedData template
+        :param key_type: The type of session key
+        :param node_xpath: Path to the assertion
+        :return: The response with the assertion encrypted
+        """
+        try:
+            data, size = self.SESSION_KEYS[key_type]
+        except KeyError:
+            raise EncryptError("Unsupported session key type: %s" % key_type)
+
+        if isinstance(statement, SamlBase):
+            statement = pre_encrypt_assertion(statement)
+
+        try:
+            root = _parse("%s" % statement)
+            nodes = root.getroottree().xpath(node_xpath or ASSERT_XPATH)
+            if not nodes:
+                raise EncryptError("Nothing to encrypt at %s" % node_xpath)
+            ctx = xmlsec.EncryptionContext(
+                self.key_cache.certificate_manager(enc_key))
+            ctx.key = xmlsec.Key.generate(getattr(xmlsec.constants, data),
+                                          size,
+                                          xmlsec.constants.KeyDataTypeSession)
+            ctx.encrypt_xml(_parse("%s" % template), nodes[0])
+        except (xmlsec.Error, etree.XMLSyntaxError, OSError) as err:
+            raise EncryptError("Failed to encrypt: %s" % err)
+        return self._serialize(root)
+
+    def decrypt(self, enctext, key_file):
+        """
+        Decrypt the first EncryptedData of a document.
+
+        :param enctext: XML document containing an encrypted part
+        :param key_file: The private key to decrypt with
+        :return: The decrypted document
+        """
+        try:
+            root = _parse(enctext)
+            # EncryptedKeys referred to by Id, like '--id-attr:Id'.
+            for node in root.iter(ENCRYPTED_KEY_TAG):
+                xmlsec.tree.add_ids(node, ["Id"])
+            for encrypted in root.iter(ENCRYPTED_DATA_TAG):
+                break
+            else:
+                raise DecryptError("No EncryptedData element found")
+            ctx = xmlsec.EncryptionContext(
+                self.key_cache.private_key_manager(key_file))
+            decrypted = ctx.decrypt(encrypted)
+        except (xmlsec.Error, etree.XMLSyntaxError, OSError) as err:
+            raise DecryptError("Failed to decrypt: %s" % err)
+        if encrypted is root:
+            # Only the decrypted content is left, e.g. of an attribute.
+            if isinstance(decrypted, bytes):
+                return decrypted.decode("utf-8")
+            root = decrypted
+        return etree.tostring(root, encoding="unicode")
+
+
+def use_crypto_backend(engine, backend):
+    """
+    Make a pysaml2 entity sign and verify with another crypto backend.
+    """
+    engine.sec.crypto = backend
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Response bodies handed to the server as a single bytes object with a
+Content-Length, optionally compressed for clients that accept it.
+
+The HTTP-POST binding pages carry a whole base64 encoded, signed response in
+an auto-submitting form, by far the largest bodies the proxy sends.
+"""
+
+import gzip
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+GZIP = "gzip"
+BROTLI = "br"
+
+
+def available_encodings():
+    """
+    :return: The supported content codings, preferred first
+    """
+    if brotli is not None:
+        return [BROTLI, GZIP]
+    return [GZIP]
+
+
+def negotiate(accept_encoding, encodings):
+    """
+    Pick a content coding from an Accept-Encoding header.
+
+    :param accept_encoding: The header value
+    :param encodings: Supported codings, preferred first
+    :return: The coding to use or None for the identity coding
+    """
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        params = item.strip().split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+
+    best = None
+    best_q = 0.0
+    for coding in encodings:
+        q = qvalues.get(coding, qvalues.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(body, encoding, level=6):
+    if encoding == GZIP:
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=min(level, 11))
+    raise ValueError("Unknown content coding '%s'" % encoding)
+
+
+def body_bytes(result):
+    """
+    Collect a WSGI result into one bytes object, without copying a result
+    that is a single chunk already.
+    """
+    try:
+        if isinstance(result, (list, tuple)) and len(result) == 1 and \
+                isinstance(result[0], bytes):
+            return result[0]
+        return b"".join(chunk if isinstance(chunk, bytes)
+                        else chunk.encode("utf-8") for chunk in result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+
+def _header(headers, name):
+    name = name.lower()
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+
+class ResponseEncoder(object):
+    """
+    WSGI middleware setting Content-Length on every response and, if
+    enabled, compressing large HTML responses.
+
+    Compressing pages that contain both secrets and values an attacker can
+    influence (like RelayState) may allow BREACH style attacks, so it's off
+    unless asked for.
+    """
+
+    def __init__(self, app, compress=False, min_size=1024, level=6,
+                 content_types=("text/html",)):
+        """
+        :param app: WSGI application
+        :param compress: Compress responses for clients that accept it
+        :param min_size: Smallest body, in bytes, worth compressing
+        :param level: gzip level and brotli quality
+        :param content_types: Media types that are compressed
+        """
+        self.app = app
+        self.compress = compress
+        self.min_size = min_size
+        self.level = level
+        self.content_types = tuple(content_types)
+        self.encodings = available_encodings()
+
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def encoding(self, environ, status, headers, body):
+        """
+        :return: The content coding to use for a response, or None
+        """
+        if not self.compress or len(body) < self.min_size:
+            return None
+        if not status.startswith("200") or \
+                _header(headers, "Content-Encoding") is not None:
+            return None
+        content_type = (_header(headers, "Content-Type") or "").lower()
+        if not content_type.startswith(self.content_types):
+            return None
+        return negotiate(environ.get("HTTP_ACCEPT_ENCODING", ""),
+                         self.encodings)
+
+    def encode(self, environ, status, headers, result):
+        """
+        Finish a response.
+
+        :param result: The WSGI result of the application
+        :return: (headers, body) to send
+        """
+        body = body_bytes(result)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != "content-length"]
+
+        encoding = self.encoding(environ, status, headers, body)
+        if encoding is not None:
+            compressed = compress(body, encoding, self.level)
+            self.compressed += 1
+            self.bytes_in += len(body)
+            self.bytes_out += len(compressed)
+            body = compressed
+            headers.append(("Content-Encoding", encoding))
+        if self.compress:
+            headers.append(("Vary", "Accept-Encoding"))
+        headers.append(("Content-Length", str(len(body))))
+        return headers, body
+
+    def __call__(self, environ, start_response):
+        response = {}
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            response["exc_info"] = exc_info
+            return written.append
+
+        result = self.app(environ, capture)
+        if written:
+            result = written + [body_bytes(result)]
+        headers, body = self.encode(environ, response["status"],
+                                    response["headers"], result)
+        start_response(response["status"], headers, response["exc_info"])
+        return [body]
+
+    def stats(self):
+        return {"compressed": self.compressed, "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out}
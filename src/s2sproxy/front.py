@@ -9,25 +9,35 @@ from saml2.httputil import Redirect
 from saml2.httputil import Unauthorized
 from saml2.s_utils import UnknownPrincipal
 from saml2.s_utils import UnsupportedBinding
-from saml2.server import Server
 
+from s2sproxy.plan import ResponsePlans
 import s2sproxy.service as service
 
 # Module level logger.
 logger = logging.getLogger(__name__)
 
 class SamlIDP(service.Service):
-    def __init__(self, environ, start_response, conf, cache, incoming):
+    def __init__(self, environ, start_response, idp, cache, incoming,
+                 metrics=None, plans=None, releases=None):
         """
         Constructor for the class.
         :param environ: WSGI environ
         :param start_response: WSGI start response function
-        :param conf: The SAML configuration
+        :param idp: Long-lived IdP engine (saml2.server.Server), shared
+            between requests
         :param cache: Cache with active sessions
+        :param metrics: s2sproxy.metrics.Metrics to record timings in
+        :param plans: s2sproxy.plan.ResponsePlans of the IdP engine, shared
+            between requests
+        :param releases: s2sproxy.release.ReleasePolicies of the IdP engine,
+            used instead of its configured policy
         """
-        service.Service.__init__(self, environ, start_response)
+        service.Service.__init__(self, environ, start_response, metrics)
         self.response_bindings = None
-        self.idp = Server(config=conf, cache=cache)
+        self.idp = idp
+        self.plans = plans or ResponsePlans(idp)
+        self.releases = releases
+        self.cache = cache
         self.incoming = incoming
 
     def verify_request(self, query, binding):
@@ -43,7 +53,8 @@ class SamlIDP(service.Service):
             resp = Unauthorized('Unknown user')
             return {"response": resp(self.environ, self.start_response)}
 
-        req_info = self.idp.parse_authn_request(query, binding)
+        with self.metrics.phase("parse_authn_request"):
+            req_info = self.idp.parse_authn_request(query, binding)
 
         logger.info("parsed OK")
         _authn_req = req_info.message
@@ -51,10 +62,11 @@ class SamlIDP(service.Service):
 
         # Check that I know where to send the reply to.
         try:
-            binding_out, destination = self.idp.pick_binding(
-                "assertion_consumer_service",
-                bindings=self.response_bindings,
-                entity_id=_authn_req.issuer.text, request=_authn_req)
+            with self.metrics.phase("pick_binding"):
+                binding_out, destination = self.plans.pick_binding(
+                    "assertion_consumer_service",
+                    bindings=self.response_bindings,
+                    entity_id=_authn_req.issuer.text, request=_authn_req)
         except Exception as err:
             logger.error("Couldn't find receiver endpoint: %s" % err)
             raise
@@ -64,7 +76,7 @@ class SamlIDP(service.Service):
 
         resp_args = {}
         try:
-            resp_args = self.idp.response_args(_authn_req)
+            resp_args = self.plans.response_args(_authn_req)
             _resp = None
         except UnknownPrincipal as excp:
             _resp = self.idp.create_error_response(_authn_req.id,
@@ -103,20 +115,23 @@ class SamlIDP(service.Service):
         try:
             _dict = self.verify_request(_request["SAMLRequest"], _binding_in)
         except UnknownPrincipal as excp:
+            self.metrics.error(excp)
             logger.error("UnknownPrincipal: %s" % (excp,))
             resp = ServiceError("UnknownPrincipal: %s" % (excp,))
             return resp(self.environ, self.start_response)
         except UnsupportedBinding as excp:
+            self.metrics.error(excp)
             logger.error("UnsupportedBinding: %s" % (excp,))
             resp = ServiceError("UnsupportedBinding: %s" % (excp,))
             return resp(self.environ, self.start_response)
 
         _binding = _dict["resp_args"]["binding"]
         if _dict["response"]:  # An error response.
-            http_args = self.idp.apply_binding(
-                _binding, "%s" % _dict["response"],
-                _dict["resp_args"]["destination"],
-                _request["RelayState"], response=True)
+            with self.metrics.phase("apply_binding"):
+                http_args = self.idp.apply_binding(
+                    _binding, "%s" % _dict["response"],
+                    _dict["resp_args"]["destination"],
+                    _request["RelayState"], response=True)
 
             logger.debug("HTTPargs: %s" % http_args)
             return self.response(_binding, http_args)
@@ -137,14 +152,17 @@ class SamlIDP(service.Service):
         :return:
         """
 
-        _resp = self.idp.create_authn_response(identity, name_id=name_id,
-                                               authn=authn,
-                                               sign_response=sign_response,
-                                               **resp_args)
+        # Signing included.
+        with self.metrics.phase("create_authn_response"):
+            _resp = self.idp.create_authn_response(
+                identity, name_id=name_id, authn=authn,
+                sign_response=sign_response, release_policy=self.releases,
+                **resp_args)
 
-        http_args = self.idp.apply_binding(
-            resp_args["binding"], "%s" % _resp, resp_args["destination"],
-            relay_state, response=True)
+        with self.metrics.phase("apply_binding"):
+            http_args = self.idp.apply_binding(
+                resp_args["binding"], "%s" % _resp, resp_args["destination"],
+                relay_state, response=True)
 
         logger.debug("HTTPargs: %s" % http_args)
 
@@ -164,16 +182,17 @@ class SamlIDP(service.Service):
     def register_endpoints(self):
         """
         Given the configuration, return a set of URL to function mappings.
+        See s2sproxy.router.Router for the path syntax.
         """
 
         url_map = []
         idp_endpoints = self.idp.config.getattr("endpoints", "idp")
         for endp, binding in idp_endpoints["single_sign_on_service"]:
             p = urlparse(endp)
-            url_map.append(("^%s/(.*)$" % p.path[1:],
+            url_map.append(("%s/*" % p.path[1:],
                             ("IDP", "handle_authn_request",
                              service.BINDING_MAP[binding])))
-            url_map.append(("^%s$" % p.path[1:],
+            url_map.append((p.path[1:],
                             ("IDP", "handle_authn_request",
                              service.BINDING_MAP[binding])))
 
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import importlib.metadata
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+import requests
+from saml2.mdstore import MetaDataFile
+from saml2.time_util import valid
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Source types a refresh can tell are unchanged without reloading them:
+# local files by their modification time and size, remote documents by a
+# conditional request and their digest. MDQ sources fetch each entity when
+# it's used, so there is nothing to reload.
+CHECKED_SOURCES = frozenset(["local", "remote", "mdq"])
+# Seconds to wait for a remote metadata document.
+REMOTE_TIMEOUT = 30
+
+
+def swap_metadata(engine, mds):
+    """
+    Make a pysaml2 entity (and its config and security context) use another
+    metadata store. Each reference is replaced with a single assignment, so
+    requests in flight keep using the store they started with.
+
+    :param engine: saml2.entity.Entity, e.g. the long-lived SP or IdP
+    :param mds: saml2.mdstore.MetadataStore
+    """
+    use_metadata(engine.config, mds)
+    engine.metadata = mds
+    engine.sec.metadata = mds
+
+
+def use_metadata(config, mds):
+    """
+    Make a pysaml2 configuration, and the policies built from it, use a
+    metadata store.
+
+    :param config: saml2.config.Config
+    :param mds: saml2.mdstore.MetadataStore
+    """
+    config.metadata = mds
+    for typ in ("sp", "idp", "aa"):
+        policy = config.getattr("policy", typ)
+        if policy is not None and hasattr(policy, "metadata_store"):
+            policy.metadata_store = mds
+
+
+def local_files(metadata_conf):
+    """
+    The local files a pysaml2 metadata specification refers to, files in
+    directories included.
+    """
+    files = []
+    paths = metadata_conf.get("local", []) if isinstance(metadata_conf,
+                                                         dict) else []
+    for path in paths:
+        if isinstance(path, dict):
+            path = path.get("path") or path.get("filename")
+        if not path:
+            continue
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name)
+                                for name in os.listdir(path)))
+        else:
+            files.append(path)
+    return files
+
+
+def remote_urls(metadata_conf):
+    """
+    The URLs of the remote documents in a pysaml2 metadata specification.
+    """
+    entries = metadata_conf.get("remote", []) if isinstance(metadata_conf,
+                                                           dict) else []
+    return [entry["url"] for entry in entries
+            if isinstance(entry, dict) and entry.get("url")]
+
+
+def only_local(metadata_conf):
+    return (isinstance(metadata_conf, dict) and
+            list(metadata_conf.keys()) == ["local"])
+
+
+class MetadataSnapshot(object):
+    """
+    The parsed metadata saved to a file, so the next start can skip parsing
+    (and checking the signatures of) metadata files that haven't changed.
+
+    The snapshot is only used if the metadata specification, the contents
+    of all the files and the pysaml2 version are the same as when it was
+    written, and nothing in it has expired since. Only local metadata is
+    snapshotted.
+
+    The file is unpickled: it must only be writable by the proxy.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The snapshot file
+        """
+        self.path = path
+
+    def key(self, metadata_conf):
+        digest = hashlib.sha256()
+        digest.update(importlib.metadata.version("pysaml2").encode("utf-8"))
+        digest.update(repr(metadata_conf).encode("utf-8"))
+        for path in local_files(metadata_conf):
+            digest.update(path.encode("utf-8"))
+            try:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+            except (IOError, OSError):
+                digest.update(b"\0")
+        return digest.hexdigest()
+
+    def load(self, config, metadata_conf):
+        """
+        :return: saml2.mdstore.MetadataStore or None if the snapshot is
+            missing, stale or unreadable
+        """
+        if not only_local(metadata_conf):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as err:
+            logger.warning("Ignoring unreadable metadata snapshot %s: %s" %
+                           (self.path, err))
+            return None
+
+        if snapshot.get("key") != self.key(metadata_conf):
+            return None
+        if not all(valid(valid_until) for valid_until in snapshot["expires"]):
+            logger.info("Metadata snapshot %s has expired entries" %
+                        self.path)
+            return None
+
+        mds = config.load_metadata({})
+        for filename, entities in snapshot["sources"]:
+            md = MetaDataFile(mds.attrc, filename)
+            md.entity = entities
+            mds.metadata[filename] = md
+        return mds
+
+    def save(self, mds, metadata_conf):
+        """
+        Atomically replace the snapshot with the content of a store.
+
+        :return: True if written
+        """
+        if not only_local(metadata_conf):
+            return False
+        sources = []
+        expires = []
+        for filename, md in mds.metadata.items():
+            if not isinstance(md, MetaDataFile):
+                return False
+            sources.append((filename, md.entity))
+            if md.entities_descr is not None:
+                if md.entities_descr.valid_until:
+                    expires.append(md.entities_descr.valid_until)
+            for entity in md.entity.values():
+                if entity.get("valid_until"):
+                    expires.append(entity["valid_until"])
+        snapshot = {"key": self.key(metadata_conf), "sources": sources,
+                    "expires": expires}
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=".metadata-", dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except Exception as err:
+            # Not fatal, the next start parses the metadata again.
+            logger.warning("Can't write metadata snapshot %s: %s" %
+                           (self.path, err))
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            return False
+        return True
+
+
+def load_metadata(config, metadata_conf, snapshot=None):
+    """
+    Load a metadata store, from the snapshot if it's up to date. Otherwise
+    the metadata is parsed and the snapshot replaced.
+
+    :param config: saml2.config.Config used to build the store
+    :param metadata_conf: The "metadata" part of the pysaml2 configuration
+    :param snapshot: MetadataSnapshot or None
+    :return: saml2.mdstore.MetadataStore
+    """
+    start = time.time()
+    if snapshot is not None:
+        mds = snapshot.load(config, metadata_conf)
+        if mds is not None:
+            logger.info("Loaded %d metadata entities from snapshot %s in "
+                        "%.3f s" % (len(mds), snapshot.path,
+                                    time.time() - start))
+            return mds
+
+    mds = config.load_metadata(metadata_conf)
+    logger.info("Parsed %d metadata entities in %.3f s" %
+                (len(mds), time.time() - start))
+    if snapshot is not None and snapshot.save(mds, metadata_conf):
+        logger.info("Wrote metadata snapshot %s" % snapshot.path)
+    return mds
+
+
+class MetadataRefresher(object):
+    """
+    Reloads the metadata in a background thread and swaps the new store into
+    the long-lived SAML engines, so new federation members are picked up
+    without a restart and without blocking requests.
+
+    The metadata is only reloaded when a source changed: a local file's
+    modification time or size, or the digest of a remote document. Remote
+    documents are fetched with If-None-Match/If-Modified-Since, so an
+    unchanged one usually costs a 304. A changed one is downloaded twice,
+    here for its digest and again by pysaml2 when it reloads the metadata
+    and checks its signature. MDQ sources never need a reload. Any other
+    source type makes every refresh reload.
+
+    The remote documents are first checked by the refresher thread, see
+    seed(), so making the refresher doesn't wait for their servers.
+    """
+
+    def __init__(self, config, metadata_conf, engines, interval=300,
+                 snapshot=None):
+        """
+        :param config: saml2.config.Config used to build the store
+        :param metadata_conf: The "metadata" part of the pysaml2 configuration
+        :param engines: pysaml2 entities that should use the new store
+        :param interval: Seconds between checks
+        :param snapshot: MetadataSnapshot updated after reloads
+        """
+        self.config = config
+        self.metadata_conf = metadata_conf
+        self.engines = engines
+        self.interval = interval
+        self.snapshot = snapshot
+        # Called with the new store after every swap.
+        self.callbacks = []
+
+        self.checked = (isinstance(metadata_conf, dict) and
+                        set(metadata_conf) <= CHECKED_SOURCES)
+        # Remote documents are fetched like pysaml2 does.
+        if config.disable_ssl_certificate_validation:
+            self.verify = False
+        else:
+            self.verify = config.ca_certs or True
+        # url -> (ETag, Last-Modified, digest) of the remote documents.
+        self._remote = {}
+        self._fingerprint = self.fingerprint(fetch=False)
+        self._seeded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.loads = 0
+        self.unchanged = 0
+        self.failures = 0
+        self.last_load_duration = None
+        self.last_loaded = None
+
+    def fingerprint(self, fetch=True):
+        """
+        :param fetch: Check the remote documents, else use their digests as
+            last seen
+        :return: (local, remote) fingerprints of the sources
+        """
+        local = []
+        for path in local_files(self.metadata_conf):
+            try:
+                st = os.stat(path)
+            except OSError:
+                local.append((path, None, None))
+            else:
+                local.append((path, st.st_mtime, st.st_size))
+        remote = []
+        for url in remote_urls(self.metadata_conf):
+            if fetch:
+                digest = self.remote_digest(url)
+            else:
+                digest = self._remote.get(url, (None, None, None))[2]
+            remote.append((url, digest))
+        return local, remote
+
+    def seed(self):
+        """
+        Fetch the remote documents and take them as the ones loaded at
+        startup, which were fetched just before.
+        """
+        for url in remote_urls(self.metadata_conf):
+            self.remote_digest(url)
+        self._fingerprint = (self._fingerprint[0],
+                             self.fingerprint(fetch=False)[1])
+        self._seeded = True
+
+    def remote_digest(self, url):
+        """
+        :return: SHA-256 of a remote document, as last seen if it isn't
+            modified or can't be fetched
+        """
+        etag, modified, digest = self._remote.get(url, (None, None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+        try:
+            response = requests.get(url, headers=headers, verify=self.verify,
+                                    timeout=REMOTE_TIMEOUT)
+        except requests.RequestException as err:
+            logger.warning("Can't check metadata %s: %s" % (url, err))
+            return digest
+        if response.status_code == 304:
+            return digest
+        if response.status_code != 200:
+            logger.warning("Can't check metadata %s: status %s" %
+                           (url, response.status_code))
+            return digest
+
+        digest = hashlib.sha256(response.content).hexdigest()
+        self._remote[url] = (response.headers.get("ETag"),
+                             response.headers.get("Last-Modified"), digest)
+        return digest
+
+    def refresh(self, force=False):
+        """
+        Reload the metadata if it changed.
+
+        :param force: Reload even if no local file changed
+        :return: True if a new store was swapped in
+        """
+        if not self._seeded:
+            self.seed()
+        fingerprint = self.fingerprint()
+        if not force and self.checked and fingerprint == self._fingerprint:
+            self.unchanged += 1
+            return False
+
+        start = time.time()
+        try:
+            mds = load_metadata(self.config, self.metadata_conf,
+                                self.snapshot)
+        except Exception as err:
+            self.failures += 1
+            logger.exception("Failed to reload metadata, keeping the old: %s"
+                             % err)
+            return False
+        duration = time.time() - start
+
+        for engine in self.engines:
+            swap_metadata(engine, mds)
+        for callback in self.callbacks:
+            callback(mds)
+
+        self._fingerprint = fingerprint
+        self.loads += 1
+        self.last_load_duration = duration
+        self.last_loaded = time.time()
+        logger.info("Reloaded metadata with %d entities in %.3f s" %
+                    (len(mds), duration))
+        return True
+
+    def _run(self):
+        if not self._seeded:
+            self.seed()
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="metadata-refresher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {"loads": self.loads, "unchanged": self.unchanged,
+                "failures": self.failures,
+                "last_load_duration": self.last_load_duration,
+                "last_loaded": self.last_loaded,
+                "entities": len(self.engines[0].metadata)
+                if self.engines else 0}
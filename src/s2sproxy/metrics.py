@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histograms for the phases of a login and request/error counters,
+exposed in the Prometheus text format.
+"""
+
+import bisect
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return ("%s" % value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"')
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return "%d" % value
+    return repr(float(value))
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        """
+        :return: ([(upper bound, cumulative count)], sum, count)
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total, running
+
+
+class _Timer(object):
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    """
+    Thread safe registry of the proxy's metrics. Each process has its own, so
+    with several worker processes every scrape shows one worker.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.phases = {}
+        self.requests = {}
+        self.errors = {}
+        # (prefix, function returning a dict of numbers), exported as gauges,
+        # e.g. the stats() of the state store.
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _histogram(self, name):
+        try:
+            return self.phases[name]
+        except KeyError:
+            with self._lock:
+                return self.phases.setdefault(name, Histogram(self.buckets))
+
+    def phase(self, name):
+        """
+        Context manager timing one phase of the request handling.
+
+        :param name: Name of the phase, e.g. 'parse_authn_request'
+        """
+        return _Timer(self._histogram(name))
+
+    def _increment(self, counters, key):
+        with self._lock:
+            counters[key] = counters.get(key, 0) + 1
+
+    def request(self, endpoint):
+        self._increment(self.requests, endpoint)
+
+    def error(self, error):
+        """
+        :param error: The exception, counted by its class name
+        """
+        self._increment(self.errors, error.__class__.__name__)
+
+    def add_collector(self, prefix, stats):
+        self.collectors.append((prefix, stats))
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text format
+        """
+        lines = [
+            "# HELP s2sproxy_phase_seconds Time spent in each phase of "
+            "handling a request.",
+            "# TYPE s2sproxy_phase_seconds histogram"]
+        for name in sorted(self.phases):
+            buckets, total, count = self.phases[name].samples()
+            for bound, cumulative in buckets:
+                lines.append(
+                    's2sproxy_phase_seconds_bucket{phase="%s",le="%s"} %d' %
+                    (_escape(name), "+Inf" if bound == float("inf")
+                     else repr(bound), cumulative))
+            lines.append('s2sproxy_phase_seconds_sum{phase="%s"} %s' %
+                         (_escape(name), repr(total)))
+            lines.append('s2sproxy_phase_seconds_count{phase="%s"} %d' %
+                         (_escape(name), count))
+
+        with self._lock:
+            requests = sorted(self.requests.items())
+            errors = sorted(self.errors.items())
+        lines.append("# HELP s2sproxy_requests_total Requests per endpoint.")
+        lines.append("# TYPE s2sproxy_requests_total counter")
+        for endpoint, count in requests:
+            lines.append('s2sproxy_requests_total{endpoint="%s"} %d' %
+                         (_escape(endpoint), count))
+        lines.append("# HELP s2sproxy_errors_total Errors per error class.")
+        lines.append("# TYPE s2sproxy_errors_total counter")
+        for error, count in errors:
+            lines.append('s2sproxy_errors_total{error="%s"} %d' %
+                         (_escape(error), count))
+
+        for prefix, stats in self.collectors:
+            for key, value in sorted(stats().items()):
+                if not isinstance(value, (int, float)):
+                    continue
+                name = "s2sproxy_%s_%s" % (prefix, key)
+                lines.append("# TYPE %s gauge" % name)
+                lines.append("%s %s" % (name, _format(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class NullMetrics(object):
+    """
+    Metrics that record nothing, used when metrics are disabled.
+    """
+    _timer = _NullTimer()
+
+    def phase(self, name):
+        return self._timer
+
+    def request(self, endpoint):
+        pass
+
+    def error(self, error):
+        pass
+
+    def add_collector(self, prefix, stats):
+        pass
+
+
+NULL_METRICS = NullMetrics()
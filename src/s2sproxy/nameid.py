@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+Store of the NameIDs the proxy's IdP issues, in place of the dbm file of
+pysaml2's subject_data: an SQLite database in WAL mode that all worker
+processes can use at the same time, with a read cache in each process.
+Users' first NameIDs are written right away, other changes are batched by a
+background thread.
+
+Copy an existing subject_data database into a store with:
+
+    python -m s2sproxy.nameid ./idp.subject /var/lib/s2sproxy/nameid.db
+"""
+
+import argparse
+import atexit
+import logging
+import os
+import shelve
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Default maximum number of entries in the read cache.
+DEFAULT_CACHE_SIZE = 100000
+# Default seconds a cached entry is used before it's read again.
+DEFAULT_CACHE_TTL = 60
+# Default seconds between writes of the pending changes.
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Marks a pending deletion.
+_DELETED = object()
+
+
+def merge(current, base, value):
+    """
+    The value to write for a key, given what's in the database.
+
+    saml2.ident.IdentDB keeps the NameIDs of a user as one space separated
+    string and adds one by writing the old string with the new NameID
+    appended. When another process changed the key meanwhile, the NameIDs
+    appended here are added to its value instead of overwriting it.
+
+    :param current: Value in the database, None if missing
+    :param base: Value the new one was made from, None if missing
+    :param value: The new value
+    """
+    if current is None or current == base:
+        return value
+    if base is None:
+        added = value.split(" ")
+    elif value.startswith(base + " "):
+        added = value[len(base) + 1:].split(" ")
+    else:
+        return value
+    items = current.split(" ")
+    return " ".join(items + [item for item in added if item not in items])
+
+
+class NameIDStore(MutableMapping):
+    """
+    Dictionary of strings for saml2.ident.IdentDB.
+
+    Reads are served from a cache of the most recently used entries. An
+    entry is read from the database again after cache_ttl seconds, so
+    NameIDs other processes add for a known user are seen.
+
+    A key that isn't in the database yet, a user's first NameID, is added
+    right away, unless another process added it first: then its value is
+    kept. Read the key again to get the value stored.
+
+    Changes to keys in the database update the cache and are written to the
+    database together, in one transaction, every flush_interval seconds or
+    when batch_size are pending, and at flush() and close(). Changes not yet
+    written are lost if the process is killed.
+    """
+
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, batch_size=1000,
+                 timeout=5.0, timer=time.monotonic):
+        """
+        :param path: Database file, created if missing
+        :param cache_size: Maximum number of cached entries
+        :param cache_ttl: Seconds a cached entry is used
+        :param flush_interval: Seconds between writes, 0 writes every change
+            right away
+        :param batch_size: Number of pending changes that are written
+            without waiting for the interval
+        :param timeout: Seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.timer = timer
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._cache = OrderedDict()
+        # key -> (value or _DELETED, value it replaced or None)
+        self._pending = OrderedDict()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.flushes = 0
+        self.merges = 0
+        self.conflicts = 0
+        self.last_flush_duration = None
+        # Fail at startup, not at the first login, if it can't be opened.
+        self._connection()
+        atexit.register(self.flush)
+
+    def _connection(self):
+        # One connection per thread, and new ones after a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS nameid "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL) "
+                         "WITHOUT ROWID")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _forked(self):
+        # Must be called with the lock held. Changes pending in the parent
+        # are the parent's to write, and its writer thread isn't here.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending.clear()
+            self._thread = None
+
+    def _read(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM nameid WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _cached(self, key):
+        # Must be called with the lock held. Raises KeyError if not cached.
+        if key in self._pending:
+            value = self._pending[key][0]
+            return None if value is _DELETED else value
+        expires, value = self._cache[key]
+        if expires <= self.timer():
+            del self._cache[key]
+            raise KeyError(key)
+        self._cache.move_to_end(key)
+        return value
+
+    def _cache_put(self, key, value):
+        # Must be called with the lock held.
+        self._cache[key] = (self.timer() + self.cache_ttl, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._forked()
+            try:
+                value = self._cached(key)
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                if value is None:
+                    raise KeyError(key)
+                return value
+
+        # Missing keys aren't cached, a user another process just made a
+        # NameID for must not get a second one here.
+        self.misses += 1
+        value = self._read(key)
+        if value is None:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._pending:
+                self._cache_put(key, value)
+        return value
+
+    def _insert(self, key, value):
+        # Adds a key that isn't in the database right away, so the other
+        # processes see it. If one of them added it first its value is
+        # kept, and returned.
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO nameid VALUES (?, ?)",
+                         (key, value))
+            stored = self._read(key)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            if key not in self._pending:
+                self._cache_put(key, stored)
+            self.writes += 1
+            if stored != value:
+                self.conflicts += 1
+        return stored
+
+    def _write(self, key, value):
+        try:
+            base = self[key]
+        except KeyError:
+            base = None
+        with self._lock:
+            new = base is None and key not in self._pending
+        if new and value is not _DELETED:
+            self._insert(key, value)
+            return
+        with self._lock:
+            if key in self._pending:
+                # The database value is still what the first change was
+                # made from.
+                base = self._pending[key][1]
+            self._pending[key] = (value, base)
+            self._cache_put(key, None if value is _DELETED else value)
+            self.writes += 1
+            pending = len(self._pending)
+
+        if not self.flush_interval:
+            self.flush()
+        elif pending >= self.batch_size:
+            self._wakeup.set()
+        self._start()
+
+    def __setitem__(self, key, value):
+        self._write(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._write(key, _DELETED)
+
+    def __iter__(self):
+        self.flush()
+        return iter([row[0] for row in self._connection().execute(
+            "SELECT key FROM nameid")])
+
+    def __len__(self):
+        self.flush()
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM nameid").fetchone()[0]
+
+    def flush(self):
+        """
+        Write the pending changes.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._forked()
+                pending = self._pending
+                self._pending = OrderedDict()
+            if not pending:
+                return
+
+            start = time.time()
+            conn = self._connection()
+            written = {}
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for key, (value, base) in pending.items():
+                    if value is _DELETED:
+                        conn.execute("DELETE FROM nameid WHERE key = ?",
+                                     (key,))
+                        continue
+                    current = self._read(key)
+                    merged = merge(current, base, value)
+                    if merged != value:
+                        self.merges += 1
+                        written[key] = merged
+                    conn.execute("INSERT OR REPLACE INTO nameid VALUES (?, ?)",
+                                 (key, merged))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                # Keep the changes for the next try, before any made since.
+                with self._lock:
+                    pending.update(self._pending)
+                    self._pending = pending
+                raise
+
+            with self._lock:
+                for key, value in written.items():
+                    if key not in self._pending:
+                        self._cache_put(key, value)
+            self.flushes += 1
+            self.last_flush_duration = time.time() - start
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception("Failed to write NameIDs, retrying: %s" %
+                                 err)
+
+    def _start(self):
+        if not self.flush_interval:
+            return
+        with self._lock:
+            self._forked()
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="nameid-writer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop the writer thread and write the pending changes.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self._thread = None
+        self.flush()
+
+    def stats(self):
+        return {"cached": len(self._cache), "pending": len(self._pending),
+                "hits": self.hits, "misses": self.misses,
+                "writes": self.writes, "flushes": self.flushes,
+                "merges": self.merges, "conflicts": self.conflicts,
+                "last_flush_duration": self.last_flush_duration}
+
+
+def open_subject_data(path):
+    """
+    Open a subject_data database read-only, like pysaml2 does.
+    """
+    try:
+        return shelve.open(path, flag="r")
+    except Exception:
+        if path.endswith(".db"):
+            return shelve.open(path[:-3], flag="r")
+        raise
+
+
+def migrate(source, path):
+    """
+    Copy the entries of a subject_data database into a store.
+
+    :param source: The subject_data database
+    :param path: Database file of the store, created if missing
+    :return: Number of entries
+    """
+    db = open_subject_data(source)
+    store = NameIDStore(path, flush_interval=0)
+    try:
+        conn = store._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        count = 0
+        for key in db.keys():
+            conn.execute("INSERT OR REPLACE INTO nameid VALUES (?, ?)",
+                         (key, db[key]))
+            count += 1
+        conn.execute("COMMIT")
+    finally:
+        db.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy a pysaml2 subject_data database into a NameID "
+                    "store for NAMEID_STORE.")
+    parser.add_argument(dest="source", help="The subject_data database.")
+    parser.add_argument(dest="store", help="The store, created if missing.")
+    args = parser.parse_args()
+
+    start = time.time()
+    count = migrate(args.source, args.store)
+    print("Copied %d entries to %s in %.1f s" % (count, args.store,
+                                                 time.time() - start),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Per-entity cache of what the metadata says about how to talk to an SP or
+IdP, so the metadata walks are done once per entity instead of on every
+login. The cache is dropped when the metadata is reloaded.
+"""
+
+import logging
+import threading
+
+from saml2.samlp import AuthnRequest
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Marks a value of a Plan that hasn't been looked up yet.
+_MISSING = object()
+
+
+class Plan(object):
+    """
+    What is known about one entity. Endpoints are resolved per request
+    shape, everything else is looked up the first time it's used.
+    """
+
+    def __init__(self, entity_id, metadata):
+        self.entity_id = entity_id
+        self.metadata = metadata
+        self.endpoints = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, load):
+        value = self._values.get(name, _MISSING)
+        if value is _MISSING:
+            value = load()
+            with self._lock:
+                self._values[name] = value
+        return value
+
+    @property
+    def attribute_requirement(self):
+        """
+        Attributes the SP requires and those it accepts, from its
+        AttributeConsumingService.
+        """
+        return self._get("attribute_requirement", lambda: (
+            self.metadata.attribute_requirement(self.entity_id) or {}))
+
+    @property
+    def encryption_certs(self):
+        """
+        The SP's certificates for encryption.
+        """
+        def load():
+            try:
+                return self.metadata.certs(self.entity_id, "spsso",
+                                           use="encryption")
+            except Exception:
+                return []
+        return self._get("encryption_certs", load)
+
+
+class ResponsePlans(object):
+    """
+    Plans for the entities a pysaml2 engine talks to.
+    """
+
+    def __init__(self, engine):
+        """
+        :param engine: The long-lived pysaml2 entity
+        """
+        self.engine = engine
+        self._plans = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def plan(self, entity_id):
+        try:
+            return self._plans[entity_id]
+        except KeyError:
+            pass
+        with self._lock:
+            plan = self._plans.get(entity_id)
+            if plan is None:
+                plan = self._plans[entity_id] = Plan(entity_id,
+                                                     self.engine.metadata)
+            return plan
+
+    def invalidate(self, mds=None):
+        """
+        Forget all plans, e.g. as a MetadataRefresher callback.
+        """
+        with self._lock:
+            self._plans = {}
+            self.invalidations += 1
+
+    def pick_binding(self, service, bindings=None, descr_type="",
+                     request=None, entity_id=""):
+        """
+        Cached saml2.entity.Entity.pick_binding.
+        """
+        if request and not entity_id:
+            entity_id = request.issuer.text.strip()
+        if bindings is None:
+            if request and request.protocol_binding:
+                bindings = [request.protocol_binding]
+            else:
+                bindings = self.engine.config.preferred_binding[service]
+        if not descr_type:
+            if self.engine.entity_type == "sp":
+                descr_type = "idpsso"
+            else:
+                descr_type = "spsso"
+
+        key = (service, tuple(bindings), descr_type,
+               getattr(request, "%s_url" % service, None),
+               getattr(request, "%s_index" % service, None))
+        plan = self.plan(entity_id)
+        try:
+            endpoint = plan.endpoints[key]
+        except KeyError:
+            self.misses += 1
+            endpoint = self.engine.pick_binding(service, list(bindings),
+                                                descr_type, request,
+                                                entity_id)
+            plan.endpoints[key] = endpoint
+        else:
+            self.hits += 1
+        return endpoint
+
+    def response_args(self, authn_req):
+        """
+        Cached saml2.entity.Entity.response_args for an AuthnRequest.
+        """
+        if not isinstance(authn_req, AuthnRequest):
+            return self.engine.response_args(authn_req)
+
+        binding, destination = self.pick_binding(
+            "assertion_consumer_service", descr_type="spsso",
+            request=authn_req)
+        return {"in_response_to": authn_req.id,
+                "sp_entity_id": authn_req.issuer.text,
+                "name_id_policy": authn_req.name_id_policy,
+                "binding": binding,
+                "destination": destination}
+
+    def stats(self):
+        return {"entities": len(self._plans), "hits": self.hits,
+                "misses": self.misses, "invalidations": self.invalidations}
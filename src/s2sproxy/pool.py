@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool for signing, signature verification, assertion encryption and
+decryption, so one proxy process can use all cores for crypto while its
+request threads stay free for the cheap requests.
+"""
+
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+
+from saml2 import SamlBase
+from saml2.sigver import CryptoBackend
+from saml2.sigver import CryptoBackendXmlSec1
+from saml2.sigver import pre_encrypt_assertion
+
+from s2sproxy.crypto import IN_PROCESS
+from s2sproxy.crypto import InProcessCryptoBackend
+from s2sproxy.crypto import XMLSEC1
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Crypto backend of a worker process, see _init_worker.
+_backend = None
+
+
+class CryptoPoolFull(Exception):
+    pass
+
+
+class CryptoJobTimeout(Exception):
+    pass
+
+
+def _init_worker(backend, xmlsec_binary):
+    global _backend
+    if backend == IN_PROCESS:
+        _backend = InProcessCryptoBackend(xmlsec_binary)
+    else:
+        _backend = CryptoBackendXmlSec1(xmlsec_binary)
+
+
+def _sign(statement, node_name, key_file, node_id):
+    return _backend.sign_statement(statement, node_name, key_file, node_id)
+
+
+def _verify(signedtext, cert_file, cert_type, node_name, node_id):
+    return _backend.validate_signature(signedtext, cert_file, cert_type,
+                                       node_name, node_id)
+
+
+def _encrypt_assertion(statement, enc_key, template, key_type, node_xpath):
+    return _backend.encrypt_assertion(statement, enc_key, template, key_type,
+                                      node_xpath)
+
+
+def _decrypt(enctext, key_file):
+    return _backend.decrypt(enctext, key_file)
+
+
+class CryptoPool(object):
+    """
+    Runs crypto jobs in worker processes. Jobs are serialized XML plus the
+    path of the key or certificate. Each worker uses the configured
+    CRYPTO_BACKEND: with "inprocess" it parses a key once, with "xmlsec1" it
+    still runs the xmlsec1 binary for every job, which then reads the key
+    file again. The pool moves that work off the request threads, it
+    doesn't make it cheaper.
+    """
+
+    def __init__(self, workers, backend=XMLSEC1, xmlsec_binary=XMLSEC1,
+                 max_pending=None, timeout=10.0):
+        """
+        :param workers: Number of worker processes
+        :param backend: Crypto backend the workers use, "xmlsec1" or
+            "inprocess"
+        :param xmlsec_binary: Path to the xmlsec1 binary
+        :param max_pending: Maximum number of queued and running jobs, more
+            are rejected with CryptoPoolFull. Four per worker by default.
+        :param timeout: Seconds to wait for a job before CryptoJobTimeout.
+            A job that is already running isn't stopped, it keeps its slot
+            of max_pending until it finishes.
+        """
+        self.workers = workers
+        self.max_pending = max_pending or 4 * workers
+        self.timeout = timeout
+        # Workers are started, not forked, so they don't inherit the locks
+        # held by request threads.
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(backend, xmlsec_binary))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _done(self, future):
+        # Called once the job has finished in a worker, or was cancelled
+        # before one started it: only then is its slot free again.
+        with self._lock:
+            self.pending -= 1
+            if future.cancelled():
+                self.cancelled += 1
+            elif future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        self._slots.release()
+
+    def submit(self, func, *args):
+        """
+        Run func(*args) in a worker and wait for the result.
+
+        :raise CryptoPoolFull: If max_pending jobs are already waiting
+        :raise CryptoJobTimeout: If the job took longer than timeout
+        """
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise CryptoPoolFull("%d crypto jobs pending" % self.max_pending)
+
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # Only stops the job if no worker has taken it yet.
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            raise CryptoJobTimeout("Crypto job took more than %s s" %
+                                   self.timeout)
+
+    def sign_statement(self, statement, node_name, key_file, node_id):
+        if not isinstance(statement, (str, bytes)):
+            statement = "%s" % statement
+        return self.submit(_sign, statement, node_name, key_file, node_id)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name,
+                           node_id):
+        return self.submit(_verify, signedtext, cert_file, cert_type,
+                           node_name, node_id)
+
+    def encrypt_assertion(self, statement, enc_key, template,
+                          key_type="des-192", node_xpath=None):
+        # The certificate is in a temporary file, which exists until this
+        # returns.
+        if isinstance(statement, SamlBase):
+            statement = pre_encrypt_assertion(statement)
+        return self.submit(_encrypt_assertion, "%s" % statement, enc_key,
+                           "%s" % template, key_type, node_xpath)
+
+    def decrypt(self, enctext, key_file):
+        return self.submit(_decrypt, enctext, key_file)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def stats(self):
+        return {"workers": self.workers, "pending": self.pending,
+                "completed": self.completed, "failed": self.failed,
+                "cancelled": self.cancelled, "rejected": self.rejected,
+                "timeouts": self.timeouts}
+
+
+class PooledCryptoBackend(CryptoBackend):
+    """
+    pysaml2 crypto backend that signs, verifies, encrypts assertions and
+    decrypts in a CryptoPool and leaves everything else to the backend it
+    replaces.
+    """
+
+    def __init__(self, pool, local):
+        """
+        :param pool: CryptoPool
+        :param local: Backend used for everything else
+        """
+        CryptoBackend.__init__(self)
+        self.pool = pool
+        self.local = local
+
+    def encrypt(self, *args, **kwargs):
+        return self.local.encrypt(*args, **kwargs)
+
+    def encrypt_assertion(self, statement, enc_key, template,
+                          key_type="des-192", node_xpath=None, node_id=None):
+        return self.pool.encrypt_assertion(statement, enc_key, template,
+                                           key_type, node_xpath)
+
+    def decrypt(self, enctext, key_file):
+        return self.pool.decrypt(enctext, key_file)
+
+    def sign_statement(self, statement, node_name, key_file, node_id):
+        return self.pool.sign_statement(statement, node_name, key_file,
+                                        node_id)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name,
+                           node_id):
+        return self.pool.validate_signature(signedtext, cert_file, cert_type,
+                                            node_name, node_id)
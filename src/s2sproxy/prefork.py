@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking process manager, to use more than one core for the XML and crypto
+work despite the GIL.
+
+The proxy configuration and metadata are loaded once in the master, before
+forking, so the workers share that memory copy-on-write. The listening socket
+is also created before forking: the workers accept from the same queue, so a
+worker that stops or is replaced doesn't drop the connections waiting for it.
+
+Signals to the master:
+
+    SIGTERM, SIGINT  stop the workers gracefully (in-flight requests finish)
+                     and exit
+    SIGHUP           graceful restart: start new workers, then stop the old
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+
+class RequestCounter(object):
+    """
+    WSGI middleware that stops the worker after max_requests requests, so the
+    master replaces it with a fresh one.
+    """
+
+    def __init__(self, app, max_requests, stop):
+        """
+        :param app: WSGI application
+        :param max_requests: Number of requests before recycling
+        :param stop: Called once when the limit is reached
+        """
+        self.app = app
+        self.max_requests = max_requests
+        self.stop = stop
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+            recycle = self.count == self.max_requests
+        try:
+            return self.app(environ, start_response)
+        finally:
+            if recycle:
+                logger.info("Worker %d served %d requests, recycling" %
+                            (os.getpid(), self.count))
+                self.stop()
+
+
+def listen(host, port, backlog=128):
+    """
+    Create the listening socket for the workers to share.
+    """
+    family, socktype, proto, _, addr = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+        socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen(backlog)
+    return sock
+
+
+def stop_worker():
+    # Signal ourselves, so the server is stopped from the main thread and
+    # not from the request thread it would wait for.
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+class PreforkServer(object):
+    """
+    Forks and supervises worker processes, replacing those that exit.
+    """
+
+    def __init__(self, run_worker, workers, stop_timeout=30):
+        """
+        :param run_worker: Called in each new worker process, serves until
+            the worker gets SIGTERM and then returns
+        :param workers: Number of worker processes
+        :param stop_timeout: Seconds to wait for workers to finish their
+            requests before they are killed
+        """
+        self.run_worker = run_worker
+        self.workers = workers
+        self.stop_timeout = stop_timeout
+        self.children = set()
+        self._stopping = False
+        self._restart = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # Worker.
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                           signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                self.run_worker()
+            except BaseException:
+                logger.exception("Worker %d failed" % os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+        self.children.add(pid)
+        logger.info("Started worker %d" % pid)
+        return pid
+
+    def kill(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+
+    def reap(self, block=False):
+        """
+        Collect exited workers.
+
+        :return: pids of the workers that exited
+        """
+        exited = []
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as err:
+                if err.errno == errno.ECHILD:
+                    self.children.clear()
+                    break
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                break
+            if pid in self.children:
+                self.children.discard(pid)
+                exited.append(pid)
+            if block:
+                break
+        return exited
+
+    def stop_workers(self, pids):
+        """
+        Ask workers to finish their requests and exit, kill them if they
+        haven't within stop_timeout.
+        """
+        pids = set(pids)
+        self.kill(pids)
+        deadline = time.time() + self.stop_timeout
+        while pids & self.children and time.time() < deadline:
+            for pid in self.reap():
+                if pid not in pids and not self._stopping:
+                    self.spawn()
+            time.sleep(0.1)
+        remaining = pids & self.children
+        if remaining:
+            logger.warning("Killing workers %s" % sorted(remaining))
+            self.kill(remaining, signal.SIGKILL)
+            while remaining & self.children:
+                self.reap(block=True)
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_restart(self, signum, frame):
+        self._restart = True
+
+    def run(self):
+        """
+        Start the workers and keep that many running until SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while not self._stopping:
+            if self._restart:
+                self._restart = False
+                old = set(self.children)
+                logger.info("Graceful restart of workers %s" % sorted(old))
+                for _ in range(self.workers):
+                    self.spawn()
+                self.stop_workers(old)
+
+            for pid in self.reap():
+                if not self._stopping:
+                    logger.info("Worker %d exited, replacing it" % pid)
+                    self.spawn()
+            time.sleep(0.2)
+
+        logger.info("Stopping workers")
+        self.stop_workers(self.children)
@@ -3,13 +3,94 @@
 
 import argparse
 import os
+import signal
 import sys
+import threading
+import time
 
 import cherrypy
 from beaker.middleware import SessionMiddleware
+from cherrypy._cpwsgi_server import CPWSGIServer
+from cherrypy.process.plugins import SimplePlugin
 from werkzeug.debug import DebuggedApplication
 
+from s2sproxy.prefork import PreforkServer
+from s2sproxy.prefork import RequestCounter
+from s2sproxy.prefork import listen
+from s2sproxy.prefork import stop_worker
 from s2sproxy.server import WsgiApplication
+from s2sproxy.tenants import MultiTenantApplication
+
+
+class InheritedSocketServer(CPWSGIServer):
+    """
+    CherryPy's HTTP server, accepting on a socket created by the pre-fork
+    master instead of binding its own.
+    """
+
+    def __init__(self, server_adapter, listener):
+        CPWSGIServer.__init__(self, server_adapter)
+        self.listener = listener
+
+    def bind(self, family, type, proto=0):
+        # A duplicate, since stopping the server closes its socket.
+        sock = self.listener.dup()
+        if self.ssl_adapter is not None:
+            sock = self.ssl_adapter.bind(sock)
+        self.socket = sock
+        return sock
+
+
+class WorkerServer(SimplePlugin):
+    """
+    Runs InheritedSocketServer on the CherryPy engine of a worker, in place
+    of cherrypy.server which insists on the port being free.
+    """
+
+    def __init__(self, bus, listener):
+        SimplePlugin.__init__(self, bus)
+        self.listener = listener
+        self.httpserver = None
+        self.thread = None
+
+    def start(self):
+        self.httpserver = InheritedSocketServer(cherrypy.server, self.listener)
+        self.thread = threading.Thread(target=self.httpserver.safe_start,
+                                       name="HTTPServer")
+        self.thread.start()
+        while not self.httpserver.ready and self.thread.is_alive():
+            time.sleep(0.1)
+        if not self.httpserver.ready:
+            raise RuntimeError("HTTP server failed to start")
+    start.priority = 75
+
+    def stop(self):
+        if self.httpserver is not None:
+            # Waits for the requests in progress.
+            self.httpserver.stop()
+            self.thread.join()
+            self.httpserver = None
+
+
+def serve_worker(app, listener):
+    """
+    Serve requests in a pre-forked worker until it gets SIGTERM.
+
+    :param app: WsgiApplication or MultiTenantApplication, loaded before
+        forking
+    :param listener: The listening socket of the master
+    """
+    app.start()
+    cherrypy.server.unsubscribe()
+    cherrypy.engine.autoreload.unsubscribe()
+    WorkerServer(cherrypy.engine, listener).subscribe()
+    signal.signal(signal.SIGTERM, lambda signum, frame:
+                  cherrypy.engine.exit())
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+    # The requests are done. The worker ends with os._exit, which skips
+    # atexit hooks, so write what is still pending here.
+    app.stop()
 
 
 def main():
@@ -20,6 +101,18 @@ def main():
                         help="Entity id for the underlying IdP. If not "
                              "specified, a discovery server will be used "
                              "instead.")
+    parser.add_argument('-w', '--workers', dest="workers", type=int,
+                        default=0,
+                        help="Number of worker processes to pre-fork. By "
+                             "default the server runs in a single process.")
+    parser.add_argument('--max-requests', dest="max_requests", type=int,
+                        default=0,
+                        help="Replace a worker after it served this many "
+                             "requests. Only used with --workers.")
+    parser.add_argument('--tenants', action='store_true', dest="tenants",
+                        help="The proxy configuration is a list of TENANTS, "
+                             "each a proxy with its own configuration "
+                             "served by this server.")
     parser.add_argument(dest="proxy_config",
                         help="Configuration file for the proxy (pysaml2 sp and idp).")
     parser.add_argument(dest="server_config",
@@ -29,14 +122,38 @@ def main():
     sys.path.insert(0, os.getcwd())
     server_conf = __import__(args.server_config)
 
-    wsgi_app = WsgiApplication(args.proxy_config, args.entityid,
-                               args.debug).run_server
+    # With workers the configuration and metadata are loaded here, before
+    # forking, and each worker starts its own threads.
+    if args.tenants:
+        app = MultiTenantApplication.from_config(args.proxy_config,
+                                                 args.debug,
+                                                 start=not args.workers)
+        tenants = app.apps
+    else:
+        app = WsgiApplication(args.proxy_config, args.entityid, args.debug,
+                              start=not args.workers)
+        tenants = [app]
+    # Even a single worker is replaced when it's recycled, restarted with
+    # SIGHUP or fails, and logins in flight then need the state it had.
+    if args.workers and not all(tenant.shared_state or
+                                "sealer" in tenant.sp_args
+                                for tenant in tenants):
+        parser.error("--workers needs a login state shared between the "
+                     "workers and their replacements: set STATE_STORE or "
+                     "STATELESS_KEY in the proxy configuration")
+
+    wsgi_app = app.run_server
     if args.debug:
         wsgi_app = DebuggedApplication(wsgi_app)
 
+    # A client that stops sending a request body is cut off when a read
+    # from its socket takes longer than BODY_TIMEOUT.
+    socket_timeout = min([cherrypy.server.socket_timeout] +
+                         [tenant.body_timeout for tenant in tenants])
     cherrypy.config.update({
         'server.socket_host': '0.0.0.0',
-        'server.socket_port': server_conf.PORT
+        'server.socket_port': server_conf.PORT,
+        'server.socket_timeout': socket_timeout
     })
     if server_conf.HTTPS:
         cherrypy.config.update({
@@ -60,11 +177,20 @@ def main():
         }
     })
 
-    cherrypy.tree.graft(SessionMiddleware(wsgi_app, server_conf.SESSION_OPTS),
-                        '/')
+    wsgi_app = SessionMiddleware(wsgi_app, server_conf.SESSION_OPTS)
+    if args.workers and args.max_requests:
+        wsgi_app = RequestCounter(wsgi_app, args.max_requests, stop_worker)
+    cherrypy.tree.graft(wsgi_app, '/')
 
-    cherrypy.engine.start()
-    cherrypy.engine.block()
+    if args.workers:
+        listener = listen('0.0.0.0', server_conf.PORT)
+
+        PreforkServer(lambda: serve_worker(app, listener),
+                      args.workers).run()
+    else:
+        cherrypy.engine.start()
+        cherrypy.engine.block()
+        app.stop()
 
 
 if __name__ == '__main__':
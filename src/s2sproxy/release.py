@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Attribute release policies compiled once per SP.
+
+pysaml2 resolves the IdP's policy (attribute_restrictions, entity
+categories, fail_on_missing_requested, name_form, lifetime) and matches the
+attributes the SP requests against the attribute converters on every
+authentication response. Here that is done the first time a response is
+made for an SP, and each later response is filtered in a pass over its
+attributes with the resolved rules. The compiled policies are dropped when
+the metadata is reloaded. The attribute converters of the name-formats are
+compiled once per IdP engine too.
+"""
+
+import copy
+import logging
+import threading
+
+from saml2 import saml
+from saml2.assertion import Policy
+from saml2.attribute_converter import AttributeConverter
+from saml2.attribute_converter import ac_factory
+from saml2.attribute_converter import get_local_name
+from saml2.s_utils import MissingValue
+from saml2.s_utils import do_ava
+from saml2.s_utils import factory
+from saml2.time_util import in_a_while
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+EPTID = "urn:oid:1.3.6.1.4.1.5923.1.1.1.10"
+
+
+class NameFormConverter(AttributeConverter):
+    """
+    An attribute converter with its conversion to the name-format compiled:
+    the Attribute arguments of each local name, as spelled in the released
+    attributes, are worked out the first time and reused after that.
+    """
+
+    def __init__(self, converter):
+        """
+        :param converter: The saml2.attribute_converter.AttributeConverter
+        """
+        AttributeConverter.__init__(self, converter.name_format)
+        self.__dict__.update(converter.__dict__)
+        self._compiled = {}
+
+    def _compile(self, key):
+        name = self._to.get(key.lower())
+        if name:
+            return {"name": name, "name_format": self.name_format,
+                    "friendly_name": key}, name == EPTID
+        return {"name": key}, False
+
+    def to_(self, attrvals):
+        """
+        saml2.attribute_converter.AttributeConverter.to_.
+        """
+        attributes = []
+        for key, value in attrvals.items():
+            try:
+                kwargs, eptid = self._compiled[key]
+            except KeyError:
+                # Only the names in the converter's table are kept, so the
+                # table is bounded.
+                kwargs, eptid = self._compile(key)
+                if "name_format" in kwargs:
+                    self._compiled[key] = kwargs, eptid
+            attr_value = self.to_eptid_value(value) if eptid else \
+                do_ava(value)
+            attributes.append(factory(saml.Attribute,
+                                      attribute_value=attr_value, **kwargs))
+        return attributes
+
+
+class Release(object):
+    """
+    The release policy of one SP.
+    """
+
+    def __init__(self, sp_entity_id, policy, acs, requirement):
+        """
+        :param sp_entity_id: The SP
+        :param policy: The IdP's saml2.assertion.Policy
+        :param acs: The IdP's attribute converters
+        :param requirement: What the SP requires and accepts, as from
+            MetadataStore.attribute_requirement
+        """
+        self.sp_entity_id = sp_entity_id
+        required = requirement.get("required") or []
+        optional = requirement.get("optional") or []
+
+        # Policy.filter falls back to the default converters too. The
+        # configured policy is shared, so the converters are set on a copy.
+        acs = acs or ac_factory()
+        policy = copy.copy(policy)
+        policy.acs = acs
+        # Lowercase names of the attributes the SP's entity categories allow,
+        # in place of what it requests.
+        categories = policy.get_entity_categories(sp_entity_id,
+                                                  required=required)
+        self.categories = frozenset(categories) if categories else None
+        self.requested = ([self._requested(attr, acs, True)
+                           for attr in required] +
+                          [self._requested(attr, acs, False)
+                           for attr in optional])
+        self.fail_on_missing = policy.get_fail_on_missing_requested(
+            sp_entity_id)
+        # Lowercase name -> compiled value patterns, or None for any value.
+        self.restrictions = policy.get_attribute_restrictions(sp_entity_id)
+        self.name_form = policy.get_name_form(sp_entity_id)
+        self.lifetime = policy.get_lifetime(sp_entity_id)
+
+    @staticmethod
+    def _requested(attr, acs, must):
+        # The names to look for in the attributes, as
+        # saml2.assertion.filter_on_attributes does.
+        names = []
+        if attr.get("name_format"):
+            local_name = get_local_name(acs, attr["name"],
+                                        attr["name_format"])
+        else:
+            local_name = attr.get("friendly_name")
+        if local_name:
+            names.append(local_name)
+        names.append(attr["name"])
+        values = [av["text"] for av in attr.get("attribute_value", [])]
+        return tuple(names), values, must, attr["name"]
+
+    def filter(self, ava):
+        """
+        :param ava: The attributes of the user
+        :return: The attributes released to the SP
+        :raise MissingValue: If a required attribute or value is missing and
+            the policy says to fail
+        """
+        if self.categories is not None:
+            ava = dict((name, values) for name, values in ava.items()
+                       if name.lower() in self.categories)
+        elif self.requested:
+            ava = self._filter_requested(ava)
+
+        restrictions = self.restrictions
+        if not restrictions:
+            return dict(ava)
+
+        released = {}
+        for name, values in ava.items():
+            try:
+                patterns = restrictions[name.lower()]
+            except KeyError:
+                continue
+            if patterns is None:
+                released[name] = values
+                continue
+            if isinstance(values, str):
+                values = [values]
+            allowed = []
+            for pattern in patterns:
+                for value in values:
+                    if pattern.match(value) and value not in allowed:
+                        allowed.append(value)
+            if allowed:
+                released[name] = allowed
+        return released
+
+    def _filter_requested(self, ava):
+        lower = {}
+        for name in ava:
+            lower.setdefault(name.lower(), name)
+
+        released = {}
+        for names, wanted, must, name in self.requested:
+            for candidate in names:
+                key = candidate if candidate in ava else \
+                    lower.get(candidate.lower())
+                if key is not None:
+                    break
+            else:
+                if must and self.fail_on_missing:
+                    raise MissingValue(
+                        "Required attribute missing: '%s'" % name)
+                continue
+
+            values = ava[key]
+            if isinstance(values, str):
+                values = [values]
+            if wanted:
+                values = [value for value in wanted if value in values]
+                if must and not values:
+                    raise MissingValue("Required attribute value missing")
+            released.setdefault(key, []).extend(values)
+        return released
+
+
+class ReleasePolicies(object):
+    """
+    The compiled release policies of an IdP engine, used by pysaml2 in
+    place of its policy: pass it as release_policy to
+    Server.create_authn_response. What isn't compiled is passed on to the
+    configured policy. The engine's attribute converters are replaced by
+    NameFormConverters, which pysaml2 uses to build the attribute statements.
+    """
+
+    def __init__(self, engine, plans):
+        """
+        :param engine: The long-lived saml2.server.Server
+        :param plans: s2sproxy.plan.ResponsePlans of the engine, for what
+            the SPs request
+        """
+        self.engine = engine
+        self.plans = plans
+        # Other kinds of converters, like AttributeConverterNOOP, are kept.
+        engine.config.attribute_converters = [
+            NameFormConverter(converter)
+            if type(converter) is AttributeConverter else converter
+            for converter in engine.config.attribute_converters or []]
+        self._releases = {}
+        self._lock = threading.Lock()
+        # Bumped by invalidate(), so a Release compiled from the metadata
+        # before it isn't kept.
+        self._generation = 0
+
+        self.compiled = 0
+        self.invalidations = 0
+
+    @property
+    def policy(self):
+        return self.engine.config.getattr("policy", "idp") or \
+            Policy(mds=self.engine.metadata)
+
+    def release(self, sp_entity_id):
+        """
+        :return: The Release of an SP, compiled the first time
+        """
+        try:
+            return self._releases[sp_entity_id]
+        except KeyError:
+            pass
+
+        generation = self._generation
+        self.compiled += 1
+        release = Release(sp_entity_id, self.policy,
+                          self.engine.config.attribute_converters,
+                          self.plans.plan(sp_entity_id).attribute_requirement)
+        with self._lock:
+            if generation == self._generation:
+                self._releases[sp_entity_id] = release
+        return release
+
+    def invalidate(self, mds=None):
+        """
+        Forget all compiled policies, e.g. as a MetadataRefresher callback.
+        """
+        with self._lock:
+            self._releases = {}
+            self._generation += 1
+            self.invalidations += 1
+
+    def restrict(self, ava, sp_entity_id, metadata=None):
+        """
+        saml2.assertion.Policy.restrict.
+        """
+        return self.release(sp_entity_id).filter(ava)
+
+    def get_name_form(self, sp_entity_id):
+        return self.release(sp_entity_id).name_form
+
+    def get_lifetime(self, sp_entity_id):
+        return self.release(sp_entity_id).lifetime
+
+    def not_on_or_after(self, sp_entity_id):
+        return in_a_while(**self.get_lifetime(sp_entity_id))
+
+    # Uses not_on_or_after above.
+    conditions = Policy.conditions
+
+    def __getattr__(self, name):
+        return getattr(self.policy, name)
+
+    def stats(self):
+        return {"entities": len(self._releases), "compiled": self.compiled,
+                "invalidations": self.invalidations}
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Remembers the IdP a user picked at the discovery service in a cookie, so the
+next login of that user goes straight to the IdP instead of making the
+two extra round trips through the discovery service.
+"""
+
+import base64
+import logging
+import threading
+from http.cookies import CookieError
+from http.cookies import SimpleCookie
+from urllib.parse import unquote
+
+from s2sproxy.state import InvalidState
+from s2sproxy.state import RelayStateSealer
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Name of the Common Domain Cookie, SAML 2.0 profiles section 4.3.
+COMMON_DOMAIN_COOKIE = "_saml_idp"
+
+
+def is_true(value):
+    return value in (True, "true", "1")
+
+
+class RememberedIdP(object):
+    """
+    Reads and writes the remembered-IdP cookie. The cookie is encrypted and
+    authenticated like the stateless RelayState, and expires after ttl.
+    """
+
+    def __init__(self, keys, ttl=30 * 24 * 3600, cookie_name="s2sproxy_idp",
+                 secure=True, common_domain_cookie=False):
+        """
+        :param keys: Fernet key, or list of keys for key rotation
+        :param ttl: Seconds an IdP is remembered
+        :param cookie_name: Name of the cookie
+        :param secure: Only send the cookie over https
+        :param common_domain_cookie: Also use the most recent IdP in the
+            Common Domain Cookie, if the proxy is in the common domain
+        """
+        self.sealer = RelayStateSealer(keys, ttl)
+        self.ttl = ttl
+        self.cookie_name = cookie_name
+        self.secure = secure
+        self.common_domain_cookie = common_domain_cookie
+
+        self.bypassed = 0
+        self.disco = 0
+        self._lock = threading.Lock()
+
+    def _cookies(self, environ):
+        cookies = SimpleCookie()
+        try:
+            cookies.load(environ.get("HTTP_COOKIE", ""))
+        except CookieError:
+            pass
+        return cookies
+
+    def get(self, environ):
+        """
+        :param environ: WSGI environ
+        :return: The remembered IdP's entity ID or None
+        """
+        cookies = self._cookies(environ)
+        if self.cookie_name in cookies:
+            try:
+                return self.sealer.unseal(
+                    cookies[self.cookie_name].value)["idp"]
+            except (InvalidState, KeyError, TypeError) as err:
+                logger.debug("Ignoring remembered IdP cookie: %s" % err)
+
+        if self.common_domain_cookie and COMMON_DOMAIN_COOKIE in cookies:
+            # Space separated base64 encoded entity IDs, most recent last.
+            value = unquote(cookies[COMMON_DOMAIN_COOKIE].value).strip('"')
+            for encoded in reversed(value.split()):
+                try:
+                    return base64.b64decode(encoded).decode("utf-8")
+                except (ValueError, UnicodeError):
+                    continue
+        return None
+
+    def cookie(self, entity_id):
+        """
+        :return: Set-Cookie header remembering entity_id
+        """
+        value = "%s=%s; Max-Age=%d; Path=/; HttpOnly" % (
+            self.cookie_name, self.sealer.seal({"idp": entity_id}), self.ttl)
+        # Requests from SPs using the HTTP-POST binding are cross-site POSTs,
+        # the cookie is only sent with those if SameSite=None.
+        if self.secure:
+            value += "; Secure; SameSite=None"
+        else:
+            value += "; SameSite=Lax"
+        return "Set-Cookie", value
+
+    def count(self, bypassed):
+        """
+        Count a login that skipped, or went to, the discovery service.
+        """
+        with self._lock:
+            if bypassed:
+                self.bypassed += 1
+            else:
+                self.disco += 1
+
+    def stats(self):
+        total = self.bypassed + self.disco
+        return {"bypassed": self.bypassed, "disco": self.disco,
+                "bypass_rate":
+                    float(self.bypassed) / total if total else 0.0}
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of replayed authentication responses.
+
+The IDs of every accepted response, of its assertions and of the request it
+answers are remembered for a time window in two rotating Bloom filters, so
+memory use doesn't depend on the number of logins. The filters can be kept
+in a memory-mapped file shared by worker processes. Since a Bloom filter can
+report IDs it never saw, a hit is confirmed in an exact set of recent IDs
+when there is one.
+"""
+
+import base64
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from defusedxml import ElementTree
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2.s_utils import decode_base64_and_inflate
+
+from s2sproxy.state import DEFAULT_TTL
+from s2sproxy.state import StateStore
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Default number of IDs remembered per window.
+DEFAULT_CAPACITY = 100000
+# Default probability that an ID never seen is reported as seen.
+DEFAULT_ERROR_RATE = 1e-6
+
+SAMLP_NS = "urn:oasis:names:tc:SAML:2.0:protocol"
+SAML_NS = "urn:oasis:names:tc:SAML:2.0:assertion"
+
+
+class ReplayedResponse(Exception):
+    pass
+
+
+def replay_keys(response_id, in_response_to, assertion_ids):
+    """
+    :return: The keys a response is remembered by
+    """
+    keys = []
+    if response_id:
+        keys.append("response %s" % response_id)
+    if in_response_to:
+        keys.append("in_response_to %s" % in_response_to)
+    for assertion_id in assertion_ids:
+        if assertion_id:
+            keys.append("assertion %s" % assertion_id)
+    return keys
+
+
+def response_keys(saml_response, binding):
+    """
+    The keys of a response as received, read without verifying it.
+    Encrypted assertions are skipped, the response ID covers them.
+
+    :param saml_response: The SAMLResponse parameter
+    :param binding: The binding it came in over
+    :return: A list of keys, empty if the response can't be parsed
+    """
+    try:
+        if binding == BINDING_HTTP_REDIRECT:
+            xml = decode_base64_and_inflate(saml_response)
+        else:
+            xml = base64.b64decode(saml_response)
+        root = ElementTree.fromstring(xml)
+    except Exception as err:
+        logger.debug("Couldn't read the response IDs: %s" % err)
+        return []
+    if root.tag != "{%s}Response" % SAMLP_NS:
+        return []
+    return replay_keys(root.get("ID"), root.get("InResponseTo"),
+                       [assertion.get("ID") for assertion in
+                        root.findall("{%s}Assertion" % SAML_NS)])
+
+
+def verified_keys(response):
+    """
+    :param response: A verified saml2.response.AuthnResponse
+    :return: The keys of the response, with the IDs of decrypted assertions
+    """
+    return replay_keys(response.id(), response.in_response_to,
+                       [assertion.id for assertion in response.assertions])
+
+
+class ReplayCache(object):
+    """
+    Remembers keys for window to 2 * window seconds.
+
+    Time is split in windows, each with its own Bloom filter: keys are added
+    to the filter of the current window and looked up in it and in the one of
+    the previous window. The filter of the window before that is cleared and
+    reused.
+
+    With a path the filters are in a memory-mapped file, for example under
+    /dev/shm, shared by all processes using it and locked with flock.
+    Otherwise they are in the memory of this process.
+
+    A Bloom filter hit is confirmed in recent, an exact store of the keys
+    that should keep them for 2 * window seconds. If recent is shared
+    between the processes sharing the filters a hit missing from it is a
+    false positive, unless recent has had to evict keys. Without recent
+    every hit is taken as a replay. By default an in-memory StateStore is
+    used as recent when the filters aren't shared.
+    """
+
+    MAGIC = b"s2sreply"
+    # Bits per filter, number of hash functions and the window each of the
+    # two filters is for.
+    HEADER = struct.Struct("<8sQIqq")
+
+    def __init__(self, path=None, window=DEFAULT_TTL,
+                 capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 recent=None, timer=time.time):
+        """
+        :param path: File backing the filters, created if missing
+        :param window: Seconds each filter is written to
+        :param capacity: Number of keys added per window the filters are
+            sized for
+        :param error_rate: Probability of a false positive at capacity
+        :param recent: Exact store of the keys (a s2sproxy.state store)
+        :param timer: Function returning the current time in seconds
+        """
+        self.path = path
+        self.window = window
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2 / 8)) * 8
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.filter_size = self.bits // 8
+        self.size = self.HEADER.size + 2 * self.filter_size
+        if recent is None and path is None:
+            recent = StateStore(ttl=2 * window, max_entries=capacity)
+        self.recent = recent
+        self.timer = timer
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+        if path is None:
+            self._map = bytearray(self.size)
+            self._map[:self.HEADER.size] = self._header(-1, -1)
+
+        self.checks = 0
+        self.replays = 0
+        self.false_positives = 0
+
+    def _header(self, epoch0, epoch1):
+        return self.HEADER.pack(self.MAGIC, self.bits, self.hashes, epoch0,
+                                epoch1)
+
+    def _open(self):
+        # Must be called with the thread lock held. flock locks belong to the
+        # open file, so each process needs its own after a fork.
+        if self.path is None or self._pid == os.getpid():
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, self._header(-1, -1), 0)
+            header = self.HEADER.unpack(os.pread(fd, self.HEADER.size, 0))
+            if header[:3] != (self.MAGIC, self.bits, self.hashes):
+                raise ValueError("%s is not a replay cache of %d bits with %d "
+                                 "hashes" % (self.path, self.bits,
+                                             self.hashes))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, operation):
+        with self._lock:
+            self._open()
+            if self._fd is None:
+                yield self._map
+                return
+            fcntl.flock(self._fd, operation)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        h2 |= 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _filters(self, buf, epoch):
+        """
+        :return: Offsets of the filters of this window and the previous one
+            that are in use
+        """
+        epochs = self.HEADER.unpack_from(buf, 0)[3:]
+        return [self.HEADER.size + (e % 2) * self.filter_size
+                for e in (epoch, epoch - 1) if epochs[e % 2] == e]
+
+    def _rotate(self, buf, epoch):
+        # Must be called with the exclusive lock held. Clears the filter of
+        # two windows ago for this window.
+        epochs = list(self.HEADER.unpack_from(buf, 0)[3:])
+        if epochs[epoch % 2] != epoch:
+            start = self.HEADER.size + (epoch % 2) * self.filter_size
+            buf[start:start + self.filter_size] = bytes(self.filter_size)
+            epochs[epoch % 2] = epoch
+            buf[:self.HEADER.size] = self._header(*epochs)
+        return self.HEADER.size + (epoch % 2) * self.filter_size
+
+    def _seen(self, buf, filters, key, indexes):
+        for offset in filters:
+            if all(buf[offset + (i >> 3)] & (1 << (i & 7)) for i in indexes):
+                break
+        else:
+            return False
+
+        if self.recent is None:
+            return True
+        if key in self.recent or self.recent.evictions:
+            return True
+        self.false_positives += 1
+        logger.debug("False positive for %s" % key)
+        return False
+
+    def seen(self, keys):
+        """
+        Check keys without adding them, for a cheap check before verifying
+        a response.
+
+        :return: True if any of the keys was seen before
+        """
+        self.checks += 1
+        epoch = int(self.timer() // self.window)
+        indexes = [(key, self._indexes(key)) for key in keys]
+        with self._locked(fcntl.LOCK_SH) as buf:
+            filters = self._filters(buf, epoch)
+            for key, key_indexes in indexes:
+                if self._seen(buf, filters, key, key_indexes):
+                    self.replays += 1
+                    return True
+        return False
+
+    def add(self, keys):
+        """
+        Add keys, in one step with checking them so of two workers getting
+        the same response only one succeeds.
+
+        :return: True if any of the keys was seen before
+        """
+        epoch = int(self.timer() // self.window)
+        indexes = [(key, self._indexes(key)) for key in keys]
+        replayed = False
+        with self._locked(fcntl.LOCK_EX) as buf:
+            current = self._rotate(buf, epoch)
+            filters = self._filters(buf, epoch)
+            for key, key_indexes in indexes:
+                if not replayed and self._seen(buf, filters, key, key_indexes):
+                    replayed = True
+                for i in key_indexes:
+                    buf[current + (i >> 3)] |= 1 << (i & 7)
+                if self.recent is not None:
+                    self.recent[key] = True
+        if replayed:
+            self.replays += 1
+        return replayed
+
+    def stats(self):
+        return {"checks": self.checks, "replays": self.replays,
+                "false_positives": self.false_positives}
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Suffix marking a route as covering everything below a path.
+PREFIX_MARKER = "/*"
+
+
+class Router(object):
+    """
+    Maps request paths (PATH_INFO without the leading '/') to handler specs.
+
+    Routes are (pattern, spec) tuples, as returned by register_endpoints:
+
+    * "acs/post" matches exactly that path.
+    * "sso/redirect/*" matches any path below "sso/redirect/".
+    * "^...$" is a regular expression, kept for custom routes.
+
+    A path is matched in this order, the first hit wins:
+
+    1. Exact paths, with a dict lookup.
+    2. Prefix routes, with a single precompiled alternation in which longer
+       prefixes are tried before shorter ones.
+    3. Regular expressions, in the order they were added.
+
+    The url_args returned by match() are what the old regex loop put in
+    environ['oic.url_args']: nothing ("") for exact paths, as the old
+    "^acs/post?(.*)$" patterns gave for the endpoints, the rest of the path
+    for prefix routes, and the first group for regular expressions or the
+    whole path if they have none.
+    """
+
+    def __init__(self, routes=()):
+        self.exact = {}
+        self.prefixes = []
+        self.regexes = []
+        self._prefix_re = None
+        self.add_routes(routes)
+
+    def add_routes(self, routes):
+        for pattern, spec in routes:
+            self.add(pattern, spec)
+
+    def add(self, pattern, spec):
+        """
+        Add one route. Routes added first win over later duplicates.
+
+        :param pattern: path, path prefix or regular expression
+        :param spec: what run_entity should be called with
+        """
+        if pattern.startswith("^"):
+            self.regexes.append((re.compile(pattern), spec))
+        elif pattern.endswith(PREFIX_MARKER):
+            prefix = pattern[:-len(PREFIX_MARKER)]
+            if prefix not in [p for p, _ in self.prefixes]:
+                self.prefixes.append((prefix, spec))
+                self._compile_prefixes()
+        elif pattern not in self.exact:
+            self.exact[pattern] = spec
+
+    def _compile_prefixes(self):
+        # Python tries alternatives left to right, so longest first gives
+        # longest-prefix-match. Each alternative has its own named group
+        # which makes match.lastgroup identify the route.
+        ordered = sorted(range(len(self.prefixes)),
+                         key=lambda i: len(self.prefixes[i][0]), reverse=True)
+        alternatives = ["%s/(?P<r%d>.*)" % (re.escape(self.prefixes[i][0]), i)
+                        for i in ordered]
+        self._prefix_re = re.compile("^(?:%s)$" % "|".join(alternatives),
+                                     re.DOTALL)
+
+    def match(self, path):
+        """
+        Find the route for a path.
+
+        :param path: PATH_INFO without the leading '/'
+        :return: a (spec, url_args) tuple, or None if nothing matched
+        """
+        try:
+            return self.exact[path], ""
+        except KeyError:
+            pass
+
+        if self._prefix_re is not None:
+            match = self._prefix_re.match(path)
+            if match is not None:
+                group = match.lastgroup
+                return self.prefixes[int(group[1:])][1], match.group(group)
+
+        for regex, spec in self.regexes:
+            match = regex.search(path)
+            if match is not None:
+                try:
+                    return spec, match.groups()[0]
+                except IndexError:
+                    return spec, path
+
+        return None
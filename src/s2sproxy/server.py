@@ -2,55 +2,345 @@
 
 import importlib
 import logging
-import re
 import sys
 import os
+import time
 import traceback
 
+from saml2.client_base import Base
 from saml2.config import config_factory
 from saml2.httputil import Unauthorized
 from saml2.httputil import NotFound
 
+from saml2.httputil import Response
 from saml2.httputil import ServiceError
+from saml2.server import Server
+from saml2.sigver import get_xmlsec_binary
 
+from s2sproxy.admission import DEFAULT_RETRY_AFTER
+from s2sproxy.admission import DEFAULT_TIMEOUT
+from s2sproxy.admission import AdmissionControl
+from s2sproxy.admission import Overloaded
 from s2sproxy.back import SamlSP
+from s2sproxy.crypto import IN_PROCESS
+from s2sproxy.crypto import XMLSEC1
+from s2sproxy.crypto import InProcessCryptoBackend
+from s2sproxy.crypto import use_crypto_backend
+from s2sproxy.encoding import ResponseEncoder
 from s2sproxy.front import SamlIDP
+from s2sproxy.metadata import MetadataRefresher
+from s2sproxy.metadata import MetadataSnapshot
+from s2sproxy.metadata import load_metadata
+from s2sproxy.metadata import use_metadata
+from s2sproxy.metrics import CONTENT_TYPE
+from s2sproxy.metrics import Metrics
+from s2sproxy.metrics import NULL_METRICS
+from s2sproxy.nameid import DEFAULT_FLUSH_INTERVAL
+from s2sproxy.nameid import NameIDStore
+from s2sproxy.plan import ResponsePlans
+from s2sproxy.pool import CryptoPool
+from s2sproxy.pool import PooledCryptoBackend
+from s2sproxy.release import ReleasePolicies
+from s2sproxy.remember import RememberedIdP
+from s2sproxy.replay import DEFAULT_CAPACITY
+from s2sproxy.replay import ReplayCache
+from s2sproxy.router import Router
+from s2sproxy.service import DEFAULT_BODY_TIMEOUT
+from s2sproxy.service import DEFAULT_MAX_BODY_SIZE
+from s2sproxy.service import BodyError
+from s2sproxy.service import RequestTooLarge
+from s2sproxy.service import content_length
+from s2sproxy.state import DEFAULT_MAX_ENTRIES
+from s2sproxy.state import DEFAULT_TTL
+from s2sproxy.state import RelayStateSealer
+from s2sproxy.state import StateStore
+from s2sproxy.state import batch
 from s2sproxy.util.attribute_module import NoUserData
 
 # Module level logger.
 logger = logging.getLogger(__name__)
 
 class WsgiApplication(object):
-    def __init__(self, config_file, entityid=None, debug=False):
+    def __init__(self, config_file, entityid=None, debug=False, start=True,
+                 metadata_stores=None):
+        """
+        :param config_file: Module name of the proxy configuration, with a
+            directory to import it from
+        :param entityid: The IdP to send all users to, else a discovery
+            service is used
+        :param start: Start the background threads and the crypto pool
+        :param metadata_stores: dict shared by applications that should use
+            one metadata store if their metadata configuration is the same
+        """
         self.urls = []
-        self.cache = {}
         self.debug = debug
+        start_time = time.time()
+
+        sys.path.insert(0, os.path.dirname(config_file))
+        conf = importlib.import_module(os.path.basename(config_file))
 
-        sp_conf = config_factory("sp", config_file)
-        idp_conf = config_factory("idp", config_file)
+        # The SP and IdP configurations share one metadata store, parsed
+        # once or loaded from the snapshot of an earlier start.
+        saml_conf = dict(conf.CONFIG)
+        metadata_conf = saml_conf.pop("metadata", None)
+        sp_conf = config_factory("sp", saml_conf)
+        idp_conf = config_factory("idp", saml_conf)
+        self.metadata_snapshot = None
+        if hasattr(conf, "METADATA_SNAPSHOT"):
+            self.metadata_snapshot = MetadataSnapshot(conf.METADATA_SNAPSHOT)
+        # The store, shared with other applications with the same metadata
+        # configuration through metadata_stores.
+        self.shared_metadata = {}
+        if metadata_conf is not None:
+            if metadata_stores is not None:
+                self.shared_metadata = metadata_stores.setdefault(
+                    repr(metadata_conf), {})
+            if "store" not in self.shared_metadata:
+                self.shared_metadata["store"] = load_metadata(
+                    sp_conf, metadata_conf, self.metadata_snapshot)
+            for saml_config in (sp_conf, idp_conf):
+                use_metadata(saml_config, self.shared_metadata["store"])
 
         self.config = {
             "SP": sp_conf,
             "IDP": idp_conf
         }
 
-        sys.path.insert(0, os.path.dirname(config_file))
-        conf = importlib.import_module(os.path.basename(config_file))
         self.attribute_module = conf.ATTRIBUTE_MODULE
+        # State of in-flight logins, bounded so abandoned logins are dropped.
+        # STATE_STORE can be set to a store shared between processes.
+        self.shared_state = hasattr(conf, "STATE_STORE")
+        if self.shared_state:
+            self.cache = conf.STATE_STORE
+        else:
+            self.cache = StateStore(
+                ttl=getattr(conf, "STATE_TTL", DEFAULT_TTL),
+                max_entries=getattr(conf, "STATE_MAX_ENTRIES",
+                                    DEFAULT_MAX_ENTRIES))
+        # Latency histograms and counters, served on METRICS_PATH.
+        if getattr(conf, "METRICS", False):
+            self.metrics = Metrics()
+            if hasattr(self.cache, "stats"):
+                self.metrics.add_collector("state", self.cache.stats)
+            if hasattr(self.attribute_module, "stats"):
+                self.metrics.add_collector("attributes",
+                                           self.attribute_module.stats)
+        else:
+            self.metrics = NULL_METRICS
         # If entityID is set it means this is a proxy in front of one IdP.
         if entityid:
             self.entity_id = entityid
-            self.sp_args = {}
+            self.sp_args = {"metrics": self.metrics}
         else:
             self.entity_id = None
-            self.sp_args = {"discosrv": conf.DISCO_SRV}
-
-        sp = SamlSP(None, None, self.config["SP"], self.cache, **self.sp_args)
+            self.sp_args = {"discosrv": conf.DISCO_SRV,
+                            "metrics": self.metrics}
+            # Skip the discovery service for users coming back.
+            if hasattr(conf, "REMEMBER_IDP_KEY"):
+                acs = sp_conf.getattr("endpoints", "sp")[
+                    "assertion_consumer_service"]
+                remember = RememberedIdP(
+                    conf.REMEMBER_IDP_KEY,
+                    getattr(conf, "REMEMBER_IDP_TTL", 30 * 24 * 3600),
+                    secure=acs[0][0].startswith("https:"),
+                    common_domain_cookie=getattr(conf, "COMMON_DOMAIN_COOKIE",
+                                                 False))
+                self.sp_args["remember"] = remember
+                self.metrics.add_collector("remembered_idp", remember.stats)
+        # Stateless mode, carry the login state in RelayState.
+        if hasattr(conf, "STATELESS_KEY"):
+            self.sp_args["sealer"] = RelayStateSealer(
+                conf.STATELESS_KEY, getattr(conf, "STATE_TTL", DEFAULT_TTL))
+        # Refuse responses used before. REPLAY_CACHE is a file to share the
+        # filters between processes.
+        if getattr(conf, "REPLAY_DETECTION", False):
+            replay = ReplayCache(
+                getattr(conf, "REPLAY_CACHE", None),
+                window=getattr(conf, "REPLAY_WINDOW",
+                               getattr(conf, "STATE_TTL", DEFAULT_TTL)),
+                capacity=getattr(conf, "REPLAY_CAPACITY", DEFAULT_CAPACITY),
+                recent=getattr(conf, "REPLAY_STORE", None))
+            self.sp_args["replay"] = replay
+            self.metrics.add_collector("replay", replay.stats)
+
+        # The SAML engines are expensive to build (metadata, keys, ident
+        # database) so one of each is created per process and shared by all
+        # requests. The login state of the proxy is kept by SamlSP/SamlIDP in
+        # the store of the request (see state_store). The caches given to the
+        # engines stay in this process: pysaml2 only keeps logout state there,
+        # which the proxy doesn't use, so they aren't part of STATE_STORE.
+        self.sp = Base(self.config["SP"], state_cache=self.cache)
+        # Keep the NameIDs issued in an SQLite database the worker processes
+        # share, instead of the dbm file of subject_data, which isn't opened.
+        self.nameid_store = None
+        if hasattr(conf, "NAMEID_STORE"):
+            self.config["IDP"].setattr("idp", "subject_data", None)
+        self.idp = Server(config=self.config["IDP"], cache=self.cache)
+        if hasattr(conf, "NAMEID_STORE"):
+            self.nameid_store = NameIDStore(
+                conf.NAMEID_STORE,
+                flush_interval=getattr(conf, "NAMEID_FLUSH_INTERVAL",
+                                       DEFAULT_FLUSH_INTERVAL))
+            self.idp.ident.db = self.nameid_store
+            self.metrics.add_collector("nameid", self.nameid_store.stats)
+        # Encrypt the assertions to SPs with an encryption certificate in
+        # their metadata.
+        self.encrypt_assertions = getattr(conf, "ENCRYPT_ASSERTIONS", False)
+        # Issue persistent NameIDs of the proxy's own, one per user and SP,
+        # instead of passing on the NameID from the IdP.
+        self.persistent_nameid = getattr(conf, "PERSISTENT_NAMEID", False)
+        self.nameid_user_attribute = getattr(conf, "NAMEID_USER_ATTRIBUTE",
+                                             None)
+        # Endpoints and bindings of the SPs and IdPs, resolved from the
+        # metadata once per entity.
+        self.idp_plans = ResponsePlans(self.idp)
+        self.sp_args["plans"] = ResponsePlans(self.sp)
+        self.metrics.add_collector("idp_plans", self.idp_plans.stats)
+        self.metrics.add_collector("sp_plans", self.sp_args["plans"].stats)
+        # The attribute release policy, compiled once per SP.
+        self.releases = ReleasePolicies(self.idp, self.idp_plans)
+        self.metrics.add_collector("release_policies", self.releases.stats)
+
+        # Do the crypto in-process instead of running xmlsec1, if asked to.
+        crypto_backend = getattr(conf, "CRYPTO_BACKEND", XMLSEC1)
+        xmlsec_binary = self.config["SP"].xmlsec_binary or \
+            get_xmlsec_binary(self.config["SP"].xmlsec_path)
+        if crypto_backend == IN_PROCESS:
+            backend = InProcessCryptoBackend(xmlsec_binary)
+            for engine in (self.sp, self.idp):
+                use_crypto_backend(engine, backend)
+            self.metrics.add_collector("key_cache", backend.key_cache.stats)
+
+        # Sign and verify in worker processes, to use more than one core.
+        self.crypto_pool = None
+        self.crypto_workers = getattr(conf, "CRYPTO_WORKERS", 0)
+        self.crypto_pool_args = {
+            "backend": crypto_backend,
+            "xmlsec_binary": xmlsec_binary,
+            "max_pending": getattr(conf, "CRYPTO_MAX_PENDING", None),
+            "timeout": getattr(conf, "CRYPTO_TIMEOUT", 10.0)}
+
+        # Pick up metadata changes without a restart, if asked to. A store
+        # shared with other applications is refreshed once for all of them,
+        # by a refresher their owner makes once they are all loaded (see
+        # MultiTenantApplication).
+        self.metadata_conf = metadata_conf
+        self.metadata_refresh_interval = getattr(
+            conf, "METADATA_REFRESH_INTERVAL", None)
+        self.metadata_refresher = None
+        if self.metadata_refresh_interval and (metadata_stores is None or
+                                               metadata_conf is None):
+            self.use_metadata_refresher(MetadataRefresher(
+                self.config["SP"], metadata_conf, [],
+                self.metadata_refresh_interval, self.metadata_snapshot))
+        sp = SamlSP(None, None, self.sp, self.cache, **self.sp_args)
         self.urls.extend(sp.register_endpoints())
 
-        idp = SamlIDP(None, None, self.config["IDP"], self.cache, None)
+        idp = SamlIDP(None, None, self.idp, self.cache, None)
         self.urls.extend(idp.register_endpoints())
 
+        if self.metrics is not NULL_METRICS:
+            self.urls.append((getattr(conf, "METRICS_PATH", "metrics"),
+                              self.metrics_endpoint))
+
+        self.router = Router(self.urls)
+        # Limits on request bodies.
+        self.default_max_body_size = getattr(conf, "MAX_BODY_SIZE",
+                                             DEFAULT_MAX_BODY_SIZE)
+        self.max_body_sizes = getattr(conf, "MAX_BODY_SIZES", {})
+        self.body_timeout = getattr(conf, "BODY_TIMEOUT",
+                                    DEFAULT_BODY_TIMEOUT)
+        # Limits on concurrent requests per endpoint class, if asked for.
+        self.admission = None
+        if hasattr(conf, "ADMISSION_LIMITS"):
+            self.admission = AdmissionControl(
+                conf.ADMISSION_LIMITS,
+                getattr(conf, "ADMISSION_QUEUE_SIZES", None),
+                getattr(conf, "ADMISSION_TIMEOUT", DEFAULT_TIMEOUT),
+                getattr(conf, "ADMISSION_RETRY_AFTER", DEFAULT_RETRY_AFTER))
+            for name, budget in sorted(self.admission.budgets.items()):
+                self.metrics.add_collector("admission_%s" % name,
+                                           budget.stats)
+
+        # Every response gets a Content-Length, and large HTML pages (the
+        # HTTP-POST binding forms) can be compressed.
+        self.encoder = ResponseEncoder(
+            self.dispatch, compress=getattr(conf, "COMPRESS_RESPONSES", False),
+            min_size=getattr(conf, "COMPRESS_MIN_SIZE", 1024))
+        if self.encoder.compress:
+            self.metrics.add_collector("compression", self.encoder.stats)
+        logger.info("Loaded the configuration in %.3f s" %
+                    (time.time() - start_time))
+
+        if start:
+            self.start()
+
+    def use_metadata_refresher(self, refresher):
+        """
+        Swap the metadata reloaded by a refresher into the SAML engines of
+        this application and drop what was resolved from the old metadata.
+
+        :param refresher: MetadataRefresher of the store this application
+            uses
+        """
+        self.metadata_refresher = refresher
+        refresher.engines.extend([self.sp, self.idp])
+        refresher.callbacks.append(self.idp_plans.invalidate)
+        refresher.callbacks.append(self.releases.invalidate)
+        refresher.callbacks.append(self.sp_args["plans"].invalidate)
+        self.metrics.add_collector("metadata", refresher.stats)
+
+    def start(self, crypto_pool=None):
+        """
+        Start the crypto worker pool and the metadata refresher thread.
+
+        Done by the constructor unless start=False, for servers that fork
+        worker processes after loading the configuration: threads and
+        process pools don't survive a fork, so each worker calls this.
+
+        :param crypto_pool: CryptoPool shared with other applications, used
+            instead of starting one
+        """
+        if self.crypto_pool is None:
+            if crypto_pool is None and self.crypto_workers:
+                crypto_pool = CryptoPool(self.crypto_workers,
+                                         **self.crypto_pool_args)
+            if crypto_pool is not None:
+                self.crypto_pool = crypto_pool
+                self.metrics.add_collector("crypto_pool",
+                                           self.crypto_pool.stats)
+                for engine in (self.sp, self.idp):
+                    use_crypto_backend(engine, PooledCryptoBackend(
+                        self.crypto_pool, engine.sec.crypto))
+        if self.metadata_refresher is not None:
+            self.metadata_refresher.start()
+
+    def stop(self):
+        """
+        Stop the metadata refresher and write the NameIDs not written yet.
+
+        Servers call this before the process exits: pre-forked workers end
+        with os._exit, which skips the atexit hook of the NameID store.
+        """
+        if self.metadata_refresher is not None:
+            self.metadata_refresher.stop()
+        if self.nameid_store is not None:
+            self.nameid_store.close()
+
+    def tenant(self, environ):
+        """
+        The application handling a request, this one. See
+        s2sproxy.tenants.MultiTenantApplication.
+        """
+        return self
+
+    def state_store(self, environ):
+        """
+        The store of the login state for a request, the one application set
+        in environ["s2sproxy.state_store"] or else self.cache.
+        """
+        return environ.get("s2sproxy.state_store", self.cache)
+
     def incoming(self, info, environ, start_response, relay_state):
         """
         An Authentication request has been requested, this is the second step
@@ -65,16 +355,24 @@ class WsgiApplication(object):
         """
 
         # If I know which IdP to authenticate at return a redirect to it.
-        inst = SamlSP(environ, start_response, self.config["SP"],
-                      self.cache, self.outgoing, **self.sp_args)
+        inst = SamlSP(environ, start_response, self.sp,
+                      self.state_store(environ), self.outgoing,
+                      **self.sp_args)
         if self.entity_id:
             state_key = inst.store_state(info["authn_req"], relay_state,
                                          info["req_args"])
             return inst.authn_request(self.entity_id, state_key)
-        else:
-            # Start the process by finding out which IdP to authenticate at.
-            return inst.disco_query(info["authn_req"], relay_state,
-                                    info["req_args"])
+
+        # Or if the user picked one the last time.
+        entity_id = inst.remembered_idp(info["req_args"])
+        if entity_id is not None:
+            state_key = inst.store_state(info["authn_req"], relay_state,
+                                         info["req_args"])
+            return inst.authn_request(entity_id, state_key)
+
+        # Start the process by finding out which IdP to authenticate at.
+        return inst.disco_query(info["authn_req"], relay_state,
+                                info["req_args"])
 
     def outgoing(self, response, instance):
         """
@@ -86,16 +384,18 @@ class WsgiApplication(object):
         :return: response
         """
 
-        _idp = SamlIDP(instance.environ, instance.start_response,
-                       self.config["SP"], self.cache, self.outgoing)
+        _idp = SamlIDP(instance.environ, instance.start_response, self.idp,
+                       instance.cache, self.outgoing, self.metrics,
+                       self.idp_plans, self.releases)
 
-        _state = instance.sp.state[response.in_response_to]
-        orig_authn_req, relay_state, req_args = instance.sp.state[_state]
+        # The login is done after this, so consume its state.
+        orig_authn_req, relay_state, req_args = instance.consume_state(
+            response.in_response_to)
 
         # The Subject NameID.
         subject = response.get_subject()
         # Diverse arguments needed to construct the response.
-        resp_args = _idp.idp.response_args(orig_authn_req)
+        resp_args = _idp.plans.response_args(orig_authn_req)
 
         # TODO Slightly awkward, should be done better.
         _authn_info = response.authn_info()[0]
@@ -110,12 +410,25 @@ class WsgiApplication(object):
 
         # This is where any possible modification of the assertion is made.
         try:
-            response.ava = self.attribute_module.get_attributes(response.ava)
+            with self.metrics.phase("get_attributes"):
+                response.ava = self.attribute_module.get_attributes(
+                    response.ava)
         except NoUserData as e:
             logger.error(
                 "User authenticated at IdP but not found by attribute module.")
             raise
 
+        if self.persistent_nameid:
+            with self.metrics.phase("nameid"):
+                subject = self.issue_nameid(self.user_id(response, subject),
+                                            resp_args["sp_entity_id"])
+
+        if self.encrypt_assertions:
+            certs = _idp.plans.plan(resp_args["sp_entity_id"]).encryption_certs
+            if certs:
+                resp_args["encrypt_assertion"] = True
+                resp_args["encrypt_cert_assertion"] = certs[0]
+
         # Will sign the response by default.
         resp = _idp.construct_authn_response(
             response.ava, name_id=subject, authn=_authn,
@@ -123,6 +436,43 @@ class WsgiApplication(object):
 
         return resp
 
+    def user_id(self, response, subject):
+        """
+        The user a persistent NameID is issued for: the value of
+        NAMEID_USER_ATTRIBUTE if set, else the IdP and the NameID it sent.
+
+        :param response: The Authentication response
+        :param subject: The NameID of the response
+        """
+        if self.nameid_user_attribute:
+            values = response.ava.get(self.nameid_user_attribute)
+            if values:
+                return values[0]
+        return "%s!%s" % (response.issuer(), subject.text)
+
+    def issue_nameid(self, userid, sp_entity_id):
+        """
+        The persistent NameID of a user at an SP, made the first time.
+
+        With NAMEID_STORE a user another process enrolled at the same time
+        keeps the NameIDs stored first, so the one to use is read back.
+
+        :param userid: The user, see user_id
+        :param sp_entity_id: The SP
+        """
+        ident = self.idp.ident
+        args = {"sp_name_qualifier": sp_entity_id,
+                "name_qualifier": self.idp.config.entityid}
+        nameid = ident.persistent_nameid(userid, **args)
+        if self.nameid_store is None:
+            return nameid
+        stored = ident.match_local_id(userid, **args)
+        if stored is None:
+            # The other process enrolled the user at another SP, add this
+            # one to it.
+            stored = ident.persistent_nameid(userid, **args)
+        return stored
+
     def run_entity(self, spec, environ, start_response):
         """
         Picks entity and method to run by that entity.
@@ -135,18 +485,111 @@ class WsgiApplication(object):
 
         if isinstance(spec, tuple):
             if spec[0] == "SP":
-                inst = SamlSP(environ, start_response, self.config["SP"],
-                              self.cache,
-                              self.outgoing, **self.sp_args)
+                inst = SamlSP(environ, start_response, self.sp,
+                              self.state_store(environ), self.outgoing,
+                              **self.sp_args)
             else:
-                inst = SamlIDP(environ, start_response, self.config["IDP"],
-                               self.cache,
-                               self.incoming)
+                inst = SamlIDP(environ, start_response, self.idp,
+                               self.state_store(environ), self.incoming,
+                               self.metrics, self.idp_plans, self.releases)
 
             func = getattr(inst, spec[1])
             return func(*spec[2:])
         else:
-            return spec()
+            return spec(environ, start_response)
+
+    def metrics_endpoint(self, environ, start_response):
+        resp = Response(self.metrics.render(), content=CONTENT_TYPE)
+        return resp(environ, start_response)
+
+    def route(self, environ):
+        """
+        Find the handler for a request and set environ['oic.url_args'].
+
+        :param environ: The HTTP application environment
+        :return: A (spec, None) tuple, or (None, response) if the request
+            can't be handled
+        """
+
+        path = environ.get('PATH_INFO', '').lstrip('/')
+        if ".." in path:
+            return None, Unauthorized()
+
+        route = self.router.match(path)
+        if route is None:
+            logger.debug("unknown side: %s" % path)
+            return None, NotFound("Couldn't find the side you asked for!")
+
+        spec, environ['oic.url_args'] = route
+
+        # Refuse too large bodies before reading them.
+        max_body_size = self.max_body_size(spec)
+        environ["s2sproxy.max_body_size"] = max_body_size
+        environ["s2sproxy.body_timeout"] = self.body_timeout
+        length = content_length(environ)
+        if length is not None and length > max_body_size:
+            return None, Response("Request body too large",
+                                  status=RequestTooLarge.status)
+        return spec, None
+
+    def max_body_size(self, spec):
+        """
+        Largest request body accepted by an endpoint, from MAX_BODY_SIZES by
+        endpoint name (e.g. "SP/authn_response/post") or entity ("SP",
+        "IDP"), else MAX_BODY_SIZE.
+        """
+        if isinstance(spec, tuple):
+            for key in ("/".join(spec), spec[0]):
+                if key in self.max_body_sizes:
+                    return self.max_body_sizes[key]
+        return self.default_max_body_size
+
+    def handle(self, spec, environ, start_response):
+        """
+        Run the handler of a routed request, errors are turned into a
+        ServiceError unless in debug mode.
+
+        :param spec: The spec returned by route
+        :param environ: The HTTP application environment
+        :param start_response: WSGI start_response
+        :return: The response as a list of lines
+        """
+
+        if isinstance(spec, tuple):
+            self.metrics.request("/".join(spec))
+        budget = None
+        if self.admission is not None:
+            try:
+                with self.metrics.phase("admission"):
+                    budget = self.admission.acquire(spec)
+            except Overloaded as err:
+                self.metrics.error(err)
+                logger.info("Shed request: %s" % err)
+                resp = Response("%s" % err, status=err.status,
+                                headers=[("Retry-After",
+                                          "%d" % self.admission.retry_after)])
+                return resp(environ, start_response)
+        try:
+            with batch(self.state_store(environ)):
+                return self.run_entity(spec, environ, start_response)
+        except BodyError as err:
+            self.metrics.error(err)
+            logger.info("Rejected request: %s" % err)
+            resp = Response("%s" % err, status=err.status)
+            return resp(environ, start_response)
+        except Exception as err:
+            self.metrics.error(err)
+            if not self.debug:
+                print("%s" % err, file=sys.stderr)
+                traceback.print_exc()
+                logger.exception("%s" % err)
+                resp = ServiceError("%s" % err)
+                return resp(environ, start_response)
+            else:
+                raise
+        finally:
+            if budget is not None:
+                budget.release()
 
     def run_server(self, environ, start_response):
         """
@@ -157,37 +600,20 @@ class WsgiApplication(object):
         :param environ: The HTTP application environment
         :param start_response: The application to run when the handling of the
             request is done
-        :return: The response as a list of lines
+        :return: The response body as a list with one bytes object
         """
+        return self.encoder(environ, start_response)
 
-        path = environ.get('PATH_INFO', '').lstrip('/')
-        if ".." in path:
-            resp = Unauthorized()
+    def dispatch(self, environ, start_response):
+        """
+        Route and handle a request, the response isn't finished by the
+        encoder yet.
+        """
+        with self.metrics.phase("routing"):
+            spec, resp = self.route(environ)
+        if resp is not None:
             return resp(environ, start_response)
-
-        for regex, spec in self.urls:
-            match = re.search(regex, path)
-            if match is not None:
-                try:
-                    environ['oic.url_args'] = match.groups()[0]
-                except IndexError:
-                    environ['oic.url_args'] = path
-
-                try:
-                    return self.run_entity(spec, environ, start_response)
-                except Exception as err:
-                    if not self.debug:
-                        print("%s" % err, file=sys.stderr)
-                        traceback.print_exc()
-                        logger.exception("%s" % err)
-                        resp = ServiceError("%s" % err)
-                        return resp(environ, start_response)
-                    else:
-                        raise
-
-        logger.debug("unknown side: %s" % path)
-        resp = NotFound("Couldn't find the side you asked for!")
-        return resp(environ, start_response)
+        return self.handle(spec, environ, start_response)
 
     # Utility method to ease integration with mod_wsgi for
     # Apache HTTP Server by providing an 'application' 
@@ -196,12 +622,13 @@ class WsgiApplication(object):
     def application(self, environ, start_response):
         """
         """
-        # In mod_wsgi deployments use the Beaker session for saving
-        # and retrieving state rather than a simple dictionary since
-        # later invocations may be made to an entirely different
-        # process. The Beaker session middleware can be configured
-        # to use different mechanisms including files and client-side
-        # cookies for storing state.
-        self.cache = environ['beaker.session']
-
-        return [s.encode('UTF-8') for s in self.run_server(environ, start_response)]
+        # In mod_wsgi deployments later invocations may be made to an
+        # entirely different process, so the state must be shared. Without
+        # a shared STATE_STORE in the configuration fall back to the Beaker
+        # session, which the Beaker session middleware can be configured to
+        # keep in files or client-side cookies. It's passed with the request,
+        # the application and its engines are shared by all threads.
+        if not self.shared_state:
+            environ["s2sproxy.state_store"] = environ['beaker.session']
+
+        return self.run_server(environ, start_response)
@@ -2,18 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import socket
+import time
 from urllib.parse import parse_qs
+from urllib.parse import unquote_plus
+from urllib.parse import unquote_to_bytes
 
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2 import BINDING_SOAP
 from saml2 import BINDING_HTTP_POST
 from saml2.extension.idpdisc import BINDING_DISCO
-from saml2.httputil import get_post
 from saml2.httputil import SeeOther
 from saml2.httputil import ServiceError
 from saml2.httputil import Response
 from saml2.httputil import BadRequest
 
+from s2sproxy.metrics import NULL_METRICS
+
 # Module level logger.
 logger = logging.getLogger(__name__)
 
@@ -27,13 +32,130 @@ BINDING_MAP = {
 
 INV_BINDING_MAP = {v: k for k, v in BINDING_MAP.items()}
 
+# Largest request body read, in bytes, unless the route sets another limit in
+# environ["s2sproxy.max_body_size"].
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+# Seconds reading a request body may take, environ["s2sproxy.body_timeout"].
+DEFAULT_BODY_TIMEOUT = 30
+# Form fields used by the SAML bindings, the rest of a form is skipped.
+SAML_FIELDS = frozenset(["SAMLRequest", "SAMLResponse", "RelayState"])
+CHUNK_SIZE = 256 * 1024
+
+
+class BodyError(Exception):
+    """
+    The request body can't be read, answered with status.
+    """
+    status = "400 Bad Request"
+
+
+class RequestTooLarge(BodyError):
+    status = "413 Payload Too Large"
+
+
+class RequestTimeout(BodyError):
+    status = "408 Request Timeout"
+
+
+def content_length(environ):
+    """
+    :return: The declared body size or None if not given
+    """
+    try:
+        return int(environ.get("CONTENT_LENGTH") or "")
+    except ValueError:
+        return None
+
+
+def read_body(environ):
+    """
+    Read the request body in chunks, giving up as soon as it is larger than
+    the limit or takes too long to arrive.
+
+    A client that stops sending is cut off by the server's socket timeout,
+    which proxy_server sets to at most BODY_TIMEOUT. The deadline here
+    catches a body that keeps trickling in.
+
+    :return: The body as bytes
+    :raise RequestTooLarge: If the body is larger than the limit
+    :raise RequestTimeout: If the body arrives too slowly
+    """
+    max_size = environ.get("s2sproxy.max_body_size", DEFAULT_MAX_BODY_SIZE)
+    deadline = time.monotonic() + environ.get("s2sproxy.body_timeout",
+                                              DEFAULT_BODY_TIMEOUT)
+    length = content_length(environ)
+    if length is None:
+        # Only read to the end if the server marks where it is. One byte
+        # more than allowed shows the body is too large.
+        if not environ.get("wsgi.input_terminated"):
+            return b""
+        to_read = max_size + 1
+    elif length > max_size:
+        raise RequestTooLarge("Request body of %d bytes, the limit is %d" %
+                              (length, max_size))
+    else:
+        to_read = length
+
+    stream = environ["wsgi.input"]
+    body = b""
+    while len(body) < to_read:
+        try:
+            chunk = stream.read(min(CHUNK_SIZE, to_read - len(body)))
+        except socket.timeout:
+            raise RequestTimeout("Request body not received in time")
+        if not chunk:
+            break
+        if not body:
+            body = chunk
+        else:
+            # Grown in place, instead of joining a list of chunks.
+            if not isinstance(body, bytearray):
+                body = bytearray(body)
+            body += chunk
+        if len(body) > max_size:
+            raise RequestTooLarge("Request body larger than %d bytes" %
+                                  max_size)
+        if time.monotonic() > deadline:
+            raise RequestTimeout("Request body not received in time")
+    return bytes(body)
+
+
+def parse_form(body, fields=SAML_FIELDS):
+    """
+    Get some fields from an application/x-www-form-urlencoded body. Only
+    those fields are copied and decoded. Like parse_qs, the first non-empty
+    value is used.
+
+    :param body: The body, bytes or bytearray
+    :param fields: Names of the fields to get
+    :return: dict
+    """
+    result = {}
+    start = 0
+    end = len(body)
+    while start < end:
+        stop = body.find(b"&", start)
+        if stop < 0:
+            stop = end
+        eq = body.find(b"=", start, stop)
+        if 0 <= eq < stop - 1:
+            name = unquote_plus(bytes(body[start:eq]).decode("utf-8",
+                                                             "replace"))
+            if name in fields and name not in result:
+                value = unquote_to_bytes(
+                    bytes(memoryview(body)[eq + 1:stop]).replace(b"+", b" "))
+                result[name] = value.decode("utf-8", "replace")
+        start = stop + 1
+    return result
+
 
 class Service(object):
     # Common operations that all services need.
-    def __init__(self, environ, start_response):
+    def __init__(self, environ, start_response, metrics=None):
         self.environ = environ
         logger.debug("ENVIRON: %s" % environ)
         self.start_response = start_response
+        self.metrics = metrics or NULL_METRICS
 
     def unpack(self, binding):
         if binding == "redirect":
@@ -47,23 +169,25 @@ class Service(object):
 
     def unpack_redirect(self):
         if "QUERY_STRING" in self.environ:
-            _qs = self.environ["QUERY_STRING"]
-            return dict([(k, v[0]) for k, v in parse_qs(_qs).items()])
+            with self.metrics.phase("unpack_redirect"):
+                _qs = self.environ["QUERY_STRING"]
+                return dict([(k, v[0]) for k, v in parse_qs(_qs).items()])
         else:
             return None
 
     def unpack_post(self):
-        post_body = get_post(self.environ).decode("utf-8")
-        _dict = parse_qs(post_body)
-        logger.debug("unpack_post:: %s" % _dict)
         try:
-            return dict([(k, v[0]) for k, v in _dict.items()])
+            with self.metrics.phase("unpack_post"):
+                _dict = parse_form(read_body(self.environ))
         except IOError:
             return None
+        logger.debug("unpack_post:: %s" % _dict)
+        return _dict
 
     def unpack_soap(self):
         try:
-            query = get_post(self.environ)
+            with self.metrics.phase("unpack_soap"):
+                query = read_body(self.environ)
             return {"SAMLResponse": query, "RelayState": ""}
         except IOError:
             return None
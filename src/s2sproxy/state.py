@@ -0,0 +1,678 @@
+# -*- coding: utf-8 -*-
+"""
+Stores for the state of in-flight logins.
+
+Every store is a dictionary replacement usable wherever the proxy and pysaml2
+expect a plain dict as cache. StateStore keeps the state in the memory of one
+process, SQLiteStateStore and MmapStateStore share it between processes so
+the two legs of a login can be handled by different workers.
+"""
+
+import fcntl
+import hashlib
+import importlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
+from cryptography.fernet import MultiFernet
+from saml2 import SamlBase
+from saml2 import create_class_from_xml_string
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Default lifetime of an in-flight login, in seconds.
+DEFAULT_TTL = 600
+# Default maximum number of entries kept.
+DEFAULT_MAX_ENTRIES = 10000
+
+# Key marking values that JSON can't represent natively.
+_TYPE_KEY = "__s2sproxy__"
+# Marks a pending deletion in a write batch.
+_DELETED = object()
+
+
+class InvalidState(Exception):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, SamlBase):
+        # Stored as XML, pysaml2 objects are large and slow to pickle.
+        cls = type(value)
+        return {_TYPE_KEY: "saml",
+                "class": "%s.%s" % (cls.__module__, cls.__name__),
+                "xml": "%s" % value}
+    elif isinstance(value, tuple):
+        return {_TYPE_KEY: "tuple", "items": [_encode(v) for v in value]}
+    elif isinstance(value, list):
+        return [_encode(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((k, _encode(v)) for k, v in value.items())
+    return value
+
+
+def _decode(obj):
+    kind = obj.get(_TYPE_KEY)
+    if kind == "tuple":
+        return tuple(obj["items"])
+    elif kind == "saml":
+        module, name = obj["class"].rsplit(".", 1)
+        if module != "saml2" and not module.startswith("saml2."):
+            raise ValueError("Not a pysaml2 class: %s" % obj["class"])
+        cls = getattr(importlib.import_module(module), name)
+        return create_class_from_xml_string(cls, obj["xml"])
+    return obj
+
+
+def dumps(value):
+    """
+    Serialize a state value: strings, numbers, lists, tuples, dicts and
+    pysaml2 message objects.
+
+    :return: bytes
+    """
+    return json.dumps(_encode(value), separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    """
+    Inverse of dumps.
+    """
+    return json.loads(data.decode("utf-8"), object_hook=_decode)
+
+
+@contextmanager
+def batch(cache):
+    """
+    Buffer the writes made to cache within the block if it supports it, the
+    cache may also be a plain dict or a Beaker session.
+    """
+    if isinstance(cache, StateBackend):
+        with cache.batch():
+            yield
+    else:
+        yield
+
+
+class StateBackend(MutableMapping):
+    """
+    Interface of the login state stores.
+    """
+
+    def __init__(self, ttl, max_entries):
+        """
+        :param ttl: Seconds an entry is kept after it was written
+        :param max_entries: Maximum number of entries kept
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @contextmanager
+    def batch(self):
+        """
+        Writes made by this thread within the block may be buffered and
+        written together when the block exits.
+        """
+        yield
+
+    def stats(self):
+        return {"entries": len(self), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations}
+
+
+class StateStore(StateBackend):
+    """
+    In-memory store, for a single process.
+
+    Entries expire ttl seconds after they were written and the number of
+    entries is capped at max_entries, evicting the least recently used ones
+    first, so abandoned logins don't make memory grow without limit.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 timer=time.monotonic):
+        """
+        :param ttl: Seconds an entry is kept after it was written
+        :param max_entries: Maximum number of entries kept
+        :param timer: Function returning the current time in seconds
+        """
+        StateBackend.__init__(self, ttl, max_entries)
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        # Must be called with the lock held.
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        if expires <= now:
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        return value
+
+    def _prune(self, now):
+        # Must be called with the lock held. Expired entries are removed from
+        # the least recently used end, others are expired lazily on access.
+        while self._data:
+            key, (expires, _) = next(iter(self._data.items()))
+            if expires <= now:
+                del self._data[key]
+                self.expirations += 1
+            elif len(self._data) > self.max_entries:
+                del self._data[key]
+                self.evictions += 1
+            else:
+                break
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._get(key, self.timer())
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            now = self.timer()
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._prune(now)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __iter__(self):
+        with self._lock:
+            self._purge(self.timer())
+            return iter(list(self._data))
+
+    def __len__(self):
+        # Only the live entries, expired ones are purged first.
+        with self._lock:
+            self._purge(self.timer())
+            return len(self._data)
+
+    def pop(self, key, *default):
+        """
+        Remove an entry and return its value, used to consume the state of a
+        login once it is done.
+        """
+        with self._lock:
+            try:
+                value = self._get(key, self.timer())
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+            del self._data[key]
+            return value
+
+    def _purge(self, now):
+        # Must be called with the lock held.
+        expired = [k for k, (expires, _) in self._data.items()
+                   if expires <= now]
+        for key in expired:
+            del self._data[key]
+        self.expirations += len(expired)
+
+    def purge(self):
+        """
+        Remove all expired entries.
+        """
+        with self._lock:
+            self._purge(self.timer())
+
+
+class SharedStateStore(StateBackend):
+    """
+    Base for stores shared between processes. Values are serialized with
+    dumps, so only their XML is stored for pysaml2 objects, and writes made
+    within batch() are written together when the block exits.
+
+    Subclasses implement _read, _write, _take and _keys.
+    """
+
+    def __init__(self, ttl, max_entries, timer=time.time):
+        StateBackend.__init__(self, ttl, max_entries)
+        # Wall clock, the expiry times are compared between processes.
+        self.timer = timer
+        self._local = threading.local()
+
+    def _read(self, key):
+        """
+        :return: The serialized value, or None if missing or expired
+        """
+        raise NotImplementedError
+
+    def _write(self, items):
+        """
+        :param items: dict of key -> serialized value, None deletes the key
+        """
+        raise NotImplementedError
+
+    def _take(self, key):
+        """
+        Read and delete an entry, atomically so only one worker gets it.
+
+        :return: The serialized value, or None if missing or expired
+        """
+        raise NotImplementedError
+
+    def _keys(self):
+        raise NotImplementedError
+
+    def _pending(self):
+        return getattr(self._local, "pending", None)
+
+    def __getitem__(self, key):
+        pending = self._pending()
+        if pending is not None and key in pending:
+            value = pending[key]
+            if value is _DELETED:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return value
+
+        data = self._read(key)
+        if data is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return loads(data)
+
+    def __setitem__(self, key, value):
+        pending = self._pending()
+        if pending is not None:
+            pending[key] = value
+        else:
+            self._write({key: dumps(value)})
+
+    def __delitem__(self, key):
+        pending = self._pending()
+        if pending is not None:
+            pending[key] = _DELETED
+        else:
+            self._write({key: None})
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def pop(self, key, *default):
+        """
+        Remove an entry and return its value, used to consume the state of a
+        login once it is done. Only one of the workers popping the same key
+        gets the value, even within batch().
+        """
+        pending = self._pending()
+        if pending is not None and key in pending:
+            value = pending[key]
+            pending[key] = _DELETED
+            if value is not _DELETED:
+                self.hits += 1
+                return value
+        else:
+            data = self._take(key)
+            if data is not None:
+                self.hits += 1
+                return loads(data)
+
+        self.misses += 1
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    @contextmanager
+    def batch(self):
+        if self._pending() is not None:
+            # Nested, the outermost block writes.
+            yield
+            return
+
+        self._local.pending = OrderedDict()
+        try:
+            yield
+        finally:
+            pending = self._local.pending
+            self._local.pending = None
+            if pending:
+                self._write(OrderedDict(
+                    (k, None if v is _DELETED else dumps(v))
+                    for k, v in pending.items()))
+
+
+class SQLiteStateStore(SharedStateStore):
+    """
+    Store in an SQLite database in WAL mode, for workers on one host.
+
+    When max_entries is exceeded the entries closest to expiry, which are
+    the oldest ones, are evicted.
+    """
+
+    # Number of writes between checks of the number of entries.
+    CAP_INTERVAL = 100
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+                 timeout=5.0, timer=time.time):
+        """
+        :param path: Database file, created if missing
+        :param timeout: Seconds to wait for a lock held by another worker
+        """
+        SharedStateStore.__init__(self, ttl, max_entries, timer)
+        self.path = path
+        self.timeout = timeout
+        self._writes = 0
+
+    def _connection(self):
+        # One connection per thread, and new ones after a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS state "
+                         "(key TEXT PRIMARY KEY, expires REAL, value BLOB)")
+            conn.execute("CREATE INDEX IF NOT EXISTS state_expires "
+                         "ON state (expires)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _read(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE key = ? AND expires > ?",
+            (key, self.timer())).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _write(self, items):
+        conn = self._connection()
+        now = self.timer()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, data in items.items():
+                if data is None:
+                    conn.execute("DELETE FROM state WHERE key = ?", (key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                                 (key, now + self.ttl, data))
+            self._prune(conn, now)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _take(self, key):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM state WHERE key = ? AND expires > ?",
+                (key, self.timer())).fetchone()
+            conn.execute("DELETE FROM state WHERE key = ?", (key,))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if row is None:
+            return None
+        return row[0]
+
+    def _prune(self, conn, now):
+        cur = conn.execute("DELETE FROM state WHERE expires <= ?", (now,))
+        self.expirations += cur.rowcount
+
+        self._writes += 1
+        if self._writes % self.CAP_INTERVAL == 0:
+            count = conn.execute("SELECT COUNT(*) FROM state").fetchone()[0]
+            if count > self.max_entries:
+                cur = conn.execute(
+                    "DELETE FROM state WHERE key IN "
+                    "(SELECT key FROM state ORDER BY expires LIMIT ?)",
+                    (count - self.max_entries,))
+                self.evictions += cur.rowcount
+
+    def _keys(self):
+        return [row[0] for row in self._connection().execute(
+            "SELECT key FROM state WHERE expires > ?", (self.timer(),))]
+
+
+class MmapStateStore(SharedStateStore):
+    """
+    Store in a memory-mapped file, for example under /dev/shm, shared by
+    workers forked from one process.
+
+    The file is a fixed size hash table of slots slot_size bytes each, so
+    max_entries is the number of slots. A key can be in any of PROBES slots
+    after the one its hash points to; when they are all live, the one
+    closest to expiry is evicted. Access is serialized with flock.
+    """
+
+    MAGIC = b"s2sstat1"
+    HEADER = struct.Struct("<8sII")
+    # Key hash (0 means free), expiry time, key length, value length.
+    SLOT = struct.Struct("<QdHI")
+    PROBES = 8
+
+    def __init__(self, path, ttl=DEFAULT_TTL, slots=4096, slot_size=4096,
+                 timer=time.time):
+        """
+        :param path: File backing the table, created if missing
+        :param slots: Number of entries the table can hold
+        :param slot_size: Bytes per entry, including key and metadata
+        """
+        SharedStateStore.__init__(self, ttl, slots, timer)
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.size = self.HEADER.size + slots * slot_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # Must be called with the thread lock held. flock locks belong to the
+        # open file, so each process needs its own after a fork.
+        if self._pid == os.getpid():
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.slots,
+                                               self.slot_size), 0)
+            header = self.HEADER.unpack(os.pread(fd, self.HEADER.size, 0))
+            if header != (self.MAGIC, self.slots, self.slot_size):
+                raise ValueError("%s is not a state table with %d slots of "
+                                 "%d bytes" % (self.path, self.slots,
+                                               self.slot_size))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, operation):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, operation)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return struct.unpack("<Q", digest)[0] or 1
+
+    def _offsets(self, key_hash):
+        first = key_hash % self.slots
+        for i in range(min(self.PROBES, self.slots)):
+            yield self.HEADER.size + ((first + i) % self.slots) * self.slot_size
+
+    def _slot_key(self, buf, offset, key_len):
+        start = offset + self.SLOT.size
+        return buf[start:start + key_len]
+
+    def _read(self, key):
+        key_b = key.encode("utf-8")
+        key_hash = self._hash(key_b)
+        with self._locked(fcntl.LOCK_SH) as buf:
+            now = self.timer()
+            for offset in self._offsets(key_hash):
+                h, expires, key_len, data_len = self.SLOT.unpack_from(buf, offset)
+                if (h == key_hash and expires > now and
+                        self._slot_key(buf, offset, key_len) == key_b):
+                    start = offset + self.SLOT.size + key_len
+                    return buf[start:start + data_len]
+        return None
+
+    def _write(self, items):
+        with self._locked(fcntl.LOCK_EX) as buf:
+            now = self.timer()
+            for key, data in items.items():
+                self._write_one(buf, now, key.encode("utf-8"), data)
+
+    def _take(self, key):
+        key_b = key.encode("utf-8")
+        key_hash = self._hash(key_b)
+        with self._locked(fcntl.LOCK_EX) as buf:
+            now = self.timer()
+            for offset in self._offsets(key_hash):
+                h, expires, key_len, data_len = self.SLOT.unpack_from(buf, offset)
+                if (h == key_hash and
+                        self._slot_key(buf, offset, key_len) == key_b):
+                    start = offset + self.SLOT.size + key_len
+                    data = buf[start:start + data_len]
+                    self.SLOT.pack_into(buf, offset, 0, 0, 0, 0)
+                    return data if expires > now else None
+        return None
+
+    def _write_one(self, buf, now, key_b, data):
+        key_hash = self._hash(key_b)
+        if data is not None and (self.SLOT.size + len(key_b) + len(data) >
+                                 self.slot_size):
+            raise ValueError("State entry of %d bytes doesn't fit in a slot of "
+                             "%d bytes" % (len(data), self.slot_size))
+
+        target = None
+        target_expires = None
+        for offset in self._offsets(key_hash):
+            h, expires, key_len, _ = self.SLOT.unpack_from(buf, offset)
+            if h == key_hash and self._slot_key(buf, offset, key_len) == key_b:
+                target = offset
+                break
+            if data is None:
+                continue
+            if h == 0 or expires <= now:
+                if target_expires is None or target_expires > 0:
+                    target, target_expires = offset, 0
+            elif target_expires is None or expires < target_expires:
+                target, target_expires = offset, expires
+
+        if data is None:
+            if target is not None:
+                self.SLOT.pack_into(buf, target, 0, 0, 0, 0)
+            return
+
+        h, expires, _, _ = self.SLOT.unpack_from(buf, target)
+        if h != 0 and h != key_hash:
+            if expires <= now:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+        self.SLOT.pack_into(buf, target, key_hash, now + self.ttl, len(key_b),
+                            len(data))
+        start = target + self.SLOT.size
+        buf[start:start + len(key_b) + len(data)] = key_b + data
+
+    def _keys(self):
+        keys = []
+        with self._locked(fcntl.LOCK_SH) as buf:
+            now = self.timer()
+            for i in range(self.slots):
+                offset = self.HEADER.size + i * self.slot_size
+                h, expires, key_len, _ = self.SLOT.unpack_from(buf, offset)
+                if h != 0 and expires > now:
+                    keys.append(self._slot_key(buf, offset, key_len).decode("utf-8"))
+        return keys
+
+
+class RelayStateSealer(object):
+    """
+    Stateless mode: instead of being kept in a store, the state of a login is
+    compressed, encrypted and authenticated (with Fernet) into a token that
+    travels upstream as RelayState and comes back with the response.
+
+    Tokens are longer than the 80 bytes the SAML bindings allow for
+    RelayState, so the upstream IdPs must accept long values.
+    """
+
+    def __init__(self, keys, ttl=DEFAULT_TTL):
+        """
+        :param keys: Fernet key, or list of keys where the first one seals
+            and all of them unseal, for key rotation
+        :param ttl: Seconds a token is valid
+        """
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        self.fernet = MultiFernet([Fernet(key) for key in keys])
+        self.ttl = ttl
+
+    def seal(self, value):
+        """
+        :param value: Anything dumps can serialize
+        :return: URL safe token
+        """
+        token = self.fernet.encrypt(zlib.compress(dumps(value)))
+        return token.decode("ascii")
+
+    def unseal(self, token):
+        """
+        :return: The sealed value
+        :raise InvalidState: If the token is forged, corrupt or expired
+        """
+        try:
+            data = self.fernet.decrypt(token.encode("ascii"), ttl=self.ttl)
+        except (InvalidToken, UnicodeError, AttributeError):
+            raise InvalidState("Unknown or expired login state")
+        return loads(zlib.decompress(data))
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Several proxies, each with its own entityID, keys, endpoints and attribute
+module, served by one process.
+
+Each tenant is a WsgiApplication with its own proxy configuration. Tenants
+with the same metadata configuration share one metadata store, parsed once
+and refreshed once for all of them, and all tenants share one crypto worker
+pool, so a tenant costs little more than its own SAML engines.
+
+A request goes to the tenant of its path prefix, else to the one of its
+Host header, else to the tenant with neither (the default) if there is one.
+The endpoints in the configuration of a tenant with a path prefix must be
+under that prefix.
+"""
+
+import importlib
+import logging
+import os
+import sys
+
+from saml2.httputil import NotFound
+
+from s2sproxy.metadata import MetadataRefresher
+from s2sproxy.pool import CryptoPool
+from s2sproxy.server import WsgiApplication
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+
+def host_name(environ):
+    """
+    :return: The lowercase host of the Host header, without the port
+    """
+    host = environ.get("HTTP_HOST") or environ.get("SERVER_NAME", "")
+    # Not the colons of an IPv6 address without a port.
+    if ":" in host and not host.endswith("]"):
+        host = host.rsplit(":", 1)[0]
+    return host.lower()
+
+
+class MultiTenantApplication(object):
+    def __init__(self, tenants, debug=False, start=True):
+        """
+        :param tenants: List of dicts, one per tenant, with "config" (the
+            proxy configuration, as for WsgiApplication), and optionally
+            "entityid" (the IdP to send all users to), "host" and "path"
+            (the path prefix, without slashes). Each configuration module
+            must have a name of its own.
+        :param start: Start the background threads and the crypto pool
+        """
+        self.metadata_stores = {}
+        self.apps = []
+        self.routes = {}
+        self.crypto_pool = None
+        keys = [(tenant.get("host", "").lower() or None,
+                 tenant.get("path", "").strip("/") or None)
+                for tenant in tenants]
+        for key in set(keys):
+            if keys.count(key) > 1:
+                raise ValueError("Two tenants for host %s and path %s" % key)
+
+        for key, tenant in zip(keys, tenants):
+            app = WsgiApplication(tenant["config"], tenant.get("entityid"),
+                                  debug, start=False,
+                                  metadata_stores=self.metadata_stores)
+            self.apps.append(app)
+            self.routes[key] = app
+        logger.info("Loaded %d tenants with %d metadata stores" %
+                    (len(self.apps), len(self.metadata_stores)))
+
+        # One refresher per shared metadata store, with the shortest
+        # METADATA_REFRESH_INTERVAL of the tenants using it. Made once all
+        # tenants are loaded, so every one of them follows the reloads.
+        self.metadata_refreshers = []
+        for shared in self.metadata_stores.values():
+            apps = [app for app in self.apps if app.shared_metadata is shared]
+            intervals = [app.metadata_refresh_interval for app in apps
+                         if app.metadata_refresh_interval]
+            if not intervals:
+                continue
+            refresher = MetadataRefresher(
+                apps[0].config["SP"], apps[0].metadata_conf, [],
+                min(intervals), apps[0].metadata_snapshot)
+            for app in apps:
+                app.use_metadata_refresher(refresher)
+            self.metadata_refreshers.append(refresher)
+
+        if start:
+            self.start()
+
+    @classmethod
+    def from_config(cls, config_file, debug=False, start=True):
+        """
+        :param config_file: Module with the list of tenants as TENANTS
+        """
+        sys.path.insert(0, os.path.dirname(config_file))
+        conf = importlib.import_module(os.path.basename(config_file))
+        return cls(conf.TENANTS, debug, start)
+
+    def start(self):
+        """
+        Start one crypto worker pool, as large as the largest CRYPTO_WORKERS
+        of the tenants, and the background threads of the tenants. See
+        WsgiApplication.start.
+        """
+        with_workers = [app for app in self.apps if app.crypto_workers]
+        if with_workers and self.crypto_pool is None:
+            self.crypto_pool = CryptoPool(
+                max(app.crypto_workers for app in with_workers),
+                **with_workers[0].crypto_pool_args)
+        for app in self.apps:
+            app.start(self.crypto_pool)
+
+    def stop(self):
+        """
+        Stop the tenants, see WsgiApplication.stop.
+        """
+        for app in self.apps:
+            app.stop()
+
+    def tenant(self, environ):
+        """
+        :return: The WsgiApplication of the tenant a request is for, or None
+        """
+        host = host_name(environ)
+        prefix = environ.get("PATH_INFO", "").lstrip("/").split("/", 1)[0]
+        for key in ((host, prefix), (None, prefix), (host, None),
+                    (None, None)):
+            app = self.routes.get(key)
+            if app is not None:
+                return app
+        return None
+
+    def run_server(self, environ, start_response):
+        """
+        The WSGI application.
+        """
+        app = self.tenant(environ)
+        if app is None:
+            logger.debug("No tenant for %s" % environ.get("HTTP_HOST"))
+            resp = NotFound("Couldn't find the side you asked for!")
+            return resp(environ, start_response)
+        return app.run_server(environ, start_response)
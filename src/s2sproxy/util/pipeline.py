@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative attribute transformations, compiled once at startup into a
+single function instead of being interpreted on every login.
+
+A pipeline is a list of steps, applied in order:
+
+    ("rename", {"email": "mail"})              rename attributes
+    ("static", {"o": ["Small university"]})    add/replace with fixed values
+    ("keep", ["mail", "sn"])                   drop all other attributes
+    ("drop", ["norEduPersonNIN"])              drop these attributes
+    ("rewrite", "mail", r"@old$", "@new")      regex substitution on values
+    ("scope", "eduPersonAffiliation", "example.com")
+                                               add @scope to unscoped values
+"""
+
+import hashlib
+import logging
+import re
+
+from s2sproxy.state import StateStore
+from s2sproxy.util.attribute_module import AttributeModule
+from s2sproxy.util.attribute_module import NoUserData
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+
+def _values(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _rename(translation):
+    translation = dict(translation)
+
+    def step(attributes):
+        for name, new_name in translation.items():
+            if name in attributes:
+                attributes[new_name] = attributes.pop(name)
+    return step
+
+
+def _static(values):
+    values = dict((name, _values(value)) for name, value in values.items())
+
+    def step(attributes):
+        for name, value in values.items():
+            attributes[name] = list(value)
+    return step
+
+
+def _keep(names):
+    names = frozenset(names)
+
+    def step(attributes):
+        for name in [n for n in attributes if n not in names]:
+            del attributes[name]
+    return step
+
+
+def _drop(names):
+    names = tuple(names)
+
+    def step(attributes):
+        for name in names:
+            attributes.pop(name, None)
+    return step
+
+
+def _rewrite(name, pattern, replacement):
+    regex = re.compile(pattern)
+
+    def step(attributes):
+        if name in attributes:
+            attributes[name] = [regex.sub(replacement, value)
+                                for value in attributes[name]]
+    return step
+
+
+def _scope(name, scope):
+    suffix = "@%s" % scope
+
+    def step(attributes):
+        if name in attributes:
+            attributes[name] = [value if "@" in value else value + suffix
+                                for value in attributes[name]]
+    return step
+
+
+STEPS = {
+    "rename": _rename,
+    "static": _static,
+    "keep": _keep,
+    "drop": _drop,
+    "rewrite": _rewrite,
+    "scope": _scope,
+}
+
+
+def compile_pipeline(steps):
+    """
+    Compile a list of steps into a function taking the attributes and
+    returning the transformed attributes. The argument isn't modified.
+
+    :raise ValueError: For unknown steps
+    """
+    compiled = []
+    for spec in steps:
+        try:
+            factory = STEPS[spec[0]]
+        except KeyError:
+            raise ValueError("Unknown attribute pipeline step '%s'" % spec[0])
+        compiled.append(factory(*spec[1:]))
+    compiled = tuple(compiled)
+
+    def pipeline(attributes):
+        attributes = dict((name, _values(value))
+                          for name, value in attributes.items())
+        for step in compiled:
+            step(attributes)
+        return attributes
+    return pipeline
+
+
+class PipelineAttributes(AttributeModule):
+    """
+    Transforms the attributes with a compiled pipeline, optionally after
+    another attribute module added the user's attributes.
+
+    With cache_ttl the resulting attributes are cached per user and the
+    attributes the IdP released, so repeat logins within the TTL with the
+    same attributes skip the source lookup and the pipeline. Attributes the
+    source adds may be up to cache_ttl seconds old.
+    """
+
+    def __init__(self, steps, source=None, user_id_attribute=None,
+                 cache_ttl=None, cache_size=10000):
+        """
+        :param steps: The pipeline, see the module documentation
+        :param source: AttributeModule applied before the pipeline
+        :param user_id_attribute: IdP attribute identifying the user, part
+            of the cache key; required with cache_ttl
+        :param cache_ttl: Seconds results are cached, no caching if None
+        :param cache_size: Maximum number of users cached
+        """
+        self.pipeline = compile_pipeline(steps)
+        self.source = source
+        self.user_id_attribute = user_id_attribute
+        self.cache = None
+        if cache_ttl:
+            if not user_id_attribute:
+                raise ValueError("cache_ttl requires user_id_attribute")
+            self.cache = StateStore(ttl=cache_ttl, max_entries=cache_size)
+
+    def _transform(self, idp_attributes):
+        if self.source is not None:
+            idp_attributes = self.source.get_attributes(idp_attributes)
+        return self.pipeline(idp_attributes)
+
+    def get_attributes(self, idp_attributes):
+        if self.cache is None:
+            return self._transform(idp_attributes)
+
+        try:
+            user_id = idp_attributes[self.user_id_attribute][0]
+        except (KeyError, IndexError):
+            raise NoUserData(
+                "Necessary attribute '{}' not returned by IdP.".format(
+                    self.user_id_attribute))
+        # The result depends on all the attributes, not only the user id:
+        # two IdPs may release the same id for different users, and an IdP
+        # may release changed attributes.
+        key = "%s!%s" % (user_id, self._digest(idp_attributes))
+        try:
+            attributes = self.cache[key]
+        except KeyError:
+            attributes = self._transform(idp_attributes)
+            self.cache[key] = attributes
+        # Callers may modify the result.
+        return dict((name, list(value)) for name, value in attributes.items())
+
+    @staticmethod
+    def _digest(idp_attributes):
+        items = sorted((name, _values(value))
+                       for name, value in idp_attributes.items())
+        return hashlib.sha256(repr(items).encode("utf-8")).hexdigest()
+
+    def stats(self):
+        if self.cache is None:
+            return {}
+        stats = self.cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Attribute module backed by a prebuilt SQLite index of the users, for
+directories too large to load into every worker. Lookups are B-tree
+searches on the user id, and the file is memory-mapped so all processes share
+the pages through the OS page cache.
+
+Build or replace the index with:
+
+    python -m s2sproxy.util.user_store users.json users.db
+    python -m s2sproxy.util.user_store --id-column uid users.csv users.db
+
+The new index is written next to the old one and renamed over it, and running
+proxies switch to it within CHECK_INTERVAL seconds without a restart.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from s2sproxy.util.attribute_module import AttributeModule
+from s2sproxy.util.attribute_module import NoUserData
+
+# Module level logger.
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for a new index file.
+CHECK_INTERVAL = 5
+# Bytes of the index to memory-map.
+MMAP_SIZE = 1 << 30
+
+
+class UserStoreAttributes(AttributeModule):
+    """
+    Adds the attributes of the user, looked up by the value of
+    idp_attribute_name, to those released by the IdP.
+    """
+
+    def __init__(self, path, idp_attribute_name,
+                 check_interval=CHECK_INTERVAL):
+        """
+        :param path: Index file made with build()
+        :param idp_attribute_name: IdP attribute with the user id
+        :param check_interval: Seconds between checks for a new index file
+        """
+        self.path = path
+        self.idp_attribute_name = idp_attribute_name
+        self.check_interval = check_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file_id = self._stat()
+        self._generation = 0
+        self._checked = time.time()
+        # Fail at startup, not at the first login, if the index is missing.
+        self._connection().execute("SELECT 1 FROM users LIMIT 1")
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_dev, st.st_ino
+
+    def _check(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            try:
+                file_id = self._stat()
+            except OSError as err:
+                logger.error("User index %s not found, keeping the open one: "
+                             "%s" % (self.path, err))
+                return
+            if file_id != self._file_id:
+                logger.info("User index %s replaced, reopening" % self.path)
+                self._file_id = file_id
+                self._generation += 1
+
+    def _connection(self):
+        local = self._local
+        if (getattr(local, "pid", None) != os.getpid() or
+                local.generation != self._generation):
+            if getattr(local, "connection", None) is not None and \
+                    local.pid == os.getpid():
+                local.connection.close()
+            local.connection = sqlite3.connect(
+                "file:%s?mode=ro" % self.path, uri=True)
+            local.connection.execute("PRAGMA mmap_size=%d" % MMAP_SIZE)
+            local.generation = self._generation
+            local.pid = os.getpid()
+        return local.connection
+
+    def lookup(self, user_id):
+        """
+        :return: The attributes of the user, None if unknown
+        """
+        self._check()
+        row = self._connection().execute(
+            "SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_attributes(self, idp_attributes):
+        try:
+            user_id = idp_attributes[self.idp_attribute_name][0]
+        except KeyError:
+            raise NoUserData(
+                "Necessary attribute '{}' not returned by IdP.".format(
+                    self.idp_attribute_name))
+
+        user_data = self.lookup(user_id)
+        if user_data is None:
+            raise NoUserData("Unknown user id '{}'".format(user_id))
+
+        idp_attributes.update(user_data)
+        return idp_attributes
+
+
+def read_json(path):
+    """
+    Users from a JSON object of user id -> {attribute: [values]}.
+    """
+    with open(path) as f:
+        users = json.load(f)
+    for user_id, attributes in users.items():
+        yield user_id, attributes
+
+
+def read_csv(path, id_column, separator=";"):
+    """
+    Users from a CSV file with a header row. Each column other than
+    id_column is an attribute, multiple values are separated by separator.
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            user_id = row.pop(id_column)
+            attributes = {}
+            for name, value in row.items():
+                values = [v for v in (value or "").split(separator) if v]
+                if values:
+                    attributes[name] = values
+            yield user_id, attributes
+
+
+def build(users, path):
+    """
+    Write an index and atomically replace path with it.
+
+    :param users: Iterable of (user id, attributes)
+    :param path: Index file
+    :return: Number of users
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".users-", suffix=".db", dir=directory)
+    os.close(fd)
+    try:
+        db = sqlite3.connect(tmp)
+        db.execute("PRAGMA journal_mode=OFF")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("CREATE TABLE users (id TEXT PRIMARY KEY, data TEXT NOT "
+                   "NULL) WITHOUT ROWID")
+        count = 0
+        batch = []
+        for user_id, attributes in users:
+            batch.append((user_id, json.dumps(attributes)))
+            if len(batch) == 10000:
+                db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)",
+                               batch)
+                count += len(batch)
+                batch = []
+        db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)", batch)
+        count += len(batch)
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the user index for UserStoreAttributes.")
+    parser.add_argument("--id-column", dest="id_column",
+                        help="Column with the user id, for CSV input.")
+    parser.add_argument("--separator", default=";",
+                        help="Separator of multiple values in a CSV column.")
+    parser.add_argument(dest="source", help="JSON or CSV export of the users.")
+    parser.add_argument(dest="index", help="Index file to create or replace.")
+    args = parser.parse_args()
+
+    if args.source.endswith(".csv"):
+        if not args.id_column:
+            parser.error("--id-column is required for CSV input")
+        users = read_csv(args.source, args.id_column, args.separator)
+    else:
+        users = read_json(args.source)
+
+    start = time.time()
+    count = build(users, args.index)
+    print("Wrote %d users to %s in %.1f s" % (count, args.index,
+                                              time.time() - start),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
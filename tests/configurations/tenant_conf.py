@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A second proxy, served under the path prefix "b" next to the one of
+proxy_conf, with the same metadata.
+"""
+import copy
+
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2 import BINDING_HTTP_POST
+
+from tests.configurations import proxy_conf
+
+BASE = 'https://example.com/b'
+
+ATTRIBUTE_MODULE = proxy_conf.ATTRIBUTE_MODULE
+
+CONFIG = copy.deepcopy(proxy_conf.CONFIG)
+CONFIG["entityid"] = "{}/proxy.xml".format(BASE)
+CONFIG["service"]["idp"]["endpoints"] = {
+    "single_sign_on_service": [
+        ("%s/sso/redirect" % BASE, BINDING_HTTP_REDIRECT),
+        ("%s/sso/post" % BASE, BINDING_HTTP_POST),
+    ],
+}
+CONFIG["service"]["sp"]["endpoints"] = {
+    "assertion_consumer_service": [
+        ("%s/acs/post" % BASE, BINDING_HTTP_POST),
+        ("%s/acs/redirect" % BASE, BINDING_HTTP_REDIRECT)
+    ],
+}
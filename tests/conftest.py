@@ -1,2 +1,22 @@
 # pylint: skip-file
+import pytest
+
+import tests.configurations.proxy_conf as proxy_conf
+from s2sproxy.server import WsgiApplication
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+
 collect_ignore = ["test_requirements.txt"]
+
+
+@pytest.fixture
+def make_app(monkeypatch):
+    """
+    Makes a WsgiApplication of the test proxy configuration, with settings
+    added to it for the test.
+    """
+    def make_app(entityid=IDP_ENTITY_ID, start=True, **settings):
+        for name, value in settings.items():
+            monkeypatch.setattr(proxy_conf, name, value, raising=False)
+        return WsgiApplication(PROXY_CONF, entityid, start=start)
+    return make_app
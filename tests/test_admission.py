@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from s2sproxy.admission import AdmissionControl
+from s2sproxy.admission import Budget
+from s2sproxy.admission import Overloaded
+from tests.test_util import FakeSP
+from tests.test_util import call
+
+
+def test_budget_queue():
+    budget = Budget("acs", 1, queue_size=1, timeout=10)
+    budget.acquire()
+
+    waiter = threading.Thread(target=budget.acquire)
+    waiter.start()
+    while not budget.waiting:
+        time.sleep(0.001)
+    # The queue is full, shed right away.
+    with pytest.raises(Overloaded):
+        budget.acquire()
+
+    budget.release()
+    waiter.join()
+    assert budget.stats() == {"limit": 1, "running": 1, "waiting": 0,
+                              "admitted": 2, "shed": 1, "timeouts": 0}
+
+
+def test_budget_timeout():
+    budget = Budget("acs", 1, timeout=0.01)
+    with budget.slot():
+        with pytest.raises(Overloaded):
+            budget.acquire()
+    assert budget.stats()["timeouts"] == 1
+    assert budget.stats()["running"] == 0
+
+
+def test_route_classes():
+    admission = AdmissionControl({"acs": 1})
+    assert admission.budget(("SP", "authn_response", "post")) is \
+        admission.budgets["acs"]
+    assert admission.budget(("IDP", "handle_authn_request", "redirect")) is None
+    assert admission.budget(lambda environ, start_response: None) is None
+
+
+def test_shed_with_retry_after(make_app):
+    app = make_app(ADMISSION_LIMITS={"acs": 1},
+                   ADMISSION_QUEUE_SIZES={"acs": 0})
+    sp = FakeSP("tests.configurations.sp_conf")
+
+    with app.admission.budgets["acs"].slot():
+        status, headers, _ = call(app.run_server,
+                                  "https://example.com/acs/post", "POST",
+                                  b"SAMLResponse=x")
+        assert status.startswith("503")
+        assert dict(headers)["Retry-After"] == "1"
+
+        # Other endpoint classes aren't held up.
+        status, _, _ = call(app.run_server, sp.make_auth_req())
+        assert status.startswith("303")
+
+    assert app.admission.budgets["acs"].stats()["shed"] == 1
@@ -0,0 +1,151 @@
+import asyncio
+import http.client
+import socket
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+import pytest
+import uvicorn
+
+from s2sproxy.asgi import AsgiApplication
+from s2sproxy.asgi import build_environ
+from s2sproxy.asgi import create_app
+from s2sproxy.server import WsgiApplication
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import idp_response
+from tests.test_util import sp_response
+
+
+def call(app, url, method="GET", body=b""):
+    parts = urlsplit(url)
+    scope = {"type": "http", "method": method, "path": parts.path,
+             "query_string": parts.query.encode("latin-1"),
+             "headers": [(b"host", parts.netloc.encode("latin-1")),
+                         (b"content-type",
+                          b"application/x-www-form-urlencoded")],
+             "server": ("localhost", 8090), "client": ("127.0.0.1", 1234)}
+    # The body arrives in two parts.
+    messages = [{"type": "http.request", "body": body[:10],
+                 "more_body": True},
+                {"type": "http.request", "body": body[10:]}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, body = sent
+    return start["status"], dict(start["headers"]), body["body"]
+
+
+@pytest.fixture(scope="module")
+def app():
+    return AsgiApplication(WsgiApplication(PROXY_CONF, IDP_ENTITY_ID))
+
+
+def test_build_environ():
+    scope = {"type": "http", "method": "POST", "path": "/a/b",
+             "query_string": b"x=%C3%A5",
+             "headers": [(b"host", b"proxy.example.com"),
+                         (b"content-type", b"text/plain"),
+                         (b"x-forwarded-for", b"10.0.0.1"),
+                         (b"x-forwarded-for", b"10.0.0.2"),
+                         (b"cookie", b"beaker.session.id=abc"),
+                         (b"cookie", b"_saml_idp=aWRw")],
+             "scheme": "https", "server": ("127.0.0.1", 8443)}
+    environ = build_environ(scope, b"body")
+
+    assert environ["REQUEST_METHOD"] == "POST"
+    assert environ["PATH_INFO"] == "/a/b"
+    assert environ["QUERY_STRING"] == "x=%C3%A5"
+    assert environ["HTTP_HOST"] == "proxy.example.com"
+    assert environ["CONTENT_TYPE"] == "text/plain"
+    assert environ["CONTENT_LENGTH"] == "4"
+    assert environ["HTTP_X_FORWARDED_FOR"] == "10.0.0.1,10.0.0.2"
+    assert environ["HTTP_COOKIE"] == "beaker.session.id=abc; _saml_idp=aWRw"
+    assert sorted(SimpleCookie(environ["HTTP_COOKIE"])) == [
+        "_saml_idp", "beaker.session.id"]
+    assert environ["wsgi.url_scheme"] == "https"
+    assert environ["wsgi.input"].read() == b"body"
+
+
+def test_unknown_path(app):
+    status, _, _ = call(app, "http://localhost:8090/nothing/here")
+    assert status == 404
+
+
+def test_flow(app):
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+
+    status, headers, _ = call(app, sp.make_auth_req())
+    assert status == 303
+    action, form = idp_response(idp, headers[b"location"].decode())
+    status, headers, _ = call(app, action, "POST",
+                              urlencode(form).encode("utf-8"))
+    assert status == 302
+
+    resp = sp_response(sp, headers[b"location"].decode())
+    assert resp.ava["displayName"][0] == "Test1"
+
+
+def test_too_large_body(app, monkeypatch):
+    monkeypatch.setattr(app.app, "default_max_body_size", 15)
+    status, _, _ = call(app, "http://localhost:8090/acs/post", "POST",
+                        b"SAMLResponse=" + b"x" * 10)
+    assert status == 413
+
+
+def request(port, url, method="GET", body=None):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    headers = {"Host": parts.netloc}
+    if body is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    conn.request(method, "%s?%s" % (parts.path, parts.query), body, headers)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp.status, resp.getheader("Location")
+
+
+def test_uvicorn(monkeypatch):
+    monkeypatch.setenv("S2SPROXY_CONFIG", PROXY_CONF)
+    monkeypatch.setenv("S2SPROXY_ENTITYID", IDP_ENTITY_ID)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_app, factory=True,
+                                           log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]})
+    thread.start()
+    try:
+        deadline = time.time() + 30
+        while not server.started and thread.is_alive() and \
+                time.time() < deadline:
+            time.sleep(0.1)
+        assert server.started
+
+        sp = FakeSP("tests.configurations.sp_conf")
+        idp = FakeIdP(USERS)
+        status, location = request(port, sp.make_auth_req())
+        assert status == 303
+        action, form = idp_response(idp, location)
+        status, location = request(port, action, "POST", urlencode(form))
+        assert status == 302
+        resp = sp_response(sp, location)
+        assert resp.ava["displayName"][0] == "Test1"
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
@@ -0,0 +1,186 @@
+import base64
+import os
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+import pytest
+from saml2 import class_name
+from saml2.s_utils import decode_base64_and_inflate
+from saml2.saml import Assertion
+from saml2.saml import Issuer
+from saml2.samlp import Response
+from saml2.sigver import CryptoBackendXmlSec1
+from saml2.sigver import DecryptError
+from saml2.sigver import SigverError
+from saml2.sigver import XmlsecError
+from saml2.sigver import get_xmlsec_binary
+from saml2.sigver import pre_encryption_part
+from saml2.sigver import pre_signature_part
+
+pytest.importorskip("xmlsec")
+
+import tests.configurations.proxy_conf as proxy_conf
+import tests.configurations.sp_conf as sp_conf
+from s2sproxy.crypto import IN_PROCESS
+from s2sproxy.crypto import InProcessCryptoBackend
+from s2sproxy.crypto import KeyCache
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import call
+from tests.test_util import location
+from tests.test_util import login_response
+from tests.test_util import sp_response
+
+PKI = os.path.join(os.path.dirname(__file__), "pki")
+KEY_FILE = os.path.join(PKI, "key.pem")
+CERT_FILE = os.path.join(PKI, "cert.pem")
+
+
+def xmlsec1_backend():
+    try:
+        return CryptoBackendXmlSec1(get_xmlsec_binary())
+    except SigverError:
+        pytest.skip("xmlsec1 not installed")
+
+
+def response(text="https://idp.example.com"):
+    return Response(id="id-1", version="2.0",
+                    issue_instant="2015-01-01T00:00:00Z",
+                    issuer=Issuer(text=text),
+                    signature=pre_signature_part("id-1", None, 1))
+
+
+NODE_NAME = class_name(response())
+
+
+def test_sign_and_verify():
+    backend = InProcessCryptoBackend()
+    signed = backend.sign_statement(response(), NODE_NAME, KEY_FILE, "id-1")
+    assert backend.validate_signature(signed, CERT_FILE, "pem", NODE_NAME,
+                                      "id-1")
+
+
+def test_tampered_document_fails():
+    backend = InProcessCryptoBackend()
+    signed = backend.sign_statement(response(), NODE_NAME, KEY_FILE, "id-1")
+    tampered = signed.replace("idp.example.com", "evil.example.com")
+    with pytest.raises(XmlsecError):
+        backend.validate_signature(tampered, CERT_FILE, "pem", NODE_NAME,
+                                   "id-1")
+
+
+def test_keys_are_parsed_once():
+    backend = InProcessCryptoBackend()
+    for _ in range(3):
+        signed = backend.sign_statement(response(), NODE_NAME, KEY_FILE,
+                                        "id-1")
+        backend.validate_signature(signed, CERT_FILE, "pem", NODE_NAME, "id-1")
+    assert backend.key_cache.loads == 2
+
+
+def test_in_process_signature_verifies_with_xmlsec1():
+    signed = InProcessCryptoBackend().sign_statement(response(), NODE_NAME,
+                                                     KEY_FILE, "id-1")
+    assert xmlsec1_backend().validate_signature(signed, CERT_FILE, "pem",
+                                                NODE_NAME, "id-1")
+
+
+def test_xmlsec1_signature_verifies_in_process():
+    signed = xmlsec1_backend().sign_statement(response(), NODE_NAME, KEY_FILE,
+                                              "id-1")
+    assert InProcessCryptoBackend().validate_signature(
+        signed, CERT_FILE, "pem", NODE_NAME, "id-1")
+
+
+def encrypted_response():
+    statement = Response(
+        id="id-1", version="2.0", issue_instant="2015-01-01T00:00:00Z",
+        issuer=Issuer(text="https://idp.example.com"),
+        assertion=Assertion(id="id-2", version="2.0",
+                            issue_instant="2015-01-01T00:00:00Z",
+                            issuer=Issuer(text="https://idp.example.com")))
+    return statement, pre_encryption_part()
+
+
+@pytest.mark.parametrize("encrypt_with_xmlsec1", [True, False])
+def test_encryption_interoperates(encrypt_with_xmlsec1):
+    backend = InProcessCryptoBackend()
+    xmlsec1 = xmlsec1_backend()
+    encrypter, decrypter = (xmlsec1, backend) if encrypt_with_xmlsec1 else \
+        (backend, xmlsec1)
+
+    statement, template = encrypted_response()
+    encrypted = encrypter.encrypt_assertion(statement, CERT_FILE, template)
+    assert 'ID="id-2"' not in encrypted
+    decrypted = decrypter.decrypt(encrypted, KEY_FILE)
+    assert 'ID="id-2"' in decrypted
+
+
+def test_decryption_keys_are_parsed_once():
+    backend = InProcessCryptoBackend()
+    for _ in range(3):
+        statement, template = encrypted_response()
+        encrypted = backend.encrypt_assertion(statement, CERT_FILE, template)
+        backend.decrypt(encrypted, KEY_FILE)
+    # The key, the certificate and a keys manager for each.
+    assert backend.key_cache.loads == 4
+
+    with pytest.raises(DecryptError):
+        backend.decrypt(encrypted.replace("CipherValue>", "CipherValue>AAAA",
+                                          1), KEY_FILE)
+
+
+def test_encrypted_assertions_both_legs(monkeypatch, make_app):
+    keypairs = [{"key_file": KEY_FILE, "cert_file": CERT_FILE}]
+    monkeypatch.setitem(proxy_conf.CONFIG, "encryption_keypairs", keypairs)
+    monkeypatch.setitem(sp_conf.CONFIG, "encryption_keypairs", keypairs)
+    app = make_app(CRYPTO_BACKEND=IN_PROCESS, ENCRYPT_ASSERTIONS=True)
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+
+    with open(CERT_FILE) as f:
+        cert = f.read()
+    action, form = login_response(app.run_server, sp, idp,
+                                  encrypt_assertion=True,
+                                  encrypt_cert_assertion=cert)
+    assert b"EncryptedAssertion" in base64.b64decode(form["SAMLResponse"])
+    status, headers, _ = call(app.run_server, action, "POST",
+                              urlencode(form).encode("utf-8"))
+    assert status.startswith("302")
+
+    req = parse_qs(urlsplit(location(headers)).query)
+    xml = decode_base64_and_inflate(req["SAMLResponse"][0])
+    assert b"EncryptedAssertion" in xml
+    assert b"test1@valueA" not in xml
+    resp = sp_response(sp, location(headers))
+    assert resp.ava["sn"] == ["test1@valueA"]
+
+
+def test_certificate_read_once(monkeypatch):
+    key_cache = KeyCache()
+    key_cache.certificate(CERT_FILE)
+
+    def no_open(*args):
+        raise AssertionError("read again")
+    monkeypatch.setattr("builtins.open", no_open)
+    assert key_cache.certificate(CERT_FILE) is key_cache.certificate(CERT_FILE)
+    key_cache.certificate_manager(CERT_FILE)
+    assert key_cache.loads == 2
+
+
+def test_key_cache_bounded(tmpdir):
+    key_cache = KeyCache(max_size=4)
+    with open(CERT_FILE) as f:
+        pem = f.read()
+    # pysaml2 writes the certificates from metadata to new temporary files.
+    for i in range(10):
+        path = str(tmpdir.join("cert%d.pem" % i))
+        with open(path, "w") as f:
+            f.write(pem)
+        key_cache.certificate(path)
+    stats = key_cache.stats()
+    assert stats["entries"] == 4
+    assert stats["loads"] == 1
+    assert stats["evictions"] == 7
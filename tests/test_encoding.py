@@ -0,0 +1,106 @@
+import gzip
+from urllib.parse import urlencode
+
+import pytest
+from saml2 import BINDING_HTTP_POST
+from saml2 import BINDING_HTTP_REDIRECT
+
+from s2sproxy.encoding import ResponseEncoder
+from s2sproxy.encoding import negotiate
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import call
+from tests.test_util import login_response
+
+PAGE = b"<html>" + b"<p>hello</p>" * 200 + b"</html>"
+
+
+def test_negotiate():
+    assert negotiate("gzip, deflate, br", ["br", "gzip"]) == "br"
+    assert negotiate("gzip, deflate", ["br", "gzip"]) == "gzip"
+    assert negotiate("br;q=0.5, gzip", ["br", "gzip"]) == "gzip"
+    assert negotiate("gzip;q=0", ["gzip"]) is None
+    assert negotiate("*", ["gzip"]) == "gzip"
+    assert negotiate("", ["gzip"]) is None
+
+
+def page_app(body, content_type="text/html", status="200 OK"):
+    def app(environ, start_response):
+        start_response(status, [("Content-Type", content_type)])
+        return [body.decode("utf-8"), b""]
+    return app
+
+
+def test_content_length():
+    app = ResponseEncoder(page_app(PAGE))
+    status, headers, body = call(app, "https://example.com/")
+    assert body == PAGE
+    headers = dict(headers)
+    assert headers["Content-Length"] == str(len(PAGE))
+    assert "Content-Encoding" not in headers
+    assert "Vary" not in headers
+
+
+def test_gzip():
+    app = ResponseEncoder(page_app(PAGE), compress=True)
+
+    def get(accept_encoding):
+        def wrapped(environ, start_response):
+            environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+            return app(environ, start_response)
+        _, headers, body = call(wrapped, "https://example.com/")
+        return dict(headers), body
+
+    headers, body = get("gzip")
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    assert headers["Content-Length"] == str(len(body))
+    assert gzip.decompress(body) == PAGE
+
+    headers, body = get("identity")
+    assert "Content-Encoding" not in headers
+    assert body == PAGE
+    assert app.stats()["compressed"] == 1
+
+
+@pytest.mark.parametrize("app", [
+    page_app(b"<html></html>"),
+    page_app(PAGE, content_type="text/plain"),
+    page_app(PAGE, status="500 Internal Server Error")])
+def test_not_compressed(app):
+    def wrapped(environ, start_response):
+        environ["HTTP_ACCEPT_ENCODING"] = "gzip"
+        return ResponseEncoder(app, compress=True)(environ, start_response)
+    _, headers, _ = call(wrapped, "https://example.com/")
+    assert "Content-Encoding" not in dict(headers)
+
+
+def test_compressed_post_form(make_app):
+    app = make_app(COMPRESS_RESPONSES=True)
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+
+    # Ask for the response with the HTTP-POST binding.
+    _, destination = sp.pick_binding(
+        "single_sign_on_service", [BINDING_HTTP_REDIRECT], "idpsso",
+        entity_id="https://example.com/proxy.xml")
+    _, authn_req = sp.create_authn_request(destination,
+                                           binding=BINDING_HTTP_POST)
+    ht_args = sp.apply_binding(BINDING_HTTP_REDIRECT, "%s" % authn_req,
+                               destination, relay_state="hello")
+    action, form = login_response(app.run_server, sp, idp,
+                                  url=ht_args["headers"][0][1])
+
+    def accept_gzip(environ, start_response):
+        environ["HTTP_ACCEPT_ENCODING"] = "gzip"
+        return app.run_server(environ, start_response)
+
+    status, headers, body = call(accept_gzip, action, "POST",
+                                 urlencode(form).encode("utf-8"))
+    assert status.startswith("200")
+    headers = dict(headers)
+    assert headers["Content-Encoding"] == "gzip"
+    page = gzip.decompress(body)
+    assert b"SAMLResponse" in page
+    assert len(body) < len(page)
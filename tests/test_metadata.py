@@ -0,0 +1,144 @@
+import hashlib
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+from saml2.client_base import Base
+from saml2.config import config_factory
+
+from s2sproxy.metadata import MetadataRefresher
+from s2sproxy.metadata import MetadataSnapshot
+from s2sproxy.metadata import load_metadata
+from s2sproxy.server import WsgiApplication
+
+CONFIGURATIONS = os.path.join(os.path.dirname(__file__), "configurations")
+
+
+def test_refresh_swaps_changed_metadata(tmpdir):
+    shutil.copy(os.path.join(CONFIGURATIONS, "unittest_idp.xml"), str(tmpdir))
+    config = config_factory("sp", "tests.configurations.proxy_conf")
+    engine = Base(config)
+    refresher = MetadataRefresher(config, {"local": [str(tmpdir)]}, [engine])
+
+    assert not refresher.refresh()
+
+    shutil.copy(os.path.join(CONFIGURATIONS, "unittest_sp.xml"), str(tmpdir))
+    old = engine.metadata
+    assert refresher.refresh()
+    assert engine.metadata is not old
+    assert engine.metadata is engine.sec.metadata is config.metadata
+    assert "http://example.com/unittest_sp.xml" in engine.metadata.keys()
+    assert refresher.stats()["entities"] == 2
+    assert refresher.stats()["loads"] == 1
+
+
+def test_failed_reload_keeps_old_metadata(tmpdir):
+    metadata = tmpdir.join("md.xml")
+    shutil.copy(os.path.join(CONFIGURATIONS, "unittest_idp.xml"), str(metadata))
+    config = config_factory("sp", "tests.configurations.proxy_conf")
+    engine = Base(config)
+    refresher = MetadataRefresher(config, {"local": [str(metadata)]}, [engine])
+
+    old = engine.metadata
+    metadata.write("not xml")
+    assert not refresher.refresh()
+    assert engine.metadata is old
+    assert refresher.stats()["failures"] == 1
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    # Serves self.server.document with an ETag.
+    def do_GET(self):
+        document = self.server.document
+        etag = '"%s"' % hashlib.sha256(document).hexdigest()
+        self.server.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(document)))
+        self.end_headers()
+        self.wfile.write(document)
+
+    def log_message(self, *args):
+        pass
+
+
+def read(name):
+    with open(os.path.join(CONFIGURATIONS, name), "rb") as f:
+        return f.read()
+
+
+def test_refresh_remote_only_when_changed():
+    server = HTTPServer(("127.0.0.1", 0), MetadataHandler)
+    server.document = read("unittest_idp.xml")
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:%d/md.xml" % server.server_port
+        metadata_conf = {"remote": [{"url": url}]}
+        config = config_factory("sp", "tests.configurations.proxy_conf")
+        config.metadata = load_metadata(config, metadata_conf)
+        engine = Base(config)
+        fetched = len(server.requests)
+        refresher = MetadataRefresher(config, metadata_conf, [engine])
+        # Not fetched until the refresher runs.
+        assert len(server.requests) == fetched
+
+        # Unchanged, answered with 304 and not reloaded.
+        assert not refresher.refresh()
+        assert server.requests[-1] is not None
+        assert refresher.stats()["unchanged"] == 1
+
+        server.document = read("unittest_sp.xml")
+        assert refresher.refresh()
+        assert "http://example.com/unittest_sp.xml" in engine.metadata.keys()
+        assert not refresher.refresh()
+        assert refresher.stats()["loads"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_snapshot(tmpdir):
+    metadata = tmpdir.join("md.xml")
+    shutil.copy(os.path.join(CONFIGURATIONS, "unittest_idp.xml"), str(metadata))
+    metadata_conf = {"local": [str(metadata)]}
+    config = config_factory("sp", "tests.configurations.proxy_conf")
+    snapshot = MetadataSnapshot(str(tmpdir.join("md.snapshot")))
+
+    assert snapshot.load(config, metadata_conf) is None
+    parsed = load_metadata(config, metadata_conf, snapshot)
+    loaded = snapshot.load(config, metadata_conf)
+    assert loaded is not None
+    assert list(loaded.keys()) == list(parsed.keys())
+    entity_id = "http://example.com/unittest_idp.xml"
+    assert (loaded.single_sign_on_service(entity_id) ==
+            parsed.single_sign_on_service(entity_id))
+
+    # Changed files make the snapshot stale.
+    shutil.copy(os.path.join(CONFIGURATIONS, "unittest_sp.xml"), str(metadata))
+    assert snapshot.load(config, metadata_conf) is None
+    assert list(load_metadata(config, metadata_conf, snapshot).keys()) == [
+        "http://example.com/unittest_sp.xml"]
+    assert snapshot.load(config, metadata_conf) is not None
+
+
+def test_snapshot_only_local(tmpdir):
+    snapshot = MetadataSnapshot(str(tmpdir.join("md.snapshot")))
+    config = config_factory("sp", "tests.configurations.proxy_conf")
+    assert not snapshot.save(config.metadata,
+                             {"remote": [{"url": "https://example.com"}]})
+
+
+def test_engines_share_metadata():
+    app = WsgiApplication("tests.configurations.proxy_conf",
+                          entityid="http://example.com/unittest_idp.xml")
+    assert app.sp.metadata is app.idp.metadata
+    assert app.config["SP"].metadata is app.config["IDP"].metadata
@@ -0,0 +1,76 @@
+import pytest
+
+from s2sproxy.metrics import Metrics
+from s2sproxy.metrics import NULL_METRICS
+from s2sproxy.server import WsgiApplication
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import call
+from tests.test_util import login
+
+
+def test_histogram_buckets():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    histogram = metrics._histogram("parse")
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+
+    text = metrics.render()
+    assert 's2sproxy_phase_seconds_bucket{phase="parse",le="0.1"} 1' in text
+    assert 's2sproxy_phase_seconds_bucket{phase="parse",le="1.0"} 3' in text
+    assert 's2sproxy_phase_seconds_bucket{phase="parse",le="+Inf"} 4' in text
+    assert 's2sproxy_phase_seconds_count{phase="parse"} 4' in text
+    assert 's2sproxy_phase_seconds_sum{phase="parse"} 6.05' in text
+
+
+def test_counters_and_collectors():
+    metrics = Metrics()
+    with metrics.phase("routing"):
+        pass
+    metrics.request("SP/authn_response/post")
+    metrics.request("SP/authn_response/post")
+    metrics.error(KeyError("x"))
+    metrics.add_collector("state", lambda: {"hits": 3, "name": "skipped"})
+
+    text = metrics.render()
+    assert 's2sproxy_phase_seconds_count{phase="routing"} 1' in text
+    assert ('s2sproxy_requests_total{endpoint="SP/authn_response/post"} 2'
+            in text)
+    assert 's2sproxy_errors_total{error="KeyError"} 1' in text
+    assert "s2sproxy_state_hits 3" in text
+    assert "name" not in text
+
+
+def test_disabled_by_default():
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    assert app.metrics is NULL_METRICS
+    status, _, _ = call(app.run_server, "https://example.com/metrics")
+    assert status.startswith("404")
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(METRICS=True)
+
+
+def test_metrics_endpoint(app):
+    login(app.run_server, FakeSP("tests.configurations.sp_conf"),
+          FakeIdP(USERS))
+
+    status, headers, body = call(app.run_server,
+                                 "https://example.com/metrics")
+    assert status.startswith("200")
+    assert dict(headers)["Content-type"].startswith("text/plain")
+    text = body.decode("utf-8")
+    for phase in ("routing", "unpack_redirect", "unpack_post",
+                  "parse_authn_request", "pick_binding", "state_put",
+                  "state_get", "parse_authn_request_response",
+                  "get_attributes", "create_authn_response",
+                  "apply_binding"):
+        assert 's2sproxy_phase_seconds_count{phase="%s"}' % phase in text
+    assert ('s2sproxy_requests_total{endpoint="IDP/handle_authn_request/'
+            'redirect"} 1' in text)
+    assert "s2sproxy_state_entries 0" in text
@@ -0,0 +1,234 @@
+import multiprocessing
+import os
+import shelve
+import signal
+import time
+
+import cherrypy
+import pytest
+from saml2.ident import IdentDB
+
+from s2sproxy.front import SamlIDP
+from s2sproxy.nameid import NameIDStore
+from s2sproxy.nameid import merge
+from s2sproxy.nameid import migrate
+from s2sproxy.prefork import PreforkServer
+from s2sproxy.prefork import listen
+from s2sproxy.proxy_server import serve_worker
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import login
+
+
+def test_write_behind(tmp_path):
+    path = str(tmp_path / "nameid.db")
+    store = NameIDStore(path, flush_interval=60)
+    other = NameIDStore(path, flush_interval=60)
+    # New keys are written right away.
+    store["a"] = "1"
+    assert other["a"] == "1"
+    assert store.stats()["pending"] == 0
+
+    store["a"] = "2"
+    assert store["a"] == "2"
+    assert NameIDStore(path)["a"] == "1"
+    assert store.stats()["pending"] == 1
+    store.flush()
+    assert NameIDStore(path)["a"] == "2"
+    del store["a"]
+    assert "a" not in store
+    store.close()
+    assert len(NameIDStore(path)) == 0
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_read_cache(tmp_path):
+    path = str(tmp_path / "nameid.db")
+    clock = Clock()
+    store = NameIDStore(path, flush_interval=0, cache_ttl=60, timer=clock)
+    other = NameIDStore(path, flush_interval=0)
+    store["a"] = "1"
+    misses = store.stats()["misses"]
+    other["a"] = "2"
+    # Cached until the entry expires.
+    assert store["a"] == "1"
+    assert store.stats()["misses"] == misses
+    clock.now += 60
+    assert store["a"] == "2"
+
+
+def test_merge():
+    assert merge(None, None, "x") == "x"
+    assert merge("x", "x", "x y") == "x y"
+    assert merge("x z", "x", "x y") == "x z y"
+    assert merge("z", None, "y") == "z y"
+
+
+def test_concurrent_appends(tmp_path):
+    # Two processes issuing NameIDs to the same user for different SPs.
+    path = str(tmp_path / "nameid.db")
+    IdentDB(NameIDStore(path), name_qualifier="proxy").persistent_nameid(
+        "user", sp_name_qualifier="sp0")
+    store1 = NameIDStore(path, flush_interval=60)
+    store2 = NameIDStore(path, flush_interval=60)
+    ident1 = IdentDB(store1, name_qualifier="proxy")
+    ident2 = IdentDB(store2, name_qualifier="proxy")
+    nameid1 = ident1.persistent_nameid("user", sp_name_qualifier="sp1")
+    nameid2 = ident2.persistent_nameid("user", sp_name_qualifier="sp2")
+    store1.flush()
+    store2.flush()
+
+    ident = IdentDB(NameIDStore(path), name_qualifier="proxy")
+    assert ident.persistent_nameid("user", sp_name_qualifier="sp1") == nameid1
+    assert ident.persistent_nameid("user", sp_name_qualifier="sp2") == nameid2
+    assert ident.find_local_id(nameid2) == "user"
+    assert store2.stats()["merges"] == 1
+
+
+def test_migrate(tmp_path):
+    source = str(tmp_path / "idp.subject")
+    db = shelve.open(source, writeback=True, protocol=2)
+    nameid = IdentDB(db).persistent_nameid("user", sp_name_qualifier="sp")
+    db.close()
+
+    path = str(tmp_path / "nameid.db")
+    assert migrate(source, path) == 2
+    ident = IdentDB(NameIDStore(path))
+    assert ident.persistent_nameid("user", sp_name_qualifier="sp") == nameid
+
+
+def issued_nameid(app, sp, idp, monkeypatch):
+    """
+    Login and return the NameID the proxy issued to the SP.
+    """
+    name_ids = []
+    construct = SamlIDP.construct_authn_response
+
+    def record(self, identity, name_id, *args, **kwargs):
+        name_ids.append(name_id)
+        return construct(self, identity, name_id, *args, **kwargs)
+    monkeypatch.setattr(SamlIDP, "construct_authn_response", record)
+
+    login(app.run_server, sp, idp)
+    return name_ids[0]
+
+
+@pytest.mark.parametrize("user_attribute", [None, "eduPersonPrincipalName"])
+def test_persistent_nameid(monkeypatch, make_app, tmp_path, user_attribute):
+    app = make_app(NAMEID_STORE=str(tmp_path / "nameid.db"),
+                   PERSISTENT_NAMEID=True,
+                   NAMEID_USER_ATTRIBUTE=user_attribute)
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+
+    first = issued_nameid(app, sp, idp, monkeypatch)
+    # The IdP sends a new transient NameID each time.
+    second = issued_nameid(app, sp, idp, monkeypatch)
+    assert first == second
+    assert first.sp_name_qualifier == sp.config.entityid
+    assert first.name_qualifier == app.idp.config.entityid
+
+    app.idp.ident.db.flush()
+    ident = IdentDB(NameIDStore(str(tmp_path / "nameid.db")))
+    userid = ident.find_local_id(first)
+    if user_attribute:
+        assert userid == "test1@example.com"
+    else:
+        assert userid.startswith(IDP_ENTITY_ID + "!")
+
+
+def _run_master(app, directory):
+    listener = listen("127.0.0.1", 0)
+
+    def run_worker():
+        # The first NameID of a user is written right away, the second
+        # when the worker stops.
+        app.idp.ident.persistent_nameid(
+            "user%d" % os.getpid(), sp_name_qualifier="sp1")
+        nameid = app.idp.ident.persistent_nameid(
+            "user%d" % os.getpid(), sp_name_qualifier="sp2")
+
+        def started():
+            with open(os.path.join(directory, str(os.getpid())), "w") as f:
+                f.write(nameid.text)
+        cherrypy.engine.subscribe("start", started, priority=80)
+        serve_worker(app, listener)
+
+    PreforkServer(run_worker, 1, stop_timeout=5).run()
+
+
+def wait_for_workers(directory, count):
+    deadline = time.time() + 10
+    while len(os.listdir(directory)) < count and time.time() < deadline:
+        time.sleep(0.1)
+    assert len(os.listdir(directory)) >= count
+    return os.listdir(directory)
+
+
+def test_recycled_worker_writes_nameids(make_app, tmp_path):
+    path = str(tmp_path / "nameid.db")
+    directory = tmp_path / "workers"
+    directory.mkdir()
+    app = make_app(start=False, NAMEID_STORE=path, NAMEID_FLUSH_INTERVAL=60)
+    master = multiprocessing.get_context("fork").Process(
+        target=_run_master, args=(app, str(directory)))
+    master.start()
+    try:
+        pid = wait_for_workers(str(directory), 1)[0]
+        with open(str(directory / pid)) as f:
+            nameid = f.read()
+        # Recycle the worker, the master starts another.
+        os.kill(int(pid), signal.SIGTERM)
+        wait_for_workers(str(directory), 2)
+    finally:
+        os.kill(master.pid, signal.SIGTERM)
+        master.join(10)
+
+    ident = IdentDB(NameIDStore(path))
+    nameids = ident.find_nameid("user%s" % pid, sp_name_qualifier="sp2")
+    assert [name_id.text for name_id in nameids] == [nameid]
+
+
+def _enroll(app, sp_entity_id, barrier, queue):
+    # Both processes miss the user before either one adds it.
+    insert = app.nameid_store._insert
+
+    def wait_and_insert(key, value):
+        if key == "user":
+            barrier.wait(10)
+        return insert(key, value)
+    app.nameid_store._insert = wait_and_insert
+    queue.put(app.issue_nameid("user", sp_entity_id).text)
+    app.nameid_store.close()
+
+
+@pytest.mark.parametrize("sp_entity_ids", [("sp", "sp"), ("sp1", "sp2")])
+def test_concurrent_enrollment(make_app, tmp_path, sp_entity_ids):
+    path = str(tmp_path / "nameid.db")
+    app = make_app(start=False, NAMEID_STORE=path, NAMEID_FLUSH_INTERVAL=60,
+                   PERSISTENT_NAMEID=True)
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(2)
+    queues = [context.Queue() for _ in sp_entity_ids]
+    workers = [context.Process(target=_enroll,
+                               args=(app, sp_entity_id, barrier, queue))
+               for sp_entity_id, queue in zip(sp_entity_ids, queues)]
+    for worker in workers:
+        worker.start()
+    issued = [queue.get(timeout=30) for queue in queues]
+    for worker in workers:
+        worker.join(10)
+
+    ident = IdentDB(NameIDStore(path))
+    for sp_entity_id, nameid in zip(sp_entity_ids, issued):
+        stored = ident.find_nameid("user", sp_name_qualifier=sp_entity_id)
+        assert [name_id.text for name_id in stored] == [nameid]
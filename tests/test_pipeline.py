@@ -0,0 +1,91 @@
+import pytest
+
+from s2sproxy.util.attribute_module import AttributeModule
+from s2sproxy.util.attribute_module import NoUserData
+from s2sproxy.util.pipeline import PipelineAttributes
+from s2sproxy.util.pipeline import compile_pipeline
+
+
+def test_steps():
+    pipeline = compile_pipeline([
+        ("rename", {"email": "mail"}),
+        ("static", {"o": "Small university"}),
+        ("rewrite", "mail", r"@old\.example\.com$", "@example.com"),
+        ("scope", "affiliation", "example.com"),
+        ("drop", ["nin"]),
+        ("keep", ["mail", "o", "affiliation", "uid"]),
+    ])
+    attributes = {"email": ["a@old.example.com"], "nin": ["1"],
+                  "affiliation": ["staff", "member@other.org"],
+                  "uid": "a", "sn": ["A"]}
+
+    assert pipeline(attributes) == {
+        "mail": ["a@example.com"], "o": ["Small university"],
+        "affiliation": ["staff@example.com", "member@other.org"],
+        "uid": ["a"]}
+    # The input is left alone.
+    assert attributes["email"] == ["a@old.example.com"]
+    assert "nin" in attributes
+
+
+def test_unknown_step():
+    with pytest.raises(ValueError):
+        compile_pipeline([("uppercase", "mail")])
+
+
+class CountingSource(AttributeModule):
+    def __init__(self):
+        self.calls = 0
+
+    def get_attributes(self, idp_attributes):
+        self.calls += 1
+        idp_attributes = dict(idp_attributes)
+        idp_attributes["sn"] = ["User"]
+        return idp_attributes
+
+
+def test_cache():
+    source = CountingSource()
+    module = PipelineAttributes([("rename", {"sn": "surname"})],
+                                source=source, user_id_attribute="uid",
+                                cache_ttl=60)
+
+    first = module.get_attributes({"uid": ["a"]})
+    first["surname"].append("modified")
+    second = module.get_attributes({"uid": ["a"]})
+    module.get_attributes({"uid": ["b"]})
+
+    assert second == {"uid": ["a"], "surname": ["User"]}
+    assert source.calls == 2
+    stats = module.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["hit_rate"] == pytest.approx(1 / 3.0)
+
+    with pytest.raises(NoUserData):
+        module.get_attributes({"mail": ["a@example.com"]})
+
+
+def test_cache_keyed_on_attributes():
+    source = CountingSource()
+    module = PipelineAttributes([("rename", {"mail": "email"})],
+                                source=source, user_id_attribute="uid",
+                                cache_ttl=60)
+
+    # The same local id from two IdPs, different users.
+    first = module.get_attributes({"uid": ["a"], "mail": ["a@one.org"]})
+    second = module.get_attributes({"uid": ["a"], "mail": ["a@two.org"]})
+    assert first["email"] == ["a@one.org"]
+    assert second["email"] == ["a@two.org"]
+    # Changed attributes aren't hidden by the cache.
+    changed = module.get_attributes({"uid": ["a"], "mail": ["new@one.org"]})
+    assert changed["email"] == ["new@one.org"]
+    assert source.calls == 3
+
+    module.get_attributes({"mail": "a@one.org", "uid": ["a"]})
+    assert source.calls == 3
+
+
+def test_cache_requires_user_id():
+    with pytest.raises(ValueError):
+        PipelineAttributes([], cache_ttl=60)
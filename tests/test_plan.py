@@ -0,0 +1,59 @@
+import pytest
+from saml2.config import config_factory
+from saml2.server import Server
+
+from s2sproxy.plan import ResponsePlans
+from tests.test_util import FakeSP
+
+PROXY_CONF = "tests.configurations.proxy_conf"
+
+
+@pytest.fixture(scope="module")
+def idp():
+    return Server(config=config_factory("idp", PROXY_CONF))
+
+
+@pytest.fixture
+def authn_req():
+    sp = FakeSP("tests.configurations.sp_conf")
+    _, req = sp.create_authn_request("https://example.com/sso/redirect")
+    return req
+
+
+def test_response_args_cached(idp, authn_req):
+    plans = ResponsePlans(idp)
+
+    assert plans.response_args(authn_req) == idp.response_args(authn_req)
+    assert plans.misses == 1
+    # The front end's pick_binding resolves to the same endpoint.
+    assert plans.pick_binding(
+        "assertion_consumer_service", entity_id=authn_req.issuer.text,
+        request=authn_req) == (plans.response_args(authn_req)["binding"],
+                               plans.response_args(authn_req)["destination"])
+    assert plans.misses == 1
+    assert plans.hits == 3
+    assert plans.stats()["entities"] == 1
+
+
+def test_invalidate(idp, authn_req):
+    plans = ResponsePlans(idp)
+    plans.response_args(authn_req)
+    plans.invalidate()
+    plans.response_args(authn_req)
+    assert plans.misses == 2
+    assert plans.stats()["invalidations"] == 1
+
+
+def test_plan_values(idp, authn_req):
+    plan = ResponsePlans(idp).plan(authn_req.issuer.text)
+    assert plan.attribute_requirement is plan.attribute_requirement
+    assert plan.encryption_certs is plan.encryption_certs
+
+
+def test_unknown_entity_not_cached(idp):
+    plans = ResponsePlans(idp)
+    for _ in range(2):
+        with pytest.raises(Exception):
+            plans.pick_binding("assertion_consumer_service",
+                               entity_id="https://unknown.example.com")
+    assert plans.misses == 2
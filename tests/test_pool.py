@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+import pytest
+from saml2 import class_name
+from saml2.saml import Assertion
+from saml2.saml import Issuer
+from saml2.samlp import Response
+from saml2.sigver import pre_encryption_part
+from saml2.sigver import pre_signature_part
+
+pytest.importorskip("xmlsec")
+
+from s2sproxy.crypto import IN_PROCESS
+from s2sproxy.pool import CryptoJobTimeout
+from s2sproxy.pool import CryptoPool
+from s2sproxy.pool import CryptoPoolFull
+
+PKI = os.path.join(os.path.dirname(__file__), "pki")
+
+
+@pytest.fixture
+def pool():
+    pool = CryptoPool(1, IN_PROCESS, max_pending=1, timeout=5)
+    yield pool
+    pool.shutdown()
+
+
+def test_sign_and_verify_in_worker(pool):
+    statement = Response(id="id-1", version="2.0",
+                         issue_instant="2015-01-01T00:00:00Z",
+                         issuer=Issuer(text="https://idp.example.com"),
+                         signature=pre_signature_part("id-1", None, 1))
+    node_name = class_name(statement)
+    signed = pool.sign_statement(statement, node_name,
+                                 os.path.join(PKI, "key.pem"), "id-1")
+    assert pool.validate_signature(signed, os.path.join(PKI, "cert.pem"),
+                                   "pem", node_name, "id-1")
+    assert pool.stats()["completed"] == 2
+
+
+def test_encrypt_and_decrypt_in_worker(pool):
+    statement = Response(id="id-1", version="2.0",
+                         issue_instant="2015-01-01T00:00:00Z",
+                         assertion=Assertion(
+                             id="id-2", version="2.0",
+                             issue_instant="2015-01-01T00:00:00Z"))
+    encrypted = pool.encrypt_assertion(statement,
+                                       os.path.join(PKI, "cert.pem"),
+                                       pre_encryption_part())
+    assert 'ID="id-2"' not in encrypted
+    decrypted = pool.decrypt(encrypted, os.path.join(PKI, "key.pem"))
+    assert 'ID="id-2"' in decrypted
+
+
+def test_full_queue_is_rejected(pool):
+    pool.submit(time.sleep, 0)  # Wait for the worker to start.
+    busy = threading.Thread(target=pool.submit, args=(time.sleep, 0.5))
+    busy.start()
+    time.sleep(0.1)
+    with pytest.raises(CryptoPoolFull):
+        pool.submit(time.sleep, 0)
+    busy.join()
+    assert pool.stats()["rejected"] == 1
+
+
+def wait_for_jobs(pool):
+    deadline = time.time() + 10
+    while pool.stats()["pending"] and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def test_slow_job_times_out(pool):
+    pool.submit(time.sleep, 0)
+    pool.timeout = 0.1
+    with pytest.raises(CryptoJobTimeout):
+        pool.submit(time.sleep, 0.5)
+    # The job still runs in the worker, and holds its slot until it ends.
+    with pytest.raises(CryptoPoolFull):
+        pool.submit(time.sleep, 0)
+    wait_for_jobs(pool)
+    pool.submit(time.sleep, 0)
+    stats = pool.stats()
+    assert (stats["timeouts"], stats["completed"], stats["cancelled"]) == \
+        (1, 3, 0)
+
+
+def test_queued_job_cancelled():
+    pool = CryptoPool(1, IN_PROCESS, max_pending=5, timeout=5)
+    try:
+        pool.submit(time.sleep, 0)
+        # One job runs, the next two wait in the worker's call queue.
+        busy = [threading.Thread(target=pool.submit, args=(time.sleep, 0.5))
+                for _ in range(3)]
+        for thread in busy:
+            thread.start()
+        time.sleep(0.1)
+        pool.timeout = 0.1
+        with pytest.raises(CryptoJobTimeout):
+            pool.submit(time.sleep, 0)
+        for thread in busy:
+            thread.join()
+        wait_for_jobs(pool)
+        stats = pool.stats()
+        assert (stats["timeouts"], stats["completed"], stats["cancelled"]) \
+            == (1, 4, 1)
+    finally:
+        pool.shutdown()
+
+
+def test_failed_job(pool):
+    with pytest.raises(ZeroDivisionError):
+        pool.submit(divmod, 1, 0)
+    wait_for_jobs(pool)
+    assert (pool.stats()["failed"], pool.stats()["completed"]) == (1, 0)
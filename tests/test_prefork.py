@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from s2sproxy.prefork import PreforkServer
+from s2sproxy.prefork import RequestCounter
+
+
+def test_request_counter_stops_once():
+    stops = []
+
+    def app(environ, start_response):
+        return [b"ok"]
+
+    counter = RequestCounter(app, 3, lambda: stops.append(1))
+    for _ in range(5):
+        assert counter({}, None) == [b"ok"]
+    assert counter.count == 5
+    assert stops == [1]
+
+
+def _run_master(directory):
+    def run_worker():
+        open(os.path.join(directory, str(os.getpid())), "w").close()
+        # The first workers exit right away, as if recycled.
+        if len(os.listdir(directory)) > 3:
+            time.sleep(60)
+
+    PreforkServer(run_worker, 2, stop_timeout=5).run()
+
+
+def test_prefork_replaces_and_stops_workers(tmpdir):
+    directory = str(tmpdir)
+    master = multiprocessing.get_context("fork").Process(
+        target=_run_master, args=(directory,))
+    master.start()
+
+    deadline = time.time() + 10
+    while len(os.listdir(directory)) < 5 and time.time() < deadline:
+        time.sleep(0.1)
+    pids = [int(name) for name in os.listdir(directory)]
+    assert len(pids) >= 5
+
+    os.kill(master.pid, signal.SIGTERM)
+    master.join(10)
+    assert master.exitcode == 0
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            pass
+        else:
+            assert False, "worker %d still running" % pid
@@ -0,0 +1,153 @@
+import pytest
+from saml2.assertion import Policy
+from saml2.attribute_converter import ac_factory
+from saml2.entity_category.refeds import RESEARCH_AND_SCHOLARSHIP
+from saml2.s_utils import MissingValue
+from saml2.saml import NAME_FORMAT_URI
+
+from s2sproxy.release import NameFormConverter
+from s2sproxy.release import Release
+from s2sproxy.server import WsgiApplication
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import login
+
+SP_ENTITY_ID = "https://sp.example.com/sp.xml"
+
+AVA = {
+    "givenName": ["Test"],
+    "sn": ["User"],
+    "mail": ["test@example.com", "test@other.org"],
+    "eduPersonPrincipalName": ["test@example.com"],
+    "eduPersonTargetedID": ["one!for!all"],
+    "eduPersonAffiliation": ["staff", "member"],
+}
+
+
+class FakeMetadata(object):
+    def registration_info(self, entity_id):
+        return {}
+
+    def entity_categories(self, entity_id):
+        return [RESEARCH_AND_SCHOLARSHIP]
+
+
+def requested(friendly_name, oid, values=()):
+    attr = {"name": "urn:oid:%s" % oid, "name_format": NAME_FORMAT_URI,
+            "friendly_name": friendly_name}
+    if values:
+        attr["attribute_value"] = [{"text": value} for value in values]
+    return attr
+
+
+def released(restrictions, requirement):
+    """
+    What pysaml2 and the compiled policy release.
+    """
+    acs = ac_factory()
+    policy = Policy(restrictions, FakeMetadata())
+    policy.acs = acs
+    expected = policy.filter(dict(AVA), SP_ENTITY_ID,
+                             required=requirement.get("required"),
+                             optional=requirement.get("optional"))
+    release = Release(SP_ENTITY_ID, Policy(restrictions, FakeMetadata()), acs,
+                      requirement)
+    result = release.filter(dict(AVA))
+    return (dict((name, sorted(values)) for name, values in result.items()),
+            dict((name, sorted(values)) for name, values in expected.items()))
+
+
+@pytest.mark.parametrize("restrictions, requirement", [
+    (None, {}),
+    ({"default": {"attribute_restrictions": {
+        "givenName": None, "mail": [".*@example\\.com$"],
+        "eduPersonAffiliation": ["staff", "student"]}}}, {}),
+    ({SP_ENTITY_ID: {"attribute_restrictions": {"sn": None}},
+      "default": {"attribute_restrictions": {"givenName": None}}}, {}),
+    (None, {"required": [requested("mail", "0.9.2342.19200300.100.1.3")],
+            "optional": [requested("sn", "2.5.4.4"),
+                         requested("eduPersonAffiliation",
+                                   "1.3.6.1.4.1.5923.1.1.1.1",
+                                   ["member", "faculty"])]}),
+    ({"default": {"attribute_restrictions": {"mail": ["test@"]}}},
+     {"required": [requested("mail", "0.9.2342.19200300.100.1.3")]}),
+    ({"default": {"entity_categories": ["refeds"]}},
+     {"required": [requested("mail", "0.9.2342.19200300.100.1.3")]}),
+])
+def test_same_as_pysaml2(restrictions, requirement):
+    result, expected = released(restrictions, requirement)
+    assert result == expected
+
+
+def test_missing_required():
+    requirement = {"required": [requested("uid",
+                                          "0.9.2342.19200300.100.1.1")]}
+    with pytest.raises(MissingValue):
+        released(None, requirement)
+
+    restrictions = {"default": {"fail_on_missing_requested": False}}
+    result, expected = released(restrictions, requirement)
+    assert result == expected == {}
+
+    requirement = {"required": [requested("mail", "0.9.2342.19200300.100.1.3",
+                                          ["nobody@example.com"])]}
+    with pytest.raises(MissingValue):
+        released(None, requirement)
+
+
+def test_compiled_once_per_sp():
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    sp = FakeSP("tests.configurations.sp_conf")
+    idp = FakeIdP(USERS)
+    login(app.run_server, sp, idp)
+    login(app.run_server, sp, idp)
+    assert app.releases.stats() == {"entities": 1, "compiled": 1,
+                                    "invalidations": 0}
+
+    app.releases.invalidate()
+    login(app.run_server, sp, idp)
+    assert app.releases.stats()["compiled"] == 2
+
+
+def test_invalidated_while_compiling(monkeypatch):
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    sp_entity_id = FakeSP("tests.configurations.sp_conf").config.entityid
+    releases = app.releases
+    plan = releases.plans.plan
+
+    def refreshed(entity_id):
+        # The metadata is reloaded while the policy is compiled.
+        releases.invalidate()
+        return plan(entity_id)
+    monkeypatch.setattr(releases.plans, "plan", refreshed)
+    assert releases.release(sp_entity_id) is not None
+    assert releases.stats()["entities"] == 0
+
+    monkeypatch.setattr(releases.plans, "plan", plan)
+    first = releases.release(sp_entity_id)
+    assert releases.release(sp_entity_id) is first
+    assert releases.stats()["entities"] == 1
+
+
+def test_configured_policy_left_alone():
+    policy = Policy(None, FakeMetadata())
+    acs = policy.acs
+    Release(SP_ENTITY_ID, policy, ac_factory(), {})
+    assert policy.acs is acs
+
+
+def test_name_form_converters():
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    assert app.idp.config.attribute_converters
+    for converter in app.idp.config.attribute_converters:
+        assert isinstance(converter, NameFormConverter)
+
+    ava = dict(AVA, unknown=["value"])
+    for converter in ac_factory():
+        compiled = NameFormConverter(converter)
+        for _ in range(2):
+            assert [str(attr) for attr in compiled.to_(ava)] == \
+                [str(attr) for attr in converter.to_(ava)]
@@ -0,0 +1,109 @@
+import base64
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+import pytest
+from cryptography.fernet import Fernet
+from saml2.client_base import Base
+from saml2.config import config_factory
+
+import tests.configurations.proxy_conf as proxy_conf
+from s2sproxy.back import SamlSP
+from s2sproxy.remember import RememberedIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import call
+from tests.test_util import location
+
+DISCO_SRV = "https://disco.example.com/ds"
+KEY = Fernet.generate_key()
+
+
+def cookie_environ(remember, entity_id):
+    _, value = remember.cookie(entity_id)
+    return {"HTTP_COOKIE": value.split(";")[0]}
+
+
+def test_cookie():
+    remember = RememberedIdP(KEY, ttl=60)
+    assert remember.get(cookie_environ(remember, IDP_ENTITY_ID)) == \
+        IDP_ENTITY_ID
+    assert remember.get({}) is None
+    assert remember.get({"HTTP_COOKIE": "s2sproxy_idp=forged"}) is None
+    # Another key, e.g. another proxy's cookie.
+    other = RememberedIdP(Fernet.generate_key())
+    assert remember.get(cookie_environ(other, IDP_ENTITY_ID)) is None
+
+    _, value = remember.cookie(IDP_ENTITY_ID)
+    assert "Secure" in value and "HttpOnly" in value
+
+
+def test_common_domain_cookie():
+    value = " ".join(base64.b64encode(entity_id.encode("utf-8")).decode()
+                     for entity_id in ("https://old.example.com",
+                                       IDP_ENTITY_ID))
+    environ = {"HTTP_COOKIE": '_saml_idp="%s"' % value}
+    assert RememberedIdP(KEY).get(environ) is None
+    assert RememberedIdP(KEY, common_domain_cookie=True).get(environ) == \
+        IDP_ENTITY_ID
+
+
+def test_remembered_idp_checks():
+    remember = RememberedIdP(KEY)
+    sp = Base(config_factory("sp", PROXY_CONF))
+
+    inst = SamlSP(cookie_environ(remember, IDP_ENTITY_ID), None, sp,
+                  remember=remember)
+    assert inst.remembered_idp({}) == IDP_ENTITY_ID
+    assert inst.remembered_idp({"force_authn": "true"}) is None
+
+    inst = SamlSP(cookie_environ(remember, "https://gone.example.com"), None,
+                  sp, remember=remember)
+    assert inst.remembered_idp({}) is None
+
+    assert remember.stats() == {"bypassed": 1, "disco": 2,
+                                "bypass_rate": pytest.approx(1 / 3.0)}
+
+
+@pytest.fixture
+def app(monkeypatch, make_app):
+    monkeypatch.setitem(proxy_conf.CONFIG["service"]["sp"]["endpoints"],
+                        "discovery_response",
+                        [("%s/disco" % proxy_conf.BASE,
+                          "urn:oasis:names:tc:SAML:profiles:SSO:"
+                          "idp-discovery-protocol")])
+    return make_app(None, DISCO_SRV=DISCO_SRV, REMEMBER_IDP_KEY=KEY)
+
+
+def with_cookie(app, cookie):
+    def wrapped(environ, start_response):
+        environ["HTTP_COOKIE"] = cookie
+        return app(environ, start_response)
+    return wrapped
+
+
+def test_disco_skipped_for_returning_user(app):
+    sp = FakeSP("tests.configurations.sp_conf")
+
+    # First login: the user picks the IdP at the discovery service.
+    status, headers, _ = call(app.run_server, sp.make_auth_req())
+    disco = location(headers)
+    assert disco.startswith(DISCO_SRV)
+    return_url = parse_qs(urlsplit(disco).query)["return"][0]
+    status, headers, _ = call(app.run_server,
+                              "%s&entityID=%s" % (return_url, IDP_ENTITY_ID))
+    assert "SAMLRequest" in location(headers)
+    cookie = dict(headers)["Set-Cookie"].split(";")[0]
+
+    # Next login goes straight to the IdP.
+    status, headers, _ = call(with_cookie(app.run_server, cookie),
+                              sp.make_auth_req())
+    assert status.startswith("303")
+    assert not location(headers).startswith(DISCO_SRV)
+    assert "SAMLRequest" in location(headers)
+    assert "Set-Cookie" not in dict(headers)
+
+    stats = app.sp_args["remember"].stats()
+    assert stats["bypassed"] == 1
+    assert stats["disco"] == 1
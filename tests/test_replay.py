@@ -0,0 +1,100 @@
+from urllib.parse import urlencode
+
+import pytest
+from cryptography.fernet import Fernet
+from saml2 import BINDING_HTTP_POST
+
+from s2sproxy.replay import ReplayCache
+from s2sproxy.replay import response_keys
+from s2sproxy.state import StateStore
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import call
+from tests.test_util import login_response
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_window():
+    clock = Clock()
+    cache = ReplayCache(window=10, capacity=100, timer=clock)
+    assert not cache.add(["response a"])
+    assert cache.seen(["response a"])
+    assert not cache.seen(["response b"])
+    assert cache.add(["response b", "response a"])
+
+    # Kept in the filter of the previous window.
+    clock.now += 10
+    assert cache.seen(["response a"])
+    # Dropped two windows later.
+    clock.now += 10
+    cache.recent = None
+    assert not cache.seen(["response a"])
+    assert cache.stats()["replays"] == 3
+
+
+def test_false_positives_confirmed():
+    # A filter so small almost everything is a hit.
+    cache = ReplayCache(capacity=1, error_rate=0.5, recent=StateStore())
+    added = ["response %d" % i for i in range(100)]
+    cache.add(added)
+    assert cache.seen(added[:1])
+    others = ["response x%d" % i for i in range(100)]
+    assert not any(cache.seen([key]) for key in others)
+    assert cache.stats()["false_positives"] > 0
+
+    # Keys the exact set evicted can't be confirmed, hits are replays.
+    cache.recent.evictions += 1
+    assert any(cache.seen([key]) for key in others)
+
+
+def test_shared_file(tmp_path):
+    path = str(tmp_path / "replay")
+    worker1 = ReplayCache(path, capacity=1000)
+    worker2 = ReplayCache(path, capacity=1000)
+    assert not worker1.add(["response a"])
+    assert worker2.seen(["response a"])
+    assert worker2.add(["response a"])
+    assert not worker2.seen(["response b"])
+
+    with pytest.raises(ValueError):
+        ReplayCache(path, capacity=10).seen(["response a"])
+
+
+def test_response_keys():
+    assert response_keys("not base64!", BINDING_HTTP_POST) == []
+    assert response_keys("PGZvby8+", BINDING_HTTP_POST) == []
+
+
+def test_replay_refused(monkeypatch, make_app):
+    # The login state travels in RelayState, so nothing else stops a replay.
+    app = make_app(STATELESS_KEY=Fernet.generate_key(), REPLAY_DETECTION=True)
+    action, form = login_response(app.run_server,
+                                  FakeSP("tests.configurations.sp_conf"),
+                                  FakeIdP(USERS))
+    keys = response_keys(form["SAMLResponse"], BINDING_HTTP_POST)
+    assert [key.split()[0] for key in keys] == ["response", "in_response_to",
+                                                "assertion"]
+
+    body = urlencode(form).encode("utf-8")
+    status, _, _ = call(app.run_server, action, "POST", body)
+    assert status.startswith("302")
+
+    def verify(*args, **kwargs):
+        raise AssertionError("A replay must be refused before verifying it")
+    monkeypatch.setattr(app.sp, "parse_authn_request_response", verify)
+    status, _, _ = call(app.run_server, action, "POST", body)
+    assert status.startswith("401")
+    assert app.sp_args["replay"].stats()["replays"] == 1
+
+
+def test_off_by_default(make_app):
+    app = make_app()
+    assert "replay" not in app.sp_args
@@ -0,0 +1,37 @@
+from s2sproxy.router import Router
+
+ACS = ("SP", "authn_response", "post")
+SSO = ("IDP", "handle_authn_request", "redirect")
+SSO_SUB = ("IDP", "handle_authn_request", "sub")
+CUSTOM = ("CUSTOM", "handle")
+
+
+def test_exact_match():
+    router = Router([("acs/post", ACS)])
+    assert router.match("acs/post") == (ACS, "")
+    assert router.match("acs/postfoo") is None
+    assert router.match("acs") is None
+
+
+def test_prefix_match_gives_rest_of_path():
+    router = Router([("sso/redirect/*", SSO), ("sso/redirect", SSO)])
+    assert router.match("sso/redirect/abc/def") == (SSO, "abc/def")
+    assert router.match("sso/redirect") == (SSO, "")
+    assert router.match("sso/redirectx") is None
+
+
+def test_longest_prefix_wins():
+    router = Router([("sso/*", SSO), ("sso/sub/*", SSO_SUB)])
+    assert router.match("sso/sub/x") == (SSO_SUB, "x")
+    assert router.match("sso/other") == (SSO, "other")
+
+
+def test_regex_is_tried_last():
+    router = Router([("^(.*)/custom$", CUSTOM), ("a/custom", ACS)])
+    assert router.match("a/custom") == (ACS, "")
+    assert router.match("b/custom") == (CUSTOM, "b")
+
+
+def test_first_route_wins():
+    router = Router([("acs/post", ACS), ("acs/post", SSO)])
+    assert router.match("acs/post") == (ACS, "")
@@ -0,0 +1,113 @@
+import io
+import socket
+import threading
+import time
+
+import pytest
+from cheroot.wsgi import Server
+
+from s2sproxy.service import RequestTimeout
+from s2sproxy.service import RequestTooLarge
+from s2sproxy.service import parse_form
+from s2sproxy.service import read_body
+from tests.test_util import call
+
+
+def environ(body, length=True, **kwargs):
+    environ = {"wsgi.input": io.BytesIO(body)}
+    if length:
+        environ["CONTENT_LENGTH"] = str(len(body))
+    environ.update(kwargs)
+    return environ
+
+
+def test_parse_form():
+    body = (b"SAMLResponse=PHNhbWw%2BPC9zYW1sPg%3D%3D&ignored=" +
+            b"x" * 1000 + b"&RelayState=a+b&RelayState=second&SAMLRequest=")
+    assert parse_form(body) == {"SAMLResponse": "PHNhbWw+PC9zYW1sPg==",
+                                "RelayState": "a b"}
+
+
+def test_read_body():
+    assert read_body(environ(b"abc")) == b"abc"
+    # Only what CONTENT_LENGTH says is read.
+    assert read_body(environ(b"abcdef", CONTENT_LENGTH="3")) == b"abc"
+    # No length: read to the end only if the server terminates the input.
+    assert read_body(environ(b"abc", length=False)) == b""
+    assert read_body(environ(b"abc" * 100000, length=False,
+                             **{"wsgi.input_terminated": True})) == \
+        b"abc" * 100000
+
+
+def test_read_body_limits():
+    with pytest.raises(RequestTooLarge):
+        read_body(environ(b"abcd", **{"s2sproxy.max_body_size": 3}))
+    with pytest.raises(RequestTooLarge):
+        read_body(environ(b"abcd", length=False,
+                          **{"s2sproxy.max_body_size": 3,
+                             "wsgi.input_terminated": True}))
+    with pytest.raises(RequestTimeout):
+        read_body(environ(b"abcd", **{"s2sproxy.body_timeout": -1}))
+
+
+class StalledInput(object):
+    def read(self, size):
+        raise socket.timeout("timed out")
+
+
+def test_read_body_stalled():
+    with pytest.raises(RequestTimeout):
+        read_body({"wsgi.input": StalledInput(), "CONTENT_LENGTH": "4"})
+
+
+def test_read_body_bytes(monkeypatch):
+    # Read in more than one chunk, into a bytearray.
+    monkeypatch.setattr("s2sproxy.service.CHUNK_SIZE", 2)
+    body = read_body(environ(b"abcde"))
+    assert body == b"abcde"
+    assert type(body) is bytes
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(MAX_BODY_SIZES={"SP": 100})
+
+
+def test_too_large_body_refused(app):
+    status, _, _ = call(app.run_server, "https://example.com/acs/post",
+                        "POST", b"SAMLResponse=" + b"x" * 100)
+    assert status.startswith("413")
+
+
+def test_too_large_body_without_length(app):
+    def chunked(environ, start_response):
+        del environ["CONTENT_LENGTH"]
+        environ["wsgi.input_terminated"] = True
+        return app.run_server(environ, start_response)
+
+    status, _, _ = call(chunked, "https://example.com/acs/post", "POST",
+                        b"SAMLResponse=" + b"x" * 100)
+    assert status.startswith("413")
+
+
+def test_stalled_client_cut_off(make_app):
+    # The socket timeout, as proxy_server sets it, ends the read of a body
+    # that stopped arriving. CherryPy then closes the connection.
+    app = make_app(BODY_TIMEOUT=1)
+    server = Server(("127.0.0.1", 0), app.run_server,
+                    timeout=app.body_timeout)
+    server.prepare()
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    try:
+        client = socket.create_connection(server.bind_addr, timeout=10)
+        client.sendall(b"POST /acs/post HTTP/1.1\r\nHost: localhost\r\n"
+                       b"Content-Type: application/x-www-form-urlencoded\r\n"
+                       b"Content-Length: 1000\r\n\r\nSAMLResponse=")
+        start = time.monotonic()
+        assert client.recv(1024) == b""
+        assert time.monotonic() - start < 5
+        client.close()
+    finally:
+        server.stop()
+        thread.join()
@@ -0,0 +1,236 @@
+import multiprocessing
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+from saml2.saml import Issuer
+from saml2.samlp import AuthnRequest
+from saml2.samlp import NameIDPolicy
+
+from s2sproxy.server import WsgiApplication
+from s2sproxy.state import InvalidState
+from s2sproxy.state import MmapStateStore
+from s2sproxy.state import RelayStateSealer
+from s2sproxy.state import SQLiteStateStore
+from s2sproxy.state import StateStore
+from s2sproxy.state import dumps
+from s2sproxy.state import loads
+from tests.test_proxy_server import USERS
+from tests.test_util import FakeIdP
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import login
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire():
+    timer = FakeTimer()
+    store = StateStore(ttl=10, timer=timer)
+    store["a"] = 1
+    timer.now = 9
+    assert store["a"] == 1
+    timer.now = 10
+    assert "a" not in store
+    assert store.stats()["expirations"] == 1
+
+
+def test_only_live_entries_counted():
+    timer = FakeTimer()
+    store = StateStore(ttl=10, timer=timer)
+    store["a"] = 1
+    timer.now = 5
+    store["b"] = 2
+    assert len(store) == 2
+    timer.now = 10
+    assert len(store) == 1
+    assert list(store) == ["b"]
+    assert store.stats()["entries"] == 1
+    assert store.stats()["expirations"] == 1
+
+
+def test_least_recently_used_is_evicted():
+    store = StateStore(max_entries=2, timer=FakeTimer())
+    store["a"] = 1
+    store["b"] = 2
+    store["a"]
+    store["c"] = 3
+    assert sorted(store) == ["a", "c"]
+    assert store.stats()["evictions"] == 1
+
+
+def test_pop_consumes_entry():
+    store = StateStore(timer=FakeTimer())
+    store["a"] = 1
+    assert store.pop("a") == 1
+    assert store.pop("a", None) is None
+    with pytest.raises(KeyError):
+        store.pop("a")
+
+
+def test_counters():
+    store = StateStore(timer=FakeTimer())
+    store["a"] = 1
+    store["a"]
+    store.get("b")
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+@pytest.fixture(params=["sqlite", "mmap"])
+def shared_store(request, tmpdir):
+    def make(timer):
+        if request.param == "sqlite":
+            return SQLiteStateStore(str(tmpdir.join("state.db")), ttl=10,
+                                    timer=timer)
+        return MmapStateStore(str(tmpdir.join("state.map")), ttl=10, slots=64,
+                              slot_size=1024, timer=timer)
+    return make
+
+
+def test_shared_store_is_shared(shared_store):
+    timer = FakeTimer()
+    first, second = shared_store(timer), shared_store(timer)
+    first["a"] = ("authn_req", "relay", {"force_authn": "true"})
+    assert second["a"] == ("authn_req", "relay", {"force_authn": "true"})
+    assert second.pop("a")[1] == "relay"
+    assert "a" not in first
+
+
+def test_shared_store_expiry(shared_store):
+    timer = FakeTimer()
+    store = shared_store(timer)
+    store["a"] = 1
+    timer.now = 10
+    assert "a" not in store
+    assert list(store) == []
+
+
+def test_shared_store_batch(shared_store):
+    timer = FakeTimer()
+    first, second = shared_store(timer), shared_store(timer)
+    with first.batch():
+        first["a"] = 1
+        first["b"] = 2
+        del first["b"]
+        assert first["a"] == 1
+        assert "a" not in second
+    assert second["a"] == 1
+    assert "b" not in second
+
+
+def test_shared_store_pop_in_batch(shared_store):
+    timer = FakeTimer()
+    first, second = shared_store(timer), shared_store(timer)
+    second["a"] = 1
+    with first.batch():
+        # Consumed right away, not when the batch is written.
+        assert first.pop("a") == 1
+        assert "a" not in second
+        assert first.pop("a", None) is None
+        first["b"] = 2
+        assert first.pop("b") == 2
+    assert "b" not in second
+
+
+def _pop(store, queue):
+    with store.batch():
+        queue.put(store.pop("a", None))
+
+
+def test_shared_store_pop_once(shared_store):
+    store = shared_store(time.time)
+    context = multiprocessing.get_context("fork")
+    for _ in range(5):
+        store["a"] = 1
+        queue = context.Queue()
+        workers = [context.Process(target=_pop, args=(store, queue))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        results = [queue.get(timeout=30) for _ in workers]
+        for worker in workers:
+            worker.join()
+        assert sorted(results, key=repr) == [1, None, None, None]
+
+
+def test_saml_objects_are_stored_as_xml():
+    req = AuthnRequest(id="id-1", issuer=Issuer(text="https://sp.example.com"),
+                       name_id_policy=NameIDPolicy(allow_create="true"))
+    data = dumps((req, "relay", {"name_id_policy": req.name_id_policy}))
+    assert b"AuthnRequest" in data
+
+    authn_req, relay_state, req_args = loads(data)
+    assert authn_req.id == "id-1"
+    assert authn_req.issuer.text == "https://sp.example.com"
+    assert req_args["name_id_policy"].allow_create == "true"
+
+
+def test_mmap_store_evicts_when_probes_are_full(tmpdir):
+    store = MmapStateStore(str(tmpdir.join("state.map")), slots=8,
+                           slot_size=256, timer=FakeTimer())
+    for i in range(20):
+        store[str(i)] = i
+    assert len(store) == 8
+    assert store["19"] == 19
+    assert store.stats()["evictions"] == 12
+
+
+def test_sealed_state_round_trip():
+    sealer = RelayStateSealer(Fernet.generate_key())
+    req = AuthnRequest(id="id-1", issuer=Issuer(text="https://sp.example.com"))
+    token = sealer.seal({"authn_req": req, "relay_state": "hello"})
+    state = sealer.unseal(token)
+    assert state["authn_req"].id == "id-1"
+    assert state["relay_state"] == "hello"
+
+
+def test_sealed_state_is_authenticated():
+    sealer = RelayStateSealer(Fernet.generate_key())
+    token = sealer.seal({"relay_state": "hello"})
+    with pytest.raises(InvalidState):
+        RelayStateSealer(Fernet.generate_key()).unseal(token)
+    with pytest.raises(InvalidState):
+        sealer.unseal(token[:-4] + "AAAA")
+
+
+def test_sealer_key_rotation():
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    token = RelayStateSealer(old_key).seal("state")
+    assert RelayStateSealer([new_key, old_key]).unseal(token) == "state"
+
+
+class Session(dict):
+    # Stands in for a Beaker session, recording what was stored in it.
+    def __init__(self):
+        dict.__init__(self)
+        self.stored = []
+
+    def __setitem__(self, key, value):
+        self.stored.append(key)
+        dict.__setitem__(self, key, value)
+
+
+def test_beaker_session_per_request():
+    app = WsgiApplication(PROXY_CONF, IDP_ENTITY_ID)
+    cache = app.cache
+    session = Session()
+
+    def with_session(environ, start_response):
+        environ["beaker.session"] = session
+        return app.application(environ, start_response)
+
+    login(with_session, FakeSP("tests.configurations.sp_conf"),
+          FakeIdP(USERS))
+    assert session.stored
+    # The shared application and its store are left alone.
+    assert app.cache is cache
+    assert len(cache) == 0
+    assert cache.stats()["misses"] == 0
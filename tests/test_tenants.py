@@ -0,0 +1,106 @@
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+import pytest
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2.s_utils import decode_base64_and_inflate
+
+import tests.configurations.tenant_conf as tenant_conf
+import tests.test_asgi as asgi
+from s2sproxy.asgi import AsgiApplication
+from s2sproxy.tenants import MultiTenantApplication
+from s2sproxy.tenants import host_name
+from tests.test_util import FakeSP
+from tests.test_util import IDP_ENTITY_ID
+from tests.test_util import PROXY_CONF
+from tests.test_util import call
+from tests.test_util import location
+
+TENANT_CONF = "tests.configurations.tenant_conf"
+
+
+@pytest.fixture
+def app():
+    return MultiTenantApplication([
+        {"config": PROXY_CONF, "entityid": IDP_ENTITY_ID,
+         "host": "example.com"},
+        {"config": TENANT_CONF, "entityid": IDP_ENTITY_ID, "path": "b"}])
+
+
+def test_host_name():
+    assert host_name({"HTTP_HOST": "Example.com:8443"}) == "example.com"
+    assert host_name({"HTTP_HOST": "[::1]:8443"}) == "[::1]"
+    assert host_name({"HTTP_HOST": "[::1]"}) == "[::1]"
+    assert host_name({"SERVER_NAME": "example.com"}) == "example.com"
+
+
+def test_shared_metadata(app):
+    first, second = app.apps
+    assert len(app.metadata_stores) == 1
+    assert first.sp.metadata is second.sp.metadata
+    assert first.idp.metadata is second.idp.metadata
+    assert first.sp.config.entityid != second.sp.config.entityid
+
+
+def test_shared_metadata_refresh(monkeypatch):
+    # Set only for the second tenant, both follow the reloads.
+    monkeypatch.setattr(tenant_conf, "METADATA_REFRESH_INTERVAL", 60,
+                        raising=False)
+    app = MultiTenantApplication([
+        {"config": PROXY_CONF, "entityid": IDP_ENTITY_ID,
+         "host": "example.com"},
+        {"config": TENANT_CONF, "entityid": IDP_ENTITY_ID, "path": "b"}],
+        start=False)
+    first, second = app.apps
+    assert len(app.metadata_refreshers) == 1
+    refresher = app.metadata_refreshers[0]
+    assert first.metadata_refresher is second.metadata_refresher is refresher
+    assert refresher.interval == 60
+
+    old = first.sp.metadata
+    assert refresher.refresh(force=True)
+    for tenant in app.apps:
+        assert tenant.sp.metadata is tenant.idp.metadata is not old
+    assert first.sp.metadata is second.sp.metadata
+
+
+def issuer_of_request(headers):
+    req = parse_qs(urlsplit(location(headers)).query)
+    return decode_base64_and_inflate(req["SAMLRequest"][0])
+
+
+@pytest.mark.parametrize("prefix, entity_id", [
+    ("", b"https://example.com/proxy.xml"),
+    ("/b", b"https://example.com/b/proxy.xml")])
+def test_tenant_by_path(app, prefix, entity_id):
+    sp = FakeSP("tests.configurations.sp_conf")
+    destination = "https://example.com%s/sso/redirect" % prefix
+    _, authn_req = sp.create_authn_request(destination)
+    ht_args = sp.apply_binding(BINDING_HTTP_REDIRECT, "%s" % authn_req,
+                               destination, relay_state="hello")
+    status, headers, _ = call(app.run_server, ht_args["headers"][0][1])
+    assert status.startswith("303")
+    assert entity_id in issuer_of_request(headers)
+
+
+def test_unknown_tenant(app):
+    status, _, _ = call(app.run_server, "https://other.example.com/sso/redirect")
+    assert status.startswith("404")
+
+
+def test_duplicate_tenant():
+    with pytest.raises(ValueError):
+        MultiTenantApplication([{"config": PROXY_CONF, "host": "example.com"},
+                                {"config": TENANT_CONF,
+                                 "host": "Example.com"}])
+
+
+def test_asgi_tenants(app):
+    asgi_app = AsgiApplication(app)
+    status, headers, _ = asgi.call(asgi_app,
+                                   "https://other.example.com/sso/redirect")
+    assert status == 404
+    assert headers[b"content-length"] == b"%d" % len(
+        b"Couldn't find the side you asked for!")
+    status, _, _ = asgi.call(asgi_app, "https://example.com/b/unknown")
+    assert status == 404
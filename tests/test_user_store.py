@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+
+from s2sproxy.util.attribute_module import NoUserData
+from s2sproxy.util.user_store import UserStoreAttributes
+from s2sproxy.util.user_store import build
+from s2sproxy.util.user_store import read_csv
+from s2sproxy.util.user_store import read_json
+
+USERS_JSON = os.path.join(os.path.dirname(__file__), "users.json")
+
+
+@pytest.fixture
+def index(tmpdir):
+    path = str(tmpdir.join("users.db"))
+    build(read_json(USERS_JSON), path)
+    return path
+
+
+def test_lookup(index):
+    store = UserStoreAttributes(index, "eduPersonPrincipalName")
+    attributes = store.get_attributes(
+        {"eduPersonPrincipalName": ["test1@example.com"]})
+    assert attributes["testA"] == ["test1@valueA"]
+    assert attributes["email"] == ["test1@example.com"]
+
+
+def test_unknown_user(index):
+    store = UserStoreAttributes(index, "eduPersonPrincipalName")
+    with pytest.raises(NoUserData):
+        store.get_attributes({"eduPersonPrincipalName": ["nobody"]})
+    with pytest.raises(NoUserData):
+        store.get_attributes({"uid": ["test1"]})
+
+
+def test_missing_index(tmpdir):
+    with pytest.raises(Exception):
+        UserStoreAttributes(str(tmpdir.join("missing.db")), "uid")
+
+
+def test_csv(tmpdir):
+    source = tmpdir.join("users.csv")
+    source.write("uid,mail,affiliation\n"
+                 "alice,alice@example.com,staff;member\n"
+                 "bob,,student\n")
+    path = str(tmpdir.join("users.db"))
+    assert build(read_csv(str(source), "uid"), path) == 2
+
+    store = UserStoreAttributes(path, "uid")
+    assert store.lookup("alice") == {"mail": ["alice@example.com"],
+                                     "affiliation": ["staff", "member"]}
+    assert store.lookup("bob") == {"affiliation": ["student"]}
+
+
+def test_swap_index(tmpdir, index):
+    store = UserStoreAttributes(index, "eduPersonPrincipalName",
+                                check_interval=0)
+    assert store.lookup("new@example.com") is None
+
+    source = tmpdir.join("new.json")
+    source.write(json.dumps({"new@example.com": {"sn": ["New"]}}))
+    build(read_json(str(source)), index)
+
+    assert store.lookup("new@example.com") == {"sn": ["New"]}
+    assert store.lookup("test1@example.com") is None
+    # No temporary files left behind.
+    assert sorted(os.listdir(str(tmpdir))) == ["new.json", "users.db"]
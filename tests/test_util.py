@@ -1,10 +1,18 @@
 import base64
+import io
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from wsgiref.util import setup_testing_defaults
 
 from saml2 import server, BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
 from saml2.authn_context import AuthnBroker, authn_context_class_ref, PASSWORD
 from saml2.client import Saml2Client
 from saml2.config import config_factory
 
+PROXY_CONF = "tests.configurations.proxy_conf"
+IDP_ENTITY_ID = "http://example.com/unittest_idp.xml"
+
 
 class FakeSP(Saml2Client):
     def __init__(self, config_module):
@@ -37,7 +45,8 @@ class FakeIdP(server.Server):
         server.Server.__init__(self, 'configurations.idp_conf')
         self.user_db = user_db
 
-    def handle_auth_req(self, saml_request, relay_state, binding, userid):
+    def handle_auth_req(self, saml_request, relay_state, binding, userid,
+                        **kwargs):
         auth_req = self.parse_authn_request(saml_request, binding)
         binding_out, destination = self.pick_binding(
             'assertion_consumer_service',
@@ -50,6 +59,7 @@ class FakeIdP(server.Server):
         authn_broker.get_authn_by_accr(PASSWORD)
         resp_args['authn'] = authn_broker.get_authn_by_accr(PASSWORD)
 
+        resp_args.update(kwargs)
         _resp = self.create_authn_response(self.user_db[userid],
                                            userid=userid,
                                            **resp_args)
@@ -59,4 +69,84 @@ class FakeIdP(server.Server):
         url = http_args['url']
         saml_response = base64.b64encode(str(_resp).encode("utf-8"))
         resp = {'SAMLResponse': saml_response, 'RelayState': relay_state}
-        return url, resp
\ No newline at end of file
+        return url, resp
+
+
+def call(app, url, method="GET", body=b""):
+    """
+    Call a WSGI application in-process.
+
+    :return: (status, headers, body)
+    """
+    parts = urlsplit(url)
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": parts.path,
+        "QUERY_STRING": parts.query,
+        "HTTP_HOST": parts.netloc,
+        "CONTENT_LENGTH": str(len(body)),
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "wsgi.input": io.BytesIO(body),
+        "REMOTE_ADDR": "127.0.0.1",
+    }
+    setup_testing_defaults(environ)
+
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result["status"] = status
+        result["headers"] = headers
+
+    body = b"".join(app(environ, start_response))
+    return result["status"], result["headers"], body
+
+
+def location(headers):
+    for header, value in headers:
+        if header.lower() == "location":
+            return value
+
+
+def idp_response(idp, url, userid="test1", **kwargs):
+    """
+    The IdP's response to the authentication request the proxy redirected
+    to url.
+
+    :return: (action, form) to post to the proxy
+    """
+    req = parse_qs(urlsplit(url).query)
+    return idp.handle_auth_req(req["SAMLRequest"][0], req["RelayState"][0],
+                               BINDING_HTTP_REDIRECT, userid, **kwargs)
+
+
+def sp_response(sp, url):
+    """
+    The response the proxy redirected back to url, parsed by the SP.
+    """
+    req = parse_qs(urlsplit(url).query)
+    return sp.parse_authn_request_response(req["SAMLResponse"][0],
+                                           BINDING_HTTP_REDIRECT)
+
+
+def login_response(app, sp, idp, url=None, **kwargs):
+    """
+    The first leg of a login: the SP's authentication request (to url if
+    given) through the proxy to the IdP.
+
+    :return: (action, form) of the IdP's response
+    """
+    _, headers, _ = call(app, url or sp.make_auth_req())
+    return idp_response(idp, location(headers), **kwargs)
+
+
+def login(app, sp, idp, **kwargs):
+    """
+    A complete login through the proxy.
+
+    :return: (status, headers, body) of the response to the SP
+    """
+    action, form = login_response(app, sp, idp, **kwargs)
+    status, headers, body = call(app, action, "POST",
+                                 urlencode(form).encode("utf-8"))
+    assert status.startswith("302"), status
+    return status, headers, body